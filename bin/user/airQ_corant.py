@@ -25,6 +25,38 @@ Configuration in weewx.conf:
 [airQ]
 
     query_interval = 5.0 # optional, default 5.0 seconds
+    rolling_window = 3600 # optional, default 0 (off), max. 86400 seconds
+    derived_obs = loop # optional, 'loop' (default) or 'lazy'
+    source = device # optional, 'device' (default) or 'broker'
+    broker_socket = /tmp/weewx-airq.sock # optional
+    record_file = /var/tmp/airq.rec # optional, record the replies
+    processes = 0 # optional, number of processes to poll the devices
+    log_repeat_interval = 600 # optional, throttle repeated messages, 0 off
+    log_repeat_count = 1 # optional, messages logged per interval
+    snapshot_file = /var/www/html/weewx/airQ/airq.json # optional
+    snapshot_interval = 5 # optional, minimum interval, default 5 seconds
+    snapshot_unit_system = METRIC # optional, default unit system of LOOP
+    shm_file = /dev/shm/weewx-airq # optional, latest readings for local use
+    rollup_binding = airq_rollup_binding # optional, rollup store
+    rollup_keep_days = 14 # optional, days to keep the 1-minute tier
+    loop_static = always # optional, 'always' (default) or 'changed'
+    loop_static_every = 0 # optional, send static readings every N packets
+    batch_threshold = 50 # optional, use NumPy from 50 waiting replies on
+    include = co2, TVOC, pm2_5 # optional, readings to use, default all
+    exclude = cnt0_3, cnt0_5 # optional, readings not to use
+    spike_filter = pm2_5, TVOC # optional, readings to filter spikes out
+    spike_window = 15 # optional, values the median is taken of
+    spike_threshold = 3.0 # optional, rejected beyond 3 times the MAD
+    spike_min_deviation = 1.0 # optional, lower limit of the scaled MAD
+    reload_interval = 0 # optional, check weewx.conf for changed devices
+    config_cache = /var/lib/weewx/airq-config.json # optional
+    config_cache_ttl = 86400 # optional, seconds the cached config is valid
+    adaptive_interval = false # optional, adjust the query interval
+    query_interval_min = 1.0 # optional, lower limit of adaptive interval
+    query_interval_max = 30.0 # optional, upper limit of adaptive interval
+    profile_dir = /var/tmp/airq # optional, create file 'start' to profile
+    profile_packets = 100 # optional, LOOP packets to profile by cProfile
+    profile_minutes = 0 # optional, minutes to record memory allocations
 
     [[first_device]]
         host = replace_me_by_host_address_or_IP
@@ -32,6 +64,8 @@ Configuration in weewx.conf:
         prefix = replace_me # optional
         altitude = 123, meter # optional, default station altitude
         query_interval = 5.0 # optional, default 5.0 seconds
+        endpoint = data # optional, 'data' (default) or 'average'
+        adaptive_interval = false # optional, default general setting
         
     [[second_device]]
         ...
@@ -59,18 +93,36 @@ except ImportError:
 import six
 import threading
 import time
+import collections
+import bisect
+import os
+import socket
+import struct
+import sys
+import cProfile
+import pstats
+import tracemalloc
+try:
+    import numpy
+except ImportError:
+    numpy = None
 if __name__ != '__main__':
     # for use as service within WeeWX
     import weewx # WeeWX-specific exceptions, class Event
     from weewx.engine import StdService
     import weewx.units
     import weewx.accum
+    import weewx.xtypes
+    import weewx.manager
+    import weedb
     import weeutil.weeutil
+    import weeutil.logger
+    import weewx.uwxutils
+    import configobj
     from weewx.wxformulas import altimeter_pressure_Metric,sealevel_pressure_Metric
 else:
     # for standalone testing
     import sys
-    import collections
     sys.path.append('../../test')
     from testpasswd import airqIP,airqpass
     class StdService(object):
@@ -91,6 +143,10 @@ else:
             default_unit_label_dict = collections.ChainMap()
         class accum(object):
             accum_dict = collections.ChainMap()
+        class xtypes(object):
+            class XType(object):
+                pass
+            xtypes = []
     class weeutil(object):
         class weeutil(object):
             def to_int(x):
@@ -137,6 +193,7 @@ except ImportError:
 
 
 ACCUM_LAST_DICT = { 'accumulator':'firstlast','extractor':'last' }
+ACCUM_EXTRACT_LAST_DICT = { 'extractor':'last' }
 
 ##############################################################################
 #   add additional units needed for airQ                                     #
@@ -189,15 +246,34 @@ def airQreply(htmlreply, passwd):
     # reply converted to python dict with 'content' decoded
     return _rtn
 
-def airQget(host, page, passwd):
-    """ get page from airQ """
+def airQget(host, page, passwd, timeout=None, timing=None):
+    """ get page from airQ 
+    
+        If 'timing' is a dict, the duration of connecting, waiting for
+        the response, and decrypting is saved there in seconds.
+    """
+    connection = None
     try:
-        connection = http.client.HTTPConnection(host)
+        if timeout:
+            connection = http.client.HTTPConnection(host, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(host)
+        if timing is not None:
+            _ts = time.time()
+            connection.connect()
+            timing['connect'] = time.time()-_ts
+            _ts = time.time()
         connection.request('GET', page)
         _response = connection.getresponse()
         if _response.status==200:
             # successful --> get response
-            reply = airQreply(_response.read(), passwd)
+            _body = _response.read()
+            if timing is not None:
+                timing['response'] = time.time()-_ts
+                _ts = time.time()
+            reply = airQreply(_body, passwd)
+            if timing is not None:
+                timing['decrypt'] = time.time()-_ts
         else:
             # HTML error
             reply = {'content':{}}
@@ -223,20 +299,293 @@ def airQget(host, page, passwd):
             'replyexception': e.__class__.__name__,
             'content': {}}
     finally:
-        connection.close()
+        if connection: connection.close()
     return reply
 
     
+##############################################################################
+#   clocks and recording                                                     #
+##############################################################################
+
+class AirqClock(object):
+    """ system clock """
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, secs, event=None):
+        """ sleep, end early if 'event' is set """
+        if event is not None:
+            event.wait(secs)
+        else:
+            time.sleep(secs)
+
+
+class AirqVirtualClock(AirqClock):
+    """ clock set by the caller, used to replay recorded replies """
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def set(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs, event=None):
+        self.now += secs
+
+
+SYSTEM_CLOCK = AirqClock()
+
+
+class AirqRecorder(object):
+    """ record the replies of the devices to a file 
+
+        Each line of the file is a JSON object, either the config 
+        data of a device or a reply with the time of arrival.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path,'a')
+        self.lock = threading.Lock()
+        loginf("recording replies to '%s'" % path)
+
+    def _write(self, rec):
+        line = json.dumps(rec)+'\n'
+        with self.lock:
+            if self.file:
+                self.file.write(line)
+                self.file.flush()
+
+    def record_config(self, name, devconf):
+        """ record config data of the device """
+        self._write({'device':name,'config':{key:devconf[key] for key in DEVICE_CONFIG_KEYS if key in devconf}})
+
+    def record(self, name, ts, reply):
+        """ record a reply of the device """
+        self._write({'device':name,'ts':ts,'reply':reply})
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+##############################################################################
+#   cache of the config data of the devices                                  #
+##############################################################################
+
+# default time in seconds the cached config data are valid
+CONFIG_CACHE_TTL = 86400
+# time to wait before reading the config data again after a failure
+CONFIG_RETRY = 300
+
+class AirqConfigCache(object):
+    """ config data of the devices saved to disk
+
+        Used instead of requesting /config from every device at startup.
+        The file contains a JSON object of device name: {'host', 'time',
+        'config'}. It is replaced as a whole on every change.
+    """
+
+    def __init__(self, path, ttl=CONFIG_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.devices = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as file:
+                    self.devices = json.load(file)
+                if not isinstance(self.devices,dict):
+                    raise ValueError("no JSON object")
+            except (OSError,IOError,ValueError) as e:
+                logerr("config cache '%s': %s" % (path,e))
+                self.devices = {}
+
+    def get(self, name, host):
+        """ cached config data of the device and whether they are 
+            still valid, (None, False) if not cached for that host """
+        entry = self.devices.get(name)
+        if not entry or entry.get('host')!=host: return None, False
+        return entry.get('config',{}), time.time()<self.expires(name)
+
+    def expires(self, name):
+        """ end of validity of the cached config data """
+        return self.devices.get(name,{}).get('time',0)+self.ttl
+
+    def put(self, name, host, devconf):
+        """ save the config data of the device """
+        entry = {
+            'host':host,
+            'time':time.time(),
+            'config':{key:devconf[key] for key in DEVICE_CONFIG_KEYS if key in devconf}}
+        with self.lock:
+            self.devices[name] = entry
+            self._write()
+
+    def invalidate(self, name):
+        """ remove the config data of the device """
+        with self.lock:
+            if self.devices.pop(name,None) is not None:
+                self._write()
+
+    def _write(self):
+        tmp = self.path+'.tmp'
+        try:
+            with open(tmp,'w') as file:
+                json.dump(self.devices,file,indent=4,sort_keys=True)
+            os.rename(tmp,self.path)
+        except (OSError,IOError) as e:
+            logerr("config cache '%s': %s" % (self.path,e))
+
+
+##############################################################################
+#   rate-limited logging                                                     #
+##############################################################################
+
+class AirqLogThrottle(object):
+    """ rate-limited logging of repeated messages 
+    
+        Messages are grouped by device and kind, e.g. failed requests
+        or state changes. Within 'interval' seconds after the first 
+        message of a group only 'burst' messages are logged. The others
+        are counted, and a summary is logged at the end of the interval
+        instead. 'interval' 0 switches off throttling. The numbers of
+        messages logged and not logged are reported every 'interval'
+        seconds if messages were not logged.
+    """
+
+    def __init__(self, interval=600, burst=1, clock=None):
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.logged = 0
+        self.suppressed = 0
+        self.next_flush = 0
+        self.next_report = None
+        self.reported = 0
+        self.configure(interval, burst)
+
+    def configure(self, interval, burst=1):
+        self.interval = interval
+        self.burst = max(burst,1)
+
+    def log(self, name, kind, level, msg, owner='thread'):
+        """ log msg using the function 'level' unless there were too 
+            many messages of the same device and kind recently 
+            
+            'owner' names what 'name' is in the summary, e.g. 'thread'
+            or 'snapshot file'.
+        """
+        if self.interval<=0:
+            level(msg)
+            return
+        now = self.clock.time()
+        with self.lock:
+            group = self.groups.get((name,kind))
+            if group and now>=group['start']+self.interval:
+                self._summary(name, kind, group)
+                group = None
+            if not group:
+                group = {'start':now,'count':0,'suppressed':0}
+                self.groups[(name,kind)] = group
+            group['count'] += 1
+            group['level'] = level
+            group['owner'] = owner
+            group['last'] = msg
+            if group['count']>self.burst:
+                group['suppressed'] += 1
+                self.suppressed += 1
+                return
+            self.logged += 1
+        level(msg)
+
+    def clear(self, name, kind):
+        """ end a group, e.g. after the device recovered """
+        with self.lock:
+            group = self.groups.pop((name,kind),None)
+            if group: self._summary(name, kind, group)
+
+    def flush(self):
+        """ log the summaries of the groups whose interval is over """
+        now = self.clock.time()
+        if now<self.next_flush: return
+        with self.lock:
+            self.next_flush = now+10
+            for key in [key for key in self.groups if now>=self.groups[key]['start']+self.interval]:
+                self._summary(key[0], key[1], self.groups.pop(key))
+            if self.next_report is None:
+                self.next_report = now+self.interval
+            elif now>=self.next_report:
+                self.next_report = now+self.interval
+                if self.suppressed>self.reported:
+                    loginf("repeated messages: %s logged, %s not logged, %s of them in last %.0f s" % (self.logged,self.suppressed,self.suppressed-self.reported,self.interval))
+                    self.reported = self.suppressed
+
+    def _summary(self, name, kind, group):
+        if group['suppressed']:
+            span = min(self.clock.time()-group['start'],self.interval)
+            group['level']("%s '%s': %s %s in last %.0f s, %s of them not logged, last: %s" % (group['owner'],name,group['count'],kind,span,group['suppressed'],group['last']))
+
+    def stats(self):
+        """ numbers of messages logged and suppressed """
+        with self.lock:
+            return {
+                'logged':self.logged,
+                'suppressed':self.suppressed,
+                'pending':{'%s/%s' % key:self.groups[key]['suppressed'] for key in self.groups}}
+
+
+LOG_THROTTLE = AirqLogThrottle()
+
+
+def configure_log_throttle(conf):
+    """ set up rate-limited logging out of section [airQ] """
+    LOG_THROTTLE.configure(
+        weeutil.weeutil.to_float(conf.get('log_repeat_interval',600)),
+        weeutil.weeutil.to_int(conf.get('log_repeat_count',1)))
+    return (LOG_THROTTLE.interval,LOG_THROTTLE.burst)
+
+
 ##############################################################################
 #    Thread to retrieve data from the air-Q device                           #
 ##############################################################################
 
+# pages of the airQ device providing readings
+ENDPOINTS = {
+    'data':'/data',
+    'average':'/average'}
+
+# timeout of a request to the device in seconds
+POLL_TIMEOUT = 10.0
+
+# adaptive query interval: fresh readings wanted per LOOP packet,
+# minimum ratio of query interval to response time, weight of the
+# failure rate, and weight of a new value in the moving averages
+ADAPTIVE_SAMPLES = 2
+ADAPTIVE_RESPONSE = 4.0
+ADAPTIVE_FAILURE = 4.0
+ADAPTIVE_WEIGHT = 0.2
+
+def _ewma(avg, val):
+    """ exponentially weighted moving average """
+    return val if avg is None else avg+ADAPTIVE_WEIGHT*(val-avg)
+
 class AirqThread(threading.Thread):
     """ retrieve data from airQ device """
     
-    def __init__(self, q, name, address, passwd, log_success, log_failure, query_interval):
+    def __init__(self, q, name, address, passwd, log_success, log_failure, query_interval, clock=None, recorder=None, endpoint='data', shm=None, adaptive=None):
         """ initialize thread """
         super(AirqThread,self).__init__()
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.recorder = recorder
+        self.shm = shm
+        self.page = ENDPOINTS.get(endpoint,'/data')
         self.queue = q
         self.name = name
         self.address = address
@@ -245,40 +594,1551 @@ class AirqThread(threading.Thread):
         self.log_failure = log_failure
         self.query_interval = query_interval
         self.running = True
-        loginf("thread '%s', host '%s': initialized" % (self.name,self.address))
+        # set to end waiting early
+        self.wake = threading.Event()
+        # cProfile.Profile set by AirqProfiler and the one enabled
+        self.profile = None
+        self.profiling = None
+        # adaptive query interval: (minimum, maximum) or None, and the
+        # moving averages it is calculated from
+        self.adaptive = adaptive if self.page=='/data' else None
+        self.base_interval = query_interval
+        self.response = None
+        self.failure = 0.0
+        self.duplicates = 0.0
+        self.cadence = None
+        self.last_sample = None
+        self.last_duplicate = False
+        self.loop_interval = None
+        self.loop_samples = None
+        # query interval that lets ADAPTIVE_SAMPLES readings wait for
+        # each LOOP packet, and the interval of the current LOOP period
+        self.drain = None
+        self.period_interval = None
+        self.logged_interval = query_interval
+        loginf("thread '%s', host '%s': initialized, page '%s'" % (self.name,self.address,self.page))
         
     def shutDown(self):
         """ stop thread """
         self.running = False
+        self.wake.set()
+
+    def update(self, address, passwd, query_interval):
+        """ change host address, password, and query interval while 
+            the thread is running, and poll the device at once """
+        self.address = address
+        self.passwd = passwd
+        self.query_interval = query_interval
+        self.base_interval = query_interval
+        self.wake.set()
+
+    def loop_feedback(self, loop_interval, samples):
+        """ time since the previous LOOP packet and number of replies
+            that went into this one, called by the service """
+        self.loop_interval = _ewma(self.loop_interval, loop_interval)
+        self.loop_samples = _ewma(self.loop_samples, samples)
+        # The readings of the LOOP packet were requested at the interval
+        # in effect during that period. Scaled by the ratio of readings
+        # consumed to readings wanted, that is the interval the LOOP 
+        # drains the queue at.
+        if self.period_interval:
+            self.drain = _ewma(self.drain, self.period_interval*samples/ADAPTIVE_SAMPLES)
+        self.period_interval = self.query_interval
+
+    def _adapt(self, ok, response, ts):
+        """ adjust the query interval after a request
+
+            'response' is the duration of the request in seconds, 'ts'
+            the timestamp of the reading in milliseconds.
+        """
+        self.failure = _ewma(self.failure, 0.0 if ok else 1.0)
+        if ok:
+            self.response = _ewma(self.response, response)
+            if ts and ts==self.last_sample:
+                self.duplicates = _ewma(self.duplicates, 1.0)
+                self.last_duplicate = True
+            elif ts:
+                # The time between two readings is the cadence of the
+                # device only if the previous request was too early.
+                if self.last_duplicate and self.last_sample and ts>self.last_sample:
+                    self.cadence = _ewma(self.cadence, (ts-self.last_sample)/1000.0)
+                self.duplicates = _ewma(self.duplicates, 0.0)
+                self.last_duplicate = False
+                self.last_sample = ts
+        low, high = self.adaptive
+        # enough fresh readings for each LOOP packet, the configured
+        # interval if the LOOP is not known (worker processes)
+        if self.loop_interval:
+            target = self.loop_interval/ADAPTIVE_SAMPLES
+        else:
+            target = self.base_interval
+        # not faster than the LOOP consumes the readings
+        if self.drain:
+            target = max(target, self.drain)
+        # not faster than the device provides new readings
+        if self.cadence:
+            target = max(target, self.cadence)
+        # do not keep a slow device busy
+        if self.response:
+            target = max(target, ADAPTIVE_RESPONSE*self.response)
+        # back off if requests fail
+        target *= 1.0+ADAPTIVE_FAILURE*self.failure
+        self.query_interval = min(max(target,low),high)
+        if abs(self.query_interval-self.logged_interval)>0.2*self.logged_interval:
+            logdbg("thread '%s': query interval %.1f s, response %.2f s, failures %.0f%%, duplicates %.0f%%, cadence %s s, LOOP %s s, %s readings per LOOP packet, drained at %s s" % (
+                self.name,self.query_interval,self.response or 0,self.failure*100,self.duplicates*100,
+                '%.1f' % self.cadence if self.cadence else '-',
+                '%.1f' % self.loop_interval if self.loop_interval else '-',
+                '%.1f' % self.loop_samples if self.loop_samples is not None else '-',
+                '%.1f' % self.drain if self.drain else '-'))
+            self.logged_interval = self.query_interval
+
+    def _sleep(self, secs):
+        """ wait, but end early on shutDown() and update() """
+        self._profile(None)
+        self.clock.sleep(secs, self.wake)
+        self.wake.clear()
+        self._profile(self.profile)
+
+    def _profile(self, prof):
+        """ profile polling, but not waiting """
+        if self.profiling:
+            self.profiling.disable()
+        self.profiling = prof
+        if prof:
+            try:
+                prof.enable()
+            except ValueError as e:
+                # Python 3.12 and later allow one active profiler only.
+                logerr("thread '%s': profiling not possible: %s" % (self.name,e))
+                self.profile = self.profiling = None
         
     def run(self):
         """ run thread """
         loginf("thread '%s', host '%s': starting" % (self.name,self.address))
         try:
             errsleep = 60
-            laststatuschange = time.time()
+            laststatuschange = self.clock.time()
+            # averaged data: timestamp of the last average, time of arrival,
+            # and update cadence in seconds
+            last_ts = None
+            last_change = 0
+            cadence = None
             while self.running:
-                reply = airQget(self.address, '/data', self.passwd)
+                start = self.clock.time()
+                reply = airQget(self.address, self.page, self.passwd, timeout=POLL_TIMEOUT)
+                if self.adaptive:
+                    self._adapt(reply['replystatus']==200, self.clock.time()-start, reply['content'].get('timestamp'))
                 if reply['replystatus']==200:
                     if errsleep:
+                        LOG_THROTTLE.clear(self.name,'failures')
                         if self.log_success:
                             loginf("thread '%s', host '%s': %s - %s" % (self.name,self.address,reply['replystatus'],reply['replyreason']))
                         errsleep = 0
-                        laststatuschange = time.time()
-                    self.queue.put(reply['content'])
-                    time.sleep(self.query_interval)
+                        laststatuschange = self.clock.time()
+                    if self.page=='/data':
+                        if self.recorder:
+                            self.recorder.record(self.name, self.clock.time(), reply['content'])
+                        if self.shm:
+                            self.shm.write(self.name, reply['content'], self.clock.time())
+                        self.queue.put(reply['content'])
+                        self._sleep(self.query_interval)
+                    else:
+                        # The device updates the average at its own
+                        # cadence. Poll again shortly after the next
+                        # update is expected.
+                        now = self.clock.time()
+                        ts = reply['content'].get('timestamp')
+                        if ts!=last_ts:
+                            if last_ts and ts and ts>last_ts:
+                                # timestamp is in milliseconds
+                                cadence = min(max((ts-last_ts)/1000.0,self.query_interval),600.0)
+                            last_ts = ts
+                            last_change = now
+                            if self.recorder:
+                                self.recorder.record(self.name, now, reply['content'])
+                            if self.shm:
+                                self.shm.write(self.name, reply['content'], now)
+                            self.queue.put(reply['content'])
+                        wait = last_change+cadence+1.0-now if cadence else 0
+                        self._sleep(wait if wait>self.query_interval else self.query_interval)
                 else:
-                    if errsleep==0: laststatuschange = time.time()
+                    if errsleep==0: laststatuschange = self.clock.time()
+                    if self.shm:
+                        self.shm.set_offline(self.name)
                     if self.log_failure:
-                        logerr("thread '%s', host '%s': %s - %s - %.0f s since last success" % (self.name,self.address,reply['replystatus'],reply['replyreason'],time.time()-laststatuschange))
+                        LOG_THROTTLE.log(self.name,'failures',logerr,"thread '%s', host '%s': %s - %s - %.0f s since last success" % (self.name,self.address,reply['replystatus'],reply['replyreason'],self.clock.time()-laststatuschange))
                     # wait
-                    time.sleep(errsleep)
+                    self._sleep(errsleep)
                     if errsleep<300: errsleep+=60
         except Exception as e:
             logerr("thread '%s', host '%s': %s" % (self.name,self.address,e))
         finally:
+            self._profile(None)
             loginf("thread '%s', host '%s': stopped" % (self.name,self.address))
+
+
+##############################################################################
+#   aggregate the readings of a device                                       #
+##############################################################################
+
+class AirqSample(object):
+    """ aggregated readings of one device
+
+        'data' holds the last value of the readings that are not averaged,
+        'sum' and 'count' the sums and counts of the readings to average.
+        'replies' is the number of replies aggregated. Samples can be 
+        merged and sent over the network to another instance of WeeWX.
+    """
+
+    def __init__(self, data=None, sum=None, count=None, replies=0):
+        self.data = data if data is not None else {}
+        self.sum = sum if sum is not None else {}
+        self.count = count if count is not None else {}
+        self.replies = replies
+
+    def merge(self, sample):
+        """ add the readings of another sample """
+        self.data.update(sample.data)
+        self.replies += sample.replies
+        for key in sample.sum:
+            self.sum[key] = self.sum.get(key,0)+sample.sum[key]
+            self.count[key] = self.count.get(key,0)+sample.count[key]
+
+    def get_data(self):
+        """ last values and averages """
+        data = dict(self.data)
+        for key in self.sum:
+            data[key] = self.sum[key]/self.count[key]
+        return data
+
+    def to_dict(self):
+        return {'data':self.data,'sum':self.sum,'count':self.count,'replies':self.replies}
+
+    @staticmethod
+    def from_dict(x):
+        return AirqSample(x.get('data'),x.get('sum'),x.get('count'),x.get('replies',0))
+
+
+# number of replies from which on NumPy is used
+BATCH_THRESHOLD = 50
+
+# number of different 'Status' strings remembered per device
+STATUS_CACHE_SIZE = 64
+
+# defaults of the spike filter
+SPIKE_WINDOW = 15
+SPIKE_THRESHOLD = 3.0
+SPIKE_MIN_DEVIATION = 1.0
+
+class AirqHampel(object):
+    """ streaming Hampel filter of one reading
+
+        A value is rejected if it differs from the median of the last
+        'window' values by more than 'threshold' times the median
+        absolute deviation (MAD), scaled to the standard deviation.
+        The scaled MAD is taken as at least 'min_deviation', because
+        it is 0 for flat or integer readings, and any change would be
+        rejected then. Rejected values stay within the window, so a 
+        lasting change of the level is accepted after half the window.
+
+        The window is kept sorted. The median is looked up by index,
+        and the MAD is the k-th smallest of the distances to the 
+        median. The distances below and above the median form two
+        sorted sequences, so that is a binary search, too. Inserting
+        into and removing from the sorted list move the following 
+        entries, which is faster than a tree for windows of this size.
+    """
+
+    def __init__(self, window=SPIKE_WINDOW, threshold=SPIKE_THRESHOLD, min_deviation=SPIKE_MIN_DEVIATION):
+        self.window = window
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+        # values in order of arrival and sorted
+        self.values = collections.deque()
+        self.sorted = []
+        self.accepted = 0
+        self.rejected = 0
+
+    def check(self, val):
+        """ add 'val' to the window, False if it is a spike """
+        ok = True
+        if len(self.sorted)>=self.window:
+            med, mad = self.median_mad()
+            if abs(val-med)>self.threshold*max(1.4826*mad,self.min_deviation):
+                ok = False
+            # remove the oldest value
+            del self.sorted[bisect.bisect_left(self.sorted,self.values.popleft())]
+        self.values.append(val)
+        bisect.insort(self.sorted,val)
+        if ok:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        return ok
+
+    def median_mad(self):
+        """ median and median absolute deviation of the window """
+        srt = self.sorted
+        n = len(srt)
+        if n%2:
+            med = srt[n//2]
+        else:
+            med = (srt[n//2-1]+srt[n//2])/2.0
+        # distances of the values below and above the median, both
+        # in ascending order
+        m = bisect.bisect_left(srt,med)
+        below = lambda ii: med-srt[m-1-ii]
+        above = lambda ii: srt[m+ii]-med
+        if n%2:
+            mad = self._kth(below,m,above,n-m,n//2)
+        else:
+            mad = (self._kth(below,m,above,n-m,n//2-1)+self._kth(below,m,above,n-m,n//2))/2.0
+        return med, mad
+
+    @staticmethod
+    def _kth(a, la, b, lb, k):
+        """ k-th smallest (from 0) of two sorted sequences, given by
+            accessor functions and lengths """
+        lo = max(0,k+1-lb)
+        hi = min(k+1,la)
+        while True:
+            # take ii values out of a and jj values out of b
+            ii = (lo+hi)//2
+            jj = k+1-ii
+            if ii<la and jj>0 and b(jj-1)>a(ii):
+                lo = ii+1
+            elif ii>0 and jj<lb and a(ii-1)>b(jj):
+                hi = ii-1
+            else:
+                break
+        if ii==0: return b(jj-1)
+        if jj==0: return a(ii-1)
+        return max(a(ii-1),b(jj-1))
+
+
+class AirqAggregator(object):
+    """ check and aggregate the replies of one airQ device """
+
+    def __init__(self, name, last_only=False, keys=None, batch_threshold=BATCH_THRESHOLD, spike=None):
+        self.name = name
+        # If more replies are waiting, they are processed as an array.
+        self.batch_threshold = batch_threshold
+        # airQ keys to process, None means all
+        self.keys = keys
+        self.state = {'init':'1'}
+        # sensor faults as bit mask, see FAULT_BITS, and the parsed
+        # 'Status' strings seen last
+        self.status = None
+        self.mask = 0
+        self.status_cache = collections.OrderedDict()
+        # timestamp of the last reply and of the beginning of the 
+        # current sensor faults in ms, number of changes of the faults
+        self.last_ts = None
+        self.fault_since = None
+        self.fault_count = 0
+        # spike filters of the readings to average
+        self.filters = {}
+        if spike:
+            for key in spike:
+                try:
+                    group = AirqService.AIRQ_DATA[key][2]
+                except (KeyError,IndexError,TypeError):
+                    group = None
+                if group in AirqService.AVG_GROUPS:
+                    self.filters[key] = AirqHampel(*spike[key])
+                else:
+                    logerr("thread '%s': spike filter for '%s' ignored, as that reading is not averaged" % (name,key))
+        # The device provides averaged readings, so use the last 
+        # reply only.
+        self.last_only = last_only
+        # total number of replies processed
+        self.replies = 0
+
+    def aggregate(self, q):
+        """ get all the items out of the queue and aggregate them 
+        
+            The items can be replies of the device or samples already
+            aggregated by another process.
+        """
+        sample = AirqSample()
+        # get all the items out of the queue
+        replies = []
+        while True:
+            try:
+                replies.append(q.get(block=False))
+            except queue.Empty:
+                break
+            except KeyError:
+                # instead of queue.Empty KeyError was raised
+                break
+        if self.last_only:
+            raw = [ii for ii in replies if not isinstance(ii,AirqSample)]
+            replies = [ii for ii in replies if isinstance(ii,AirqSample)]+raw[-1:]
+            sample.replies += len(raw)-len(raw[-1:])
+            self.replies += len(raw)-len(raw[-1:])
+        last_ts = 0
+        raw = []
+        faults = False
+        for reply in replies:
+            try:
+                # already aggregated
+                if isinstance(reply,AirqSample):
+                    sample.merge(reply)
+                    self.replies += reply.replies
+                    continue
+                sample.replies += 1
+                self.replies += 1
+                # check timestamp
+                if reply['timestamp']<=last_ts: 
+                    logdbg("New record is older than last record.")
+                    continue
+                last_ts = reply['timestamp']
+                raw.append(reply)
+                faults = True
+            except (IndexError,ValueError,TypeError,KeyError) as e:
+                logerr("new_loop_packet %s" % e)
+        if numpy is not None and self.batch_threshold and len(raw)>self.batch_threshold:
+            # a lot of replies are waiting
+            try:
+                self._add_batch(sample, raw)
+                raw = []
+            except (ValueError,TypeError) as e:
+                logerr("thread '%s': batch processing failed: %s" % (self.name,e))
+        for reply in raw:
+            try:
+                self._add_reply(sample, reply)
+            except (IndexError,ValueError,TypeError,KeyError) as e:
+                logerr("new_loop_packet %s" % e)
+        if faults:
+            self._add_state(sample)
+        return sample
+
+    def _parse_status(self, status):
+        """ sensor state and fault mask out of 'Status', memoized
+
+            While a sensor is warming up or faulty, the device sends
+            the same few 'Status' strings for hours. Returns None if
+            'Status' is invalid.
+        """
+        try:
+            self.status_cache.move_to_end(status)
+            return self.status_cache[status]
+        except (KeyError,TypeError):
+            pass
+        try:
+            if status=='OK':
+                airqstate = {}
+            else:
+                airqstate = json.loads(status)
+                if 'Status' in airqstate:
+                    airqstate = airqstate['Status']
+            mask = 0
+            for key in airqstate:
+                mask |= FAULT_BITS.get(key,FAULT_OTHER)
+            result = (airqstate, mask)
+        except (KeyError,ValueError,IndexError,TypeError):
+            result = None
+        try:
+            self.status_cache[status] = result
+        except TypeError:
+            # not hashable
+            return result
+        while len(self.status_cache)>STATUS_CACHE_SIZE:
+            self.status_cache.popitem(last=False)
+        return result
+
+    def _check_state(self, reply):
+        """ get the sensor fault mask out of the reply and log changes """
+        self.last_ts = reply.get('timestamp')
+        status = reply.get('Status')
+        if status==self.status: return self.mask
+        parsed = self._parse_status(status)
+        if parsed is None: return 0
+        airqstate, mask = parsed
+        if airqstate!=self.state:
+            self.state = airqstate
+            if airqstate:
+                LOG_THROTTLE.log(self.name,'state changes',logerr,"thread '%s': state %s" % (self.name,airqstate))
+            else:
+                LOG_THROTTLE.log(self.name,'state changes',loginf,"thread '%s': state OK" % self.name)
+        if mask!=self.mask:
+            if self.status is not None: self.fault_count += 1
+            self.fault_since = self.last_ts if mask else None
+            self.mask = mask
+        self.status = status
+        return mask
+
+    def _add_state(self, sample):
+        """ add sensor faults and the number of spikes to the sample """
+        try:
+            fault_time = (self.last_ts-self.fault_since)/1000.0 if self.fault_since is not None else 0.0
+        except TypeError:
+            fault_time = None
+        state = [('fault_mask',self.mask),('fault_time',fault_time),('fault_count',self.fault_count)]
+        if self.filters:
+            state.append(('spike_count',self.spikes()))
+        for key, val in state:
+            if self.keys is None or key in self.keys:
+                sample.data[key] = val
+
+    def spikes(self):
+        """ total number of values rejected by the spike filters """
+        return sum([self.filters[key].rejected for key in self.filters])
+
+    @staticmethod
+    def _value(jj, reply, mask):
+        """ converted value of reading 'jj', None if invalid """
+        if mask & FAULT_BITS.get(jj,0):
+            # observation type is mentioned in status,
+            # that means the value is invalid
+            return None
+        try:
+            xx = AirqService.AIRQ_DATA.get(jj)
+            val = xx[3](reply[jj]) if xx is not None else reply[jj]
+            if jj not in AirqService.ACCUM_LAST:
+                if val<0.0: val = None
+        except (ValueError,TypeError,IndexError,KeyError) as e:
+            val = None
+        return val
+
+    def _add_batch(self, sample, replies):
+        """ add a lot of replies at once 
+        
+            The readings to average are put into an array of replies
+            times readings, with NaN for missing or invalid values.
+            Of the other readings only the last one is converted.
+        """
+        states = [self._check_state(reply) for reply in replies]
+        avg_keys = []
+        last_keys = []
+        for jj in set().union(*replies):
+            if self.keys is not None and jj not in self.keys: continue
+            try:
+                unit_group = AirqService.AIRQ_DATA.get(jj)[2] 
+            except (IndexError,TypeError):
+                unit_group = ""
+            if unit_group in AirqService.AVG_GROUPS:
+                avg_keys.append(jj)
+            else:
+                last_keys.append(jj)
+        if avg_keys:
+            arr = numpy.array([
+                [self._value(jj,reply,state) if jj in reply else None for jj in avg_keys]
+                for reply, state in zip(replies,states)],dtype=float)
+            # Like in _add_reply() zero does not count.
+            valid = numpy.isfinite(arr)&(arr!=0.0)
+            # The spike filters look at the values one by one.
+            for idx, jj in enumerate(avg_keys):
+                if jj in self.filters:
+                    check = self.filters[jj].check
+                    for row in numpy.nonzero(valid[:,idx])[0]:
+                        if not check(arr[row,idx]):
+                            valid[row,idx] = False
+            sums = numpy.where(valid,arr,0.0).sum(axis=0)
+            counts = valid.sum(axis=0)
+            for idx, jj in enumerate(avg_keys):
+                if counts[idx]:
+                    sample.sum[jj] = sample.sum.get(jj,0)+float(sums[idx])
+                    sample.count[jj] = sample.count.get(jj,0)+int(counts[idx])
+        for jj in last_keys:
+            for idx in range(len(replies)-1,-1,-1):
+                if jj in replies[idx]:
+                    sample.data[jj] = self._value(jj,replies[idx],states[idx])
+                    break
+
+    def _add_reply(self, sample, reply):
+        """ check the reply and add its values to the sample """
+        data = sample.data
+        avg_sum = sample.sum
+        avg_ct = sample.count
+        # check status
+        mask = self._check_state(reply)
+        # process values
+        for jj in reply:
+            if self.keys is not None and jj not in self.keys: continue
+            try:
+                unit_group = AirqService.AIRQ_DATA.get(jj)[2] 
+            except (IndexError,TypeError):
+                unit_group = ""
+            val = self._value(jj, reply, mask)
+            #logdbg("val %s - %s - %s" % (jj,reply[jj],val))
+            if unit_group in AirqService.AVG_GROUPS:
+                # if observation type is in AVG_GROUPS, then
+                # add values for calculating averages
+                if val and (jj not in self.filters or self.filters[jj].check(val)):
+                    avg_sum[jj] = avg_sum.get(jj,0)+val
+                    avg_ct[jj] = avg_ct.get(jj,0)+1
+            else:
+                # otherwise remember the last value of the
+                # loop period
+                data.update({jj:val})
+
+
+##############################################################################
+#   local broker: share the readings with other instances of WeeWX           #
+##############################################################################
+
+# default path of the Unix domain socket of the broker
+BROKER_SOCKET = '/tmp/weewx-airq.sock'
+
+# config data of the device that are needed by AirqService
+DEVICE_CONFIG_KEYS = ('id','air-Q-Software-Version','sensors','ppb&ppm','RoomType')
+
+def broker_frame(msg):
+    """ convert message to frame: 4 bytes length, then JSON """
+    payload = json.dumps(msg).encode('utf-8')
+    return struct.pack('>I',len(payload))+payload
+
+def _recv_exactly(sock, n):
+    """ receive n bytes, None if the connection was closed """
+    buf = bytearray()
+    while len(buf)<n:
+        chunk = sock.recv(n-len(buf))
+        if not chunk: return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+def broker_recv(sock):
+    """ receive one frame and convert it to a message """
+    header = _recv_exactly(sock,4)
+    if header is None: return None
+    payload = _recv_exactly(sock,struct.unpack('>I',header)[0])
+    if payload is None: return None
+    return json.loads(payload.decode('utf-8'))
+
+
+class AirqBroker(object):
+    """ poll the airQ devices and publish the aggregated readings to
+        the instances of WeeWX connected by Unix domain socket
+
+        All the readings of one publishing interval are sent in one
+        frame. A client that does not accept data within 
+        'broker_timeout' seconds is disconnected.
+    """
+
+    def __init__(self, config_dict, socket_path=None, interval=None):
+        conf = config_dict.get('airQ',{})
+        self.socket_path = socket_path if socket_path else conf.get('broker_socket',BROKER_SOCKET)
+        self.interval = weeutil.weeutil.to_float(interval if interval else conf.get('broker_interval',2.5))
+        self.timeout = weeutil.weeutil.to_float(conf.get('broker_timeout',2.0))
+        configure_log_throttle(conf)
+        if conf.get('shm_file'):
+            import user.airq_shm
+            self.shm = user.airq_shm.AirqShmWriter(conf['shm_file'], conf.sections)
+        else:
+            self.shm = None
+        if conf.get('config_cache'):
+            self.config_cache = AirqConfigCache(conf['config_cache'],
+                weeutil.weeutil.to_float(conf.get('config_cache_ttl',CONFIG_CACHE_TTL)))
+        else:
+            self.config_cache = None
+        self.devices = {}
+        self.clients = []
+        self.lock = threading.Lock()
+        self.running = True
+        for dev in conf.sections:
+            host = conf[dev].get('host')
+            passwd = conf[dev].get('password')
+            if not host or not passwd:
+                logerr("device '%s': host address or password missing" % dev)
+                continue
+            devconf = self._device_config(dev, host, passwd)
+            endpoint = conf[dev].get('endpoint',conf.get('endpoint','data'))
+            # The clients need the base readings of the derived values.
+            needed = AirqService.obs_selection(conf[dev],conf,True)[1]
+            q = queue.Queue()
+            self.devices[dev] = {
+                'queue': q,
+                'aggregator': AirqAggregator(dev, endpoint!='data', needed,
+                    spike=AirqService.spike_selection(conf[dev],conf)),
+                'config': {key:devconf[key] for key in DEVICE_CONFIG_KEYS if key in devconf},
+                'thread': AirqThread(q, dev, host, passwd, True, True, 
+                    weeutil.weeutil.to_float(conf[dev].get('query_interval',conf.get('query_interval',5.0))),
+                    endpoint=endpoint, shm=self.shm)}
+        loginf("broker: %s devices, socket '%s', interval %.1f s" % (len(self.devices),self.socket_path,self.interval))
+
+    def _device_config(self, dev, host, passwd):
+        """ config data out of the cache or the device, {} if not 
+            available, so that polling starts anyway """
+        if self.config_cache:
+            devconf, valid = self.config_cache.get(dev, host)
+            if valid: return devconf
+        else:
+            devconf = None
+        reply = AirqService._read_config(host, passwd)
+        if reply:
+            if self.config_cache: self.config_cache.put(dev, host, reply)
+            return reply
+        if devconf is not None:
+            logerr("device '%s': could not read config out of the device, using expired config data out of the cache" % dev)
+            return devconf
+        logerr("device '%s': could not read config out of the device" % dev)
+        return {}
+
+    def shutDown(self):
+        self.running = False
+
+    def run(self):
+        """ poll the devices and publish the readings """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
+        accept_thread = threading.Thread(target=self._accept, args=(server,))
+        accept_thread.daemon = True
+        accept_thread.start()
+        for dev in self.devices:
+            self.devices[dev]['thread'].start()
+        try:
+            next_ts = time.time()
+            while self.running:
+                next_ts += self.interval
+                time.sleep(max(next_ts-time.time(),0))
+                LOG_THROTTLE.flush()
+                samples = {}
+                for dev in self.devices:
+                    sample = self.devices[dev]['aggregator'].aggregate(self.devices[dev]['queue'])
+                    if sample.data or sample.sum:
+                        samples[dev] = sample.to_dict()
+                if samples:
+                    self._publish({'type':'data','samples':samples})
+        finally:
+            self.running = False
+            for dev in self.devices:
+                self.devices[dev]['thread'].shutDown()
+            server.close()
+            with self.lock:
+                for conn in self.clients:
+                    conn.close()
+                self.clients = []
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            loginf("broker: stopped")
+
+    def _accept(self, server):
+        """ accept new clients and send them the device config """
+        while self.running:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            conn.settimeout(self.timeout)
+            try:
+                conn.sendall(broker_frame({'type':'config','devices':
+                    {dev:self.devices[dev]['config'] for dev in self.devices}}))
+            except OSError as e:
+                logerr("broker: could not send config to new client: %s" % e)
+                conn.close()
+                continue
+            with self.lock:
+                self.clients.append(conn)
+            loginf("broker: client connected, %s clients" % len(self.clients))
+
+    def _publish(self, msg):
+        """ send message to all the clients """
+        frame = broker_frame(msg)
+        with self.lock:
+            for conn in list(self.clients):
+                try:
+                    conn.sendall(frame)
+                except OSError as e:
+                    logerr("broker: client disconnected: %s" % e)
+                    conn.close()
+                    self.clients.remove(conn)
+
+
+class AirqBrokerClient(threading.Thread):
+    """ receive the readings from the broker instead of polling the
+        devices """
+
+    def __init__(self, service, socket_path):
+        super(AirqBrokerClient,self).__init__(name='airQ-broker-client')
+        self.service = service
+        self.socket_path = socket_path
+        self.running = True
+        self.sock = None
+        self.evt = threading.Event()
+
+    def shutDown(self):
+        """ stop thread """
+        self.running = False
+        self.evt.set()
+        try:
+            if self.sock: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        loginf("broker client: starting, socket '%s'" % self.socket_path)
+        while self.running:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.socket_path)
+                loginf("broker client: connected")
+                while self.running:
+                    msg = broker_recv(self.sock)
+                    if msg is None: break
+                    if msg.get('type')=='config':
+                        for dev in msg.get('devices',{}):
+                            if dev in self.service.threads:
+                                self.service.set_device_config(dev, msg['devices'][dev])
+                    elif msg.get('type')=='data':
+                        for dev in msg.get('samples',{}):
+                            if dev in self.service.threads:
+                                self.service.threads[dev]['queue'].put(
+                                    AirqSample.from_dict(msg['samples'][dev]))
+            except (OSError,ValueError) as e:
+                if self.running:
+                    logerr("broker client: %s" % e)
+            finally:
+                self.sock.close()
+            # wait before reconnecting
+            if self.running:
+                self.evt.wait(10)
+        loginf("broker client: stopped")
+
+
+##############################################################################
+#   poll the devices in several processes                                    #
+##############################################################################
+
+def _shard_worker(shard, devices, out_q, stop_evt, interval, log_success, log_failure, log_throttle, shm_file):
+    """ poll the devices of one shard and send the aggregated readings
+        to the WeeWX process
+
+        Runs in a separate process. 'devices' is a list of tuples
+        (name, host, password, query interval, endpoint, airQ keys,
+        spike filters, adaptive interval bounds).
+    """
+    try:
+        weeutil.logger.setup('weewxd-airq-shard%s' % shard, {})
+    except (NameError,AttributeError):
+        pass
+    LOG_THROTTLE.configure(*log_throttle)
+    if shm_file:
+        import user.airq_shm
+        shm = user.airq_shm.AirqShmWriter(shm_file)
+    else:
+        shm = None
+    threads = {}
+    for name, host, passwd, query_interval, endpoint, keys, spike, adaptive in devices:
+        q = queue.Queue()
+        threads[name] = (q, AirqAggregator(name, endpoint!='data', keys, spike=spike),
+            AirqThread(q, name, host, passwd, log_success, log_failure, query_interval, endpoint=endpoint, shm=shm, adaptive=adaptive))
+        threads[name][2].start()
+    try:
+        while not stop_evt.wait(interval):
+            LOG_THROTTLE.flush()
+            samples = {}
+            for name in threads:
+                sample = threads[name][1].aggregate(threads[name][0])
+                if sample.data or sample.sum:
+                    samples[name] = sample
+            if samples:
+                out_q.put(samples)
+    except (KeyboardInterrupt,EOFError,OSError):
+        pass
+    finally:
+        for name in threads:
+            threads[name][2].shutDown()
+        for name in threads:
+            threads[name][2].join(10)
+
+
+class AirqShards(threading.Thread):
+    """ distribute the devices to several processes and receive
+        the aggregated readings from them """
+
+    def __init__(self, service, processes, interval):
+        super(AirqShards,self).__init__(name='airQ-shards')
+        import multiprocessing
+        # Threads are running within the WeeWX process, so do not fork.
+        self.ctx = multiprocessing.get_context('spawn')
+        self.service = service
+        self.out_q = self.ctx.Queue()
+        self.stop_evt = self.ctx.Event()
+        self.running = True
+        # distribute the devices round robin
+        shards = [[] for ii in range(processes)]
+        for idx, name in enumerate(service.threads):
+            shards[idx%processes].append((name,)+service.threads[name]['shard'])
+        self.processes = []
+        for shard, devices in enumerate(shards):
+            if not devices: continue
+            self.processes.append(self.ctx.Process(
+                target=_shard_worker,
+                name='airQ-shard%s' % shard,
+                args=(shard, devices, self.out_q, self.stop_evt, interval,
+                      service.log_success, service.log_failure,
+                      service.log_throttle, service.shm_file)))
+        loginf("polling %s devices in %s processes" % (len(service.threads),len(self.processes)))
+
+    def start(self):
+        for proc in self.processes:
+            proc.daemon = True
+            proc.start()
+        super(AirqShards,self).start()
+
+    def shutDown(self):
+        """ stop worker processes and thread """
+        self.running = False
+        self.stop_evt.set()
+        timeout = time.time()+10
+        for proc in self.processes:
+            proc.join(max(timeout-time.time(),0.1))
+            if proc.is_alive():
+                logerr("unable to shutdown process '%s'" % proc.name)
+                proc.terminate()
+
+    def run(self):
+        """ put the samples received into the queues of the devices """
+        while self.running:
+            try:
+                samples = self.out_q.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError,OSError) as e:
+                logerr("shards: %s" % e)
+                break
+            for name in samples:
+                if name in self.service.threads:
+                    self.service.threads[name]['queue'].put(samples[name])
+
+
+##############################################################################
+#   XType: short-window aggregates out of memory                             #
+##############################################################################
+
+class AirqRollingStats(weewx.xtypes.XType):
+    """ serve aggregates of airQ readings for short time spans out of
+        ring buffers in memory instead of the database
+
+        The ring buffers are fed with the LOOP packet readings by
+        AirqService.new_loop_packet(). If the requested time span is not
+        completely covered by the buffer, UnknownAggregation is raised,
+        so that WeeWX asks the next XType, which is the database.
+    """
+
+    # aggregation types that can be calculated out of the ring buffer
+    AGGREGATES = ('min','max','avg','sum','count','not_null',
+                  'first','last','mintime','maxtime','firsttime','lasttime')
+
+    def __init__(self, window):
+        # time span in seconds to keep readings for
+        self.window = window
+        # unit system of the readings in the buffers
+        self.usUnits = None
+        # timestamp of the last packet
+        self.last_ts = None
+        # obs_type: [timestamp of the first reading, deque of (ts,val)]
+        self.buffers = {}
+        # get_aggregate() is called from the report thread
+        self.lock = threading.Lock()
+
+    def add_obs_type(self, obs_type):
+        """ register observation type to buffer """
+        with self.lock:
+            if obs_type not in self.buffers:
+                self.buffers[obs_type] = [None,collections.deque()]
+
+    def add_packet(self, ts, data, usUnits):
+        """ add readings to the buffers
+        
+            'data' are the readings of one device. Only the buffers of 
+            those readings are touched, the others are pruned when they
+            get the next reading or are read.
+        """
+        if ts is None: return
+        with self.lock:
+            if usUnits!=self.usUnits:
+                # unit system changed, the buffered readings are useless
+                for obs_type in self.buffers:
+                    self.buffers[obs_type] = [None,collections.deque()]
+                self.usUnits = usUnits
+            if self.last_ts is None or ts>self.last_ts: self.last_ts = ts
+            old_ts = ts-self.window
+            for obs_type, val in data.items():
+                buf = self.buffers.get(obs_type)
+                if buf is None or val is None: continue
+                # the buffer covers the time from its first reading on
+                if buf[0] is None: buf[0] = ts
+                buf[1].append((ts,val))
+                self._prune(buf, old_ts)
+
+    @staticmethod
+    def _prune(buf, old_ts):
+        """ remove the readings that are out of the window """
+        while buf[1] and buf[1][0][0]<=old_ts:
+            buf[1].popleft()
+
+    def get_aggregate(self, obs_type, timespan, aggregate_type, db_manager, **option_dict):
+        """ calculate aggregate out of the ring buffer """
+        if obs_type not in self.buffers:
+            raise weewx.UnknownType(obs_type)
+        if aggregate_type not in self.AGGREGATES:
+            raise weewx.UnknownAggregation(aggregate_type)
+        with self.lock:
+            if self.last_ts is not None:
+                self._prune(self.buffers[obs_type], self.last_ts-self.window)
+            start_ts = self.buffers[obs_type][0]
+            # The buffer must cover the whole time span, otherwise the
+            # database has to be used.
+            if (start_ts is None or timespan.start<start_ts or
+                timespan.start<self.last_ts-self.window):
+                raise weewx.UnknownAggregation(aggregate_type)
+            vals = [ii for ii in self.buffers[obs_type][1]
+                     if timespan.start<ii[0]<=timespan.stop]
+            usUnits = self.usUnits
+        val = None
+        if aggregate_type=='count':
+            val = len(vals)
+        elif aggregate_type=='not_null':
+            val = len(vals)>0
+        elif vals:
+            if aggregate_type=='min':
+                val = min(vals,key=lambda x:x[1])[1]
+            elif aggregate_type=='max':
+                val = max(vals,key=lambda x:x[1])[1]
+            elif aggregate_type=='mintime':
+                val = min(vals,key=lambda x:x[1])[0]
+            elif aggregate_type=='maxtime':
+                val = max(vals,key=lambda x:x[1])[0]
+            elif aggregate_type=='sum':
+                val = sum([ii[1] for ii in vals])
+            elif aggregate_type=='avg':
+                val = sum([ii[1] for ii in vals])/len(vals)
+            elif aggregate_type=='first':
+                val = vals[0][1]
+            elif aggregate_type=='last':
+                val = vals[-1][1]
+            elif aggregate_type=='firsttime':
+                val = vals[0][0]
+            elif aggregate_type=='lasttime':
+                val = vals[-1][0]
+        u, g = weewx.units.getStandardUnitType(usUnits, obs_type, aggregate_type)
+        vt = weewx.units.ValueTuple(val, u, g)
+        # return the result in the unit system of the database
+        std_unit_system = getattr(db_manager,'std_unit_system',None)
+        if std_unit_system is not None and std_unit_system!=usUnits:
+            vt = weewx.units.convertStd(vt, std_unit_system)
+        return vt
+
+
+##############################################################################
+#   XType: derived observation types calculated on request                   #
+##############################################################################
+
+class AirqDerived(weewx.xtypes.XType):
+    """ calculate altimeter, barometer, and the volume or mass variant
+        of CO, NO2, O3, and SO2 on request out of the base readings
+        within the record
+
+        Used if option 'derived_obs' is set to 'lazy'. The results are
+        remembered per record, as the same value is often requested
+        several times during a report run.
+    """
+
+    def __init__(self, service, cache_size=2048):
+        self.service = service
+        # WeeWX observation type: (thread name, airQ key)
+        self.obs_types = {}
+        # memoized results
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def add_device(self, thread_name, prefix, ppbppm, emit=None):
+        """ register the derived observation types of a device """
+        self.remove_device(thread_name)
+        for key in AirqService.derived_keys(ppbppm):
+            if emit is not None and key not in emit: continue
+            obs_type = AirqService.obstype_with_prefix(AirqService.AIRQ_DATA[key][0],prefix)
+            self.obs_types[obs_type] = (thread_name,key)
+
+    def remove_device(self, thread_name):
+        """ unregister the derived observation types of a device """
+        for obs_type in [ii for ii in self.obs_types if self.obs_types[ii][0]==thread_name]:
+            del self.obs_types[obs_type]
+        with self.lock:
+            self.cache.clear()
+
+    def get_scalar(self, obs_type, record, db_manager=None, **option_dict):
+        """ calculate derived value out of the record """
+        if obs_type not in self.obs_types:
+            raise weewx.UnknownType(obs_type)
+        if record is None:
+            raise weewx.CannotCalculate(obs_type)
+        # LOOP packets and archive records can have the same timestamp
+        memo = (obs_type,record.get('dateTime'),record.get('usUnits'),'interval' in record)
+        with self.lock:
+            if memo in self.cache:
+                self.cache.move_to_end(memo)
+                return self.cache[memo]
+        thread_name, key = self.obs_types[obs_type]
+        _obs_conf = AirqService.AIRQ_DATA[key]
+        val = self.service.calc_derived(thread_name, key, record)
+        vt = weewx.units.convertStd(
+            weewx.units.ValueTuple(val, _obs_conf[1], _obs_conf[2]),
+            record['usUnits'])
+        with self.lock:
+            self.cache[memo] = vt
+            while len(self.cache)>self.cache_size:
+                self.cache.popitem(last=False)
+        return vt
+
+
+##############################################################################
+#   XType: rollup store for long-range graphs                                #
+##############################################################################
+
+class AirqRollup(weewx.xtypes.XType):
+    """ min, max, sum, and count of the airQ readings per minute, 
+        hour, and day in a database of its own 
         
+        The tiers are updated by each new archive record. Series of 
+        plots with the option 'airq_rollup = true' are read out of the
+        coarsest tier that fits the aggregation interval.
+
+        Updates use one connection that is kept open until close().
+        Series are read by the report thread, so they open a 
+        connection of their own.
+    """
+
+    # width of the tier in seconds, table name suffix
+    TIERS = ((60,'1m'),(3600,'1h'),(86400,'1d'))
+
+    AGGREGATES = ('min','max','avg','sum','count')
+
+    def __init__(self, config_dict, binding, obs_types, keep_days=14):
+        manager_dict = weewx.manager.get_manager_dict_from_config(config_dict, binding)
+        self.database_dict = manager_dict['database_dict']
+        self.table_name = manager_dict.get('table_name','airq_rollup')
+        self.obs_types = set(obs_types)
+        # days to keep the 1-minute tier
+        self.keep_days = keep_days
+        self.last_prune = 0
+        self.conn = None
+        self._create_tables(self.connection())
+
+    @staticmethod
+    def obs_types_from_config(config_dict):
+        """ numeric observation types of all the devices """
+        obs_types = []
+        for device in config_dict.get('airQ',{}).sections:
+            prefix = config_dict['airQ'][device].get('prefix')
+            emit = AirqService.obs_selection(config_dict['airQ'][device],config_dict['airQ'])[0]
+            for key in AirqService.AIRQ_DATA:
+                if emit is not None and key not in emit: continue
+                obs_conf = AirqService.AIRQ_DATA[key]
+                if obs_conf and obs_conf[2] is not None and key not in AirqService.ACCUM_LAST:
+                    obs_types.append(AirqService.obstype_with_prefix(obs_conf[0],prefix))
+        return obs_types
+
+    def connect(self):
+        """ open the database, create it if it does not exist """
+        try:
+            return weedb.connect(self.database_dict)
+        except weedb.NoDatabaseError:
+            weedb.create(self.database_dict)
+            return weedb.connect(self.database_dict)
+
+    def connection(self):
+        """ the connection used for updates, opened on first use """
+        if self.conn is None:
+            self.conn = self.connect()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except weedb.DatabaseError:
+                pass
+            self.conn = None
+
+    def _create_tables(self, conn):
+        tables = conn.tables()
+        for width, suffix in self.TIERS:
+            table = '%s_%s' % (self.table_name,suffix)
+            if table not in tables:
+                conn.execute("CREATE TABLE %s (dateTime INTEGER NOT NULL, obs_type VARCHAR(64) NOT NULL, usUnits INTEGER NOT NULL, min REAL, max REAL, sum REAL, count INTEGER, PRIMARY KEY (dateTime, obs_type))" % table)
+                loginf("rollup: created table '%s'" % table)
+
+    def drop_tables(self):
+        """ remove all the tiers, used before rebuilding them """
+        conn = self.connection()
+        tables = conn.tables()
+        for width, suffix in self.TIERS:
+            table = '%s_%s' % (self.table_name,suffix)
+            if table in tables:
+                conn.execute("DROP TABLE %s" % table)
+        self._create_tables(conn)
+
+    @staticmethod
+    def start_of_bucket(ts, width):
+        """ start of the bucket of width 'width' the record 'ts' belongs to """
+        if width==86400:
+            # local days like the daily summaries of WeeWX
+            return weeutil.weeutil.archiveDaySpan(ts)[0]
+        return weeutil.weeutil.startOfInterval(ts, width)
+
+    def add_records(self, records):
+        """ aggregate the records in memory and merge the result
+            into the tiers """
+        buckets = {}
+        for record in records:
+            ts = record.get('dateTime')
+            usUnits = record.get('usUnits')
+            if ts is None: continue
+            for obs_type in self.obs_types:
+                val = record.get(obs_type)
+                if not isinstance(val,(int,float)): continue
+                for width, suffix in self.TIERS:
+                    key = (suffix,self.start_of_bucket(ts,width),obs_type)
+                    agg = buckets.get(key)
+                    if agg is None:
+                        buckets[key] = [usUnits,val,val,val,1]
+                    else:
+                        if val<agg[1]: agg[1] = val
+                        if val>agg[2]: agg[2] = val
+                        agg[3] += val
+                        agg[4] += 1
+        if not buckets: return 0
+        try:
+            with weedb.Transaction(self.connection()) as cursor:
+                for key in buckets:
+                    table = '%s_%s' % (self.table_name,key[0])
+                    usUnits, vmin, vmax, vsum, vct = buckets[key]
+                    cursor.execute("SELECT usUnits, min, max, sum, count FROM %s WHERE dateTime=? AND obs_type=?" % table, key[1:])
+                    row = cursor.fetchone()
+                    if row is None:
+                        cursor.execute("INSERT INTO %s (dateTime, obs_type, usUnits, min, max, sum, count) VALUES (?,?,?,?,?,?,?)" % table, key[1:]+(usUnits,vmin,vmax,vsum,vct))
+                    elif row[0]!=usUnits:
+                        logerr("rollup: unit system changed for '%s' at %s" % (key[2],key[1]))
+                    else:
+                        cursor.execute("UPDATE %s SET min=?, max=?, sum=?, count=? WHERE dateTime=? AND obs_type=?" % table, (min(row[1],vmin),max(row[2],vmax),row[3]+vsum,row[4]+vct)+key[1:])
+        except weedb.DatabaseError:
+            # open a new connection next time, e.g. after the database
+            # server was restarted
+            self.close()
+            raise
+        return len(buckets)
+
+    def prune(self, ts):
+        """ remove old entries from the 1-minute tier """
+        if not self.keep_days or ts<self.last_prune+3600: return
+        self.last_prune = ts
+        try:
+            with weedb.Transaction(self.connection()) as cursor:
+                cursor.execute("DELETE FROM %s_1m WHERE dateTime<?" % self.table_name, (ts-self.keep_days*86400,))
+        except weedb.DatabaseError:
+            self.close()
+            raise
+
+    def get_series(self, obs_type, timespan, db_manager, aggregate_type=None, aggregate_interval=None, **option_dict):
+        """ get a series out of the coarsest tier that fits """
+        if obs_type not in self.obs_types:
+            raise weewx.UnknownType(obs_type)
+        if not weeutil.weeutil.to_bool(option_dict.get('airq_rollup',False)):
+            raise weewx.UnknownAggregation(aggregate_type)
+        if not aggregate_type or aggregate_type.lower() not in self.AGGREGATES:
+            raise weewx.UnknownAggregation(aggregate_type)
+        aggregate_type = aggregate_type.lower()
+        aggregate_interval = weeutil.weeutil.nominal_spans(aggregate_interval)
+        if not aggregate_interval:
+            raise weewx.UnknownAggregation(aggregate_type)
+        suffix = None
+        for width, tier in self.TIERS:
+            if aggregate_interval%width==0: suffix = tier
+        if suffix is None:
+            raise weewx.UnknownAggregation(aggregate_type)
+        intervals = list(weeutil.weeutil.intervalgen(timespan.start, timespan.stop, aggregate_interval))
+        if not intervals:
+            raise weewx.UnknownAggregation(aggregate_type)
+        # min, max, sum, count per interval
+        aggs = [None]*len(intervals)
+        usUnits = None
+        idx = 0
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT dateTime, usUnits, min, max, sum, count FROM %s_%s WHERE obs_type=? AND dateTime>=? AND dateTime<? ORDER BY dateTime" % (self.table_name,suffix),(obs_type,intervals[0].start,intervals[-1].stop))
+            for row in cursor:
+                while idx<len(intervals) and row[0]>=intervals[idx].stop:
+                    idx += 1
+                if idx>=len(intervals): break
+                if row[0]<intervals[idx].start: continue
+                if usUnits is None: usUnits = row[1]
+                agg = aggs[idx]
+                if agg is None:
+                    aggs[idx] = list(row[2:])
+                else:
+                    agg[0] = min(agg[0],row[2])
+                    agg[1] = max(agg[1],row[3])
+                    agg[2] += row[4]
+                    agg[3] += row[5]
+            cursor.close()
+        data = []
+        for agg in aggs:
+            if agg is None:
+                data.append(0 if aggregate_type=='count' else None)
+            elif aggregate_type=='min':
+                data.append(agg[0])
+            elif aggregate_type=='max':
+                data.append(agg[1])
+            elif aggregate_type=='sum':
+                data.append(agg[2])
+            elif aggregate_type=='count':
+                data.append(agg[3])
+            else:
+                data.append(agg[2]/agg[3] if agg[3] else None)
+        if usUnits is None: usUnits = db_manager.std_unit_system
+        unit, unit_group = weewx.units.getStandardUnitType(usUnits, obs_type, aggregate_type)
+        return (weewx.units.ValueTuple([ii.start for ii in intervals],'unix_epoch','group_time'),
+                weewx.units.ValueTuple([ii.stop for ii in intervals],'unix_epoch','group_time'),
+                weewx.units.ValueTuple(data,unit,unit_group))
+
+
+##############################################################################
+#   snapshot of the current readings for dashboards                          #
+##############################################################################
+
+class AirqSnapshot(object):
+    """ write the latest readings of all the devices to a JSON file
+
+        The file is written to a temporary file first and then renamed,
+        so readers never see a partly written file. It is written at 
+        most every 'interval' seconds and only if something changed.
+    """
+
+    def __init__(self, path, interval=5.0, unit_system=None):
+        self.path = path
+        self.interval = interval
+        self.unit_system = unit_system
+        self.devices = {}
+        self.units = {}
+        self.usUnits = unit_system
+        self.last_write = 0
+        self.last_json = None
+        self.errors = 0
+        loginf("snapshot file '%s' interval %.1f s" % (path,interval))
+
+    def update(self, name, prefix, state, data, usUnits, ts):
+        """ merge the readings of one LOOP packet of a device """
+        if self.unit_system is None: self.usUnits = usUnits
+        dev = self.devices.setdefault(name,{'prefix':prefix,'dateTime':None,'status':None,'values':{}})
+        values = dict(dev['values'])
+        for key in data:
+            val = data[key]
+            unit = None
+            if isinstance(val,(int,float)) and usUnits is not None:
+                unit, group = weewx.units.getStandardUnitType(usUnits,key)
+                if unit and self.unit_system is not None:
+                    val, unit, group = weewx.units.convertStd(
+                        weewx.units.ValueTuple(val,unit,group),self.unit_system)
+                if unit and unit not in self.units:
+                    self.units[unit] = {
+                        'label':weewx.units.default_unit_label_dict.get(unit,''),
+                        'format':weewx.units.default_unit_format_dict.get(unit,'%f')}
+                if isinstance(val,float): val = round(val,3)
+            values[key] = [val,unit]
+        if values!=dev['values']:
+            dev['values'] = values
+            dev['dateTime'] = ts
+        # state of the sensors, 'init' if no reply was checked in this
+        # process, e.g. if the readings come from the broker
+        if 'init' not in state:
+            dev['status'] = state if state else 'OK'
+        else:
+            dev['status'] = values.get(AirqService.obstype_with_prefix('airqStatus',prefix),[None])[0]
+
+    def write(self, ts):
+        """ write the file if the interval is over and something changed """
+        if ts is None or ts<self.last_write+self.interval: return
+        __stats = LOG_THROTTLE.stats()
+        x = json.dumps({
+            'units':self.units,
+            'devices':self.devices,
+            'messages':{'logged':__stats['logged'],'suppressed':__stats['suppressed']}},
+            sort_keys=True,separators=(',',':'))
+        if x==self.last_json: return
+        tmp = self.path+'.tmp'
+        try:
+            with open(tmp,'w') as file:
+                file.write('{"dateTime":%s,"usUnits":%s,%s' % (int(ts),json.dumps(self.usUnits),x[1:]))
+            os.rename(tmp,self.path)
+            self.last_json = x
+            self.last_write = ts
+        except (OSError,IOError) as e:
+            self.errors += 1
+            LOG_THROTTLE.log(self.path,'write errors',logerr,"snapshot file '%s': %s" % (self.path,e),owner='snapshot file')
+
+
+##############################################################################
+#   profiling the service                                                    #
+##############################################################################
+
+# number of lines of the text reports
+PROFILE_LINES = 40
+# number of frames of the tracebacks recorded by tracemalloc
+PROFILE_FRAMES = 5
+# Python 3.12 and later allow one active profiler at a time only, so
+# the threads are not profiled together with the LOOP there.
+PROFILE_THREADS = sys.version_info<(3,12)
+
+class AirqProfiler(object):
+    """ profile the service on request
+    
+        A run is started by creating the file 'start' within the 
+        directory 'path'. Then 'new_loop_packet' and the polling 
+        threads are profiled by cProfile for 'packets' LOOP packets,
+        and the memory allocations are compared over 'minutes' 
+        minutes by tracemalloc. The results are written to that 
+        directory with the starting time in the file names.
+    """
+
+    def __init__(self, path, packets=100, minutes=0):
+        self.path = path
+        self.packets = packets
+        self.minutes = minutes
+        # LOOP profiling
+        self.loop = None
+        self.threads = {}
+        self.count = 0
+        self.loop_name = None
+        # memory profiling
+        self.memory = None
+        self.memory_end = 0
+        self.memory_name = None
+        self.memory_started = False
+        loginf("profiling: create '%s' to start, %s LOOP packets, %s minutes memory" % (self.trigger(),packets,minutes))
+
+    def trigger(self):
+        return os.path.join(self.path,'start')
+
+    def _name(self, what):
+        return os.path.join(self.path,'airq-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'),what))
+
+    def check(self, service):
+        """ start a run if requested, called before each LOOP packet
+
+            Returns True if 'new_loop_packet' is to be profiled.
+        """
+        if not self.loop and not self.memory and os.path.exists(self.trigger()):
+            try:
+                os.unlink(self.trigger())
+            except OSError as e:
+                logerr("profiling: %s" % e)
+                return False
+            if self.packets>0:
+                self.loop = cProfile.Profile()
+                self.count = 0
+                self.loop_name = self._name('loop')
+                # Each thread enables its own profiler while polling.
+                for ii in service.threads:
+                    if PROFILE_THREADS and service.threads[ii]['thread']:
+                        self.threads[ii] = cProfile.Profile()
+                        service.threads[ii]['thread'].profile = self.threads[ii]
+                loginf("profiling: started for %s LOOP packets and %s threads" % (self.packets,len(self.threads)))
+            if self.minutes>0:
+                self.memory_started = not tracemalloc.is_tracing()
+                if self.memory_started: tracemalloc.start(PROFILE_FRAMES)
+                self.memory = (self._queues(service),self._snapshot())
+                self.memory_end = time.time()+self.minutes*60
+                self.memory_name = self._name('memory')
+                loginf("profiling: memory allocations for %s minutes" % self.minutes)
+        if self.memory and time.time()>=self.memory_end:
+            self._write_memory(service)
+        if self.loop:
+            try:
+                self.loop.enable()
+            except ValueError as e:
+                # another profiler is active
+                logerr("profiling: LOOP profiling not possible: %s" % e)
+                self._stop_threads(service)
+                self.loop = None
+                self.threads = {}
+                return False
+            return True
+        return False
+
+    def _stop_threads(self, service):
+        for ii in self.threads:
+            if ii in service.threads and service.threads[ii]['thread']:
+                service.threads[ii]['thread'].profile = None
+
+    def done(self, service):
+        """ end profiling a LOOP packet, called after each LOOP packet """
+        self.loop.disable()
+        self.count += 1
+        if self.count<self.packets: return
+        self._stop_threads(service)
+        self._write_stats(self.loop_name, [self.loop], 'LOOP packets: %s' % self.count)
+        threads = [self.threads[ii] for ii in self.threads]
+        if threads:
+            self._write_stats(self.loop_name.replace('-loop','-threads'), threads, 'threads: %s' % ', '.join(self.threads))
+        loginf("profiling: results written to '%s.*'" % self.loop_name)
+        self.loop = None
+        self.threads = {}
+
+    def _write_stats(self, name, profiles, title):
+        """ write binary pstats file and text report """
+        stats = None
+        for prof in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(prof)
+                else:
+                    stats.add(prof)
+            except TypeError:
+                # no data collected
+                pass
+        if stats is None: return
+        try:
+            stats.dump_stats(name+'.pstats')
+            with open(name+'.txt','w') as file:
+                file.write(title+'\n')
+                stats.stream = file
+                stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+                stats.sort_stats('tottime').print_stats(PROFILE_LINES)
+        except (OSError,IOError) as e:
+            logerr("profiling: could not write '%s': %s" % (name,e))
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False,tracemalloc.__file__),))
+
+    @staticmethod
+    def _queues(service):
+        """ sizes of the queues of the devices """
+        return {ii:service.threads[ii]['queue'].qsize() for ii in service.threads}
+
+    def _write_memory(self, service):
+        """ compare the allocations to those at the start of the run """
+        queues, snapshot = self.memory
+        diff = self._snapshot().compare_to(snapshot,'traceback')
+        if self.memory_started: tracemalloc.stop()
+        self.memory = None
+        now = self._queues(service)
+        try:
+            with open(self.memory_name+'.txt','w') as file:
+                file.write('%s minutes\n\nqueue sizes at start and end:\n' % self.minutes)
+                for ii in sorted(set(queues)|set(now)):
+                    file.write('    %s: %s -> %s\n' % (ii,queues.get(ii),now.get(ii)))
+                file.write('\ntotal growth: %s bytes\n' % sum(stat.size_diff for stat in diff))
+                file.write('\ngrowth by traceback:\n')
+                for stat in diff[:PROFILE_LINES]:
+                    file.write('\n%s\n' % stat)
+                    for line in stat.traceback.format():
+                        file.write('    %s\n' % line)
+            loginf("profiling: memory report written to '%s.txt'" % self.memory_name)
+        except (OSError,IOError) as e:
+            logerr("profiling: could not write '%s': %s" % (self.memory_name,e))
+
 
 ##############################################################################
 #   data_services: augment LOOP packet with airQ readings                    #
@@ -326,7 +2186,12 @@ class AirqService(StdService):
         'cnt10':       ('cnt10_0',         'count', 'group_count', lambda x:int(x[0])),
         'TypPS':       ('TypPS',           None, None, lambda x:x),
         'bat':         ('airqBattery',     None, None, lambda x:x),
-        'door_event':  ('airqDoorEvent',   None, None, lambda x:int(x))
+        'door_event':  ('airqDoorEvent',   None, None, lambda x:int(x)),
+        # calculated out of 'Status' by AirqAggregator
+        'fault_mask':  ('airqFaultMask',   None, None, lambda x:int(x)),
+        'fault_time':  ('airqFaultTime',   'second', 'group_deltatime', lambda x:float(x)),
+        'fault_count': ('airqFaultCount',  'count', 'group_count', lambda x:int(x)),
+        'spike_count': ('airqSpikeCount',  'count', 'group_count', lambda x:int(x))
         }
         
     # which readings are to accumulate calculating average
@@ -339,7 +2204,30 @@ class AirqService(StdService):
     ACCUM_LAST = [
         'DeviceID',
         'Status',
-        'bat']
+        'bat',
+        'fault_mask']
+    
+    # numeric readings of which the archive record gets the last value
+    EXTRACT_LAST = [
+        'fault_time',
+        'fault_count',
+        'spike_count']
+    
+    # readings that do not change often, not to be sent in every LOOP
+    # packet with option 'loop_static = changed'
+    LOOP_STATIC = ACCUM_LAST+['TypPS']
+
+    # general options of section [airQ] that apply to the devices
+    # and therefore take effect on reload
+    RELOAD_OPTIONS = [
+        'query_interval','endpoint','loop_static','loop_static_every',
+        'include','exclude','spike_filter','spike_window',
+        'spike_threshold','spike_min_deviation','reload_interval',
+        'profile_packets','profile_minutes','adaptive_interval',
+        'query_interval_min','query_interval_max']
+    
+    # device parameters that can be changed while the thread is running
+    RELOAD_IN_PLACE = ['address','passwd','query_interval']
     
     # conversion volume to mass according to Dr. Daniel Lehmann of Corant
     # valid up to firmware version 1.74 only
@@ -365,105 +2253,422 @@ class AirqService(StdService):
         if self.debug>0:
             self.log_success = True
             self.log_failure = True
+        # rate-limited logging of repeated failures and state changes
+        self.log_throttle = configure_log_throttle(config_dict.get('airQ',{}))
+        loginf("repeated messages: %s per %.0f s" % (self.log_throttle[1],self.log_throttle[0]))
         # conversion between volume and mass
         self.volume_mass_method = weeutil.weeutil.to_int(config_dict.get('airQ',{}).get('volume_mass_method',1))
         loginf("volume_mass_method %s" % self.volume_mass_method)
+        # short-window aggregates out of memory
+        __window = weeutil.weeutil.to_int(config_dict.get('airQ',{}).get('rolling_window',0))
+        if __window>0:
+            self.rolling_stats = AirqRollingStats(min(__window,86400))
+            weewx.xtypes.xtypes.insert(0,self.rolling_stats)
+            loginf("rolling statistics window %s s" % self.rolling_stats.window)
+        else:
+            self.rolling_stats = None
+        # derived observation types within the LOOP packet or on request
+        self.derived_obs = config_dict.get('airQ',{}).get('derived_obs','loop').lower()
+        if self.derived_obs=='lazy':
+            self.derived = AirqDerived(self)
+            weewx.xtypes.xtypes.append(self.derived)
+        else:
+            self.derived = None
+        loginf("derived observation types: %s" % self.derived_obs)
+        # poll the devices or receive the readings from the broker
+        self.source = config_dict.get('airQ',{}).get('source','device').lower()
+        loginf("source of readings: %s" % self.source)
+        # number of processes to poll the devices, 0 means threads only
+        if self.source=='device':
+            self.processes = weeutil.weeutil.to_int(config_dict.get('airQ',{}).get('processes',0))
+        else:
+            self.processes = 0
+        # clock to use for timeouts, replaced when replaying recorded data
+        self.clock = SYSTEM_CLOCK
+        # config data of the devices saved to disk
+        __config_cache = config_dict.get('airQ',{}).get('config_cache')
+        if __config_cache and self.source=='device':
+            self.config_cache = AirqConfigCache(__config_cache,
+                weeutil.weeutil.to_float(config_dict['airQ'].get('config_cache_ttl',CONFIG_CACHE_TTL)))
+            loginf("config cache '%s' valid for %.0f s" % (__config_cache,self.config_cache.ttl))
+        else:
+            self.config_cache = None
+        # record the replies of the devices
+        __record_file = config_dict.get('airQ',{}).get('record_file')
+        if __record_file and self.source=='device' and not self.processes:
+            self.recorder = AirqRecorder(__record_file)
+        else:
+            self.recorder = None
+        # shared memory table of the latest readings for local consumers
+        self.shm_file = config_dict.get('airQ',{}).get('shm_file')
+        if self.shm_file and self.source=='device' and 'airQ' in config_dict:
+            import user.airq_shm
+            try:
+                self.shm = user.airq_shm.AirqShmWriter(self.shm_file, config_dict['airQ'].sections)
+                loginf("shared memory file '%s'" % self.shm_file)
+            except ValueError as e:
+                logerr("shared memory file '%s': %s" % (self.shm_file,e))
+                self.shm_file = None
+                self.shm = None
+        else:
+            self.shm_file = None
+            self.shm = None
+        # snapshot of the current readings for dashboards
+        __snapshot_file = config_dict.get('airQ',{}).get('snapshot_file')
+        if __snapshot_file:
+            __unit_system = config_dict.get('airQ',{}).get('snapshot_unit_system')
+            if __unit_system and __unit_system.upper() not in weewx.units.unit_constants:
+                logerr("snapshot: unknown unit system '%s', using the unit system of the LOOP packet" % __unit_system)
+                __unit_system = None
+            self.snapshot = AirqSnapshot(__snapshot_file,
+                weeutil.weeutil.to_float(config_dict.get('airQ',{}).get('snapshot_interval',5.0)),
+                weewx.units.unit_constants[__unit_system.upper()] if __unit_system else None)
+        else:
+            self.snapshot = None
+        # profiling on request
+        __profile_dir = config_dict.get('airQ',{}).get('profile_dir')
+        if __profile_dir:
+            self.profiler = AirqProfiler(__profile_dir,
+                weeutil.weeutil.to_int(config_dict['airQ'].get('profile_packets',100)),
+                weeutil.weeutil.to_float(config_dict['airQ'].get('profile_minutes',0)))
+        else:
+            self.profiler = None
+        # rollup store for long-range graphs
+        __rollup_binding = config_dict.get('airQ',{}).get('rollup_binding')
+        if __rollup_binding:
+            self.rollup = AirqRollup(config_dict, __rollup_binding,
+                AirqRollup.obs_types_from_config(config_dict),
+                weeutil.weeutil.to_float(config_dict['airQ'].get('rollup_keep_days',14)))
+            weewx.xtypes.xtypes.insert(0,self.rollup)
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+            loginf("rollup store binding '%s'" % __rollup_binding)
+        else:
+            self.rollup = None
+        # number of waiting replies from which on NumPy is used
+        self.batch_threshold = weeutil.weeutil.to_int(config_dict.get('airQ',{}).get('batch_threshold',BATCH_THRESHOLD))
+        if numpy is None and self.batch_threshold:
+            loginf("NumPy not available, replies are processed one by one")
+        # archive interval, static readings are sent at its beginning
+        self.archive_interval = weeutil.weeutil.to_int(config_dict.get('StdArchive',{}).get('archive_interval',300))
+        # reload the device sections if weewx.conf changed
+        self.reload_interval = weeutil.weeutil.to_float(config_dict.get('airQ',{}).get('reload_interval',0))
+        self.config_path = config_dict.get('config_path')
+        self.reload_next = 0
+        try:
+            self.config_mtime = os.stat(self.config_path).st_mtime if self.config_path else None
+        except OSError:
+            self.config_mtime = None
+        self.airq_options = {key:config_dict['airQ'][key] for key in config_dict['airQ'].scalars} if 'airQ' in config_dict else {}
+        self.shm_retired = []
+        # time of the last LOOP packet
+        self.last_loop = None
+        # accumulator settings added to weewx.accum.accum_dict per device
+        self.accum_maps = {}
+        # read the config data of new devices in background, set when
+        # devices are added while running
+        self.config_background = False
+        if self.reload_interval:
+            if self.source=='device' and not self.processes and self.config_path:
+                loginf("reload of the device sections: checking '%s' every %.0f s" % (self.config_path,self.reload_interval))
+            else:
+                logerr("reload of the device sections not possible with this configuration")
+                self.reload_interval = 0
         # dict of devices and threads
         self.threads={}
         # devices
         ct = 0
         if 'airQ' in config_dict:
             for device in config_dict['airQ'].sections:
-                # altitude to calculate altimeter value 
-                if 'altitude' in config_dict['airQ'][device]:
-                    __altitude = config_dict['airQ'][device]['altitude']
-                    if len(__altitude)==3:
-                        __altitude = weewx.units.ValueTuple(weeutil.weeutil.to_float(__altitude[0]),__altitude[1],__altitude[2])
-                    else:
-                        __altitude = weewx.units.ValueTuple(weeutil.weeutil.to_float(__altitude[0]),__altitude[1],'group_altitude')
-                else:
-                    __altitude = engine.stn_info.altitude_vt
-                __altitude = weewx.units.convert(__altitude,'meter')[0]
                 # create thread
-                if self._create_thread(device,
-                    config_dict['airQ'][device].get('host'),
-                    config_dict['airQ'][device].get('password'),
-                    config_dict['airQ'][device].get('prefix'),
-                    __altitude,
-                    weeutil.weeutil.to_float(config_dict['airQ'][device].get('query_interval',config_dict['airQ'].get('query_interval',5.0)))):
+                __params = self._device_params(config_dict['airQ'], device)
+                if self._create_thread(device, **__params):
+                    self.threads[device]['params'] = __params
                     ct+=1
-            if ct>0:
+            if ct>0 or self.reload_interval:
                 self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
+            # connect to the broker
+            if ct>0 and self.source=='broker':
+                self.broker_client = AirqBrokerClient(self, config_dict['airQ'].get('broker_socket',BROKER_SOCKET))
+                self.broker_client.start()
+            else:
+                self.broker_client = None
+            # start the worker processes
+            if ct>0 and self.processes:
+                self.shards = AirqShards(self, self.processes, 
+                    weeutil.weeutil.to_float(config_dict['airQ'].get('process_interval',1.0)))
+                self.shards.start()
+            else:
+                self.shards = None
         if ct==1:
             loginf("1 air-Q device found")
         else:
             loginf("%s air-Q devices found" % ct)
 
-    def _create_thread(self, thread_name, address, passwd, prefix, altitude, query_interval):
-        if address is None or address=='': 
-            logerr("device '%s': not host address defined" % thread_name)
-            return False
-        if passwd is None or passwd=='':
-            logerr("device '%s': no password defined" % thread_name)
-            return False
+    def _device_params(self, conf, device):
+        """ parameters of _create_thread() out of the device section 
+            and the general options of section [airQ] """
+        devconf = conf[device]
+        # altitude to calculate altimeter value 
+        if 'altitude' in devconf:
+            __altitude = devconf['altitude']
+            if len(__altitude)==3:
+                __altitude = weewx.units.ValueTuple(weeutil.weeutil.to_float(__altitude[0]),__altitude[1],__altitude[2])
+            else:
+                __altitude = weewx.units.ValueTuple(weeutil.weeutil.to_float(__altitude[0]),__altitude[1],'group_altitude')
+        else:
+            __altitude = self.engine.stn_info.altitude_vt
+        return {
+            'address': devconf.get('host'),
+            'passwd': devconf.get('password'),
+            'prefix': devconf.get('prefix'),
+            'altitude': weewx.units.convert(__altitude,'meter')[0],
+            'query_interval': weeutil.weeutil.to_float(devconf.get('query_interval',conf.get('query_interval',5.0))),
+            'endpoint': devconf.get('endpoint',conf.get('endpoint','data')),
+            'loop_static': devconf.get('loop_static',conf.get('loop_static','always')).lower(),
+            'loop_static_every': weeutil.weeutil.to_int(devconf.get('loop_static_every',conf.get('loop_static_every',0))),
+            'selection': self.obs_selection(devconf,conf,self.derived_obs=='lazy'),
+            'spike': self.spike_selection(devconf,conf),
+            'adaptive': self.adaptive_bounds(devconf,conf)}
+
+    def _create_thread(self, thread_name, address, passwd, prefix, altitude, query_interval, endpoint='data', loop_static='always', loop_static_every=0, selection=(None,None), spike=None, adaptive=None):
+        if self.source=='device':
+            if address is None or address=='': 
+                logerr("device '%s': not host address defined" % thread_name)
+                return False
+            if passwd is None or passwd=='':
+                logerr("device '%s': no password defined" % thread_name)
+                return False
         # report config data from weewx.conf to syslog
-        loginf("device '%s' host address '%s' prefix '%s' query interval %.1f s altitude %.0f m" % (thread_name,address,prefix,query_interval,altitude))
-        # get config data out of device and log
-        try:
-            devconf = airQget(address,'/config',passwd)
-            devconf = devconf.get('content',{})
-        except:
-            logerr("device '%s': could not read config out of the device" % thread_name)
-            devconf = {}
-        loginf("device '%s' device id: %s" % (thread_name,devconf.get('id','unknown')))
-        loginf("device '%s' firmware version: %s" % (thread_name,devconf.get('air-Q-Software-Version','unknown')))
-        loginf("device '%s' sensors: %s" % (thread_name,devconf.get('sensors','unkown')))
-        loginf("device '%s' concentration units config: %s" % (thread_name,'ppb&ppm' if devconf.get('ppb&ppm',False) else 'µg/m^3'))
+        loginf("device '%s' host address '%s' prefix '%s' query interval %.1f s altitude %.0f m endpoint '%s'" % (thread_name,address,prefix,query_interval,altitude,endpoint))
+        if endpoint not in ENDPOINTS:
+            logerr("device '%s': unknown endpoint '%s', using 'data'" % (thread_name,endpoint))
+            endpoint = 'data'
+        if adaptive and endpoint=='data':
+            loginf("device '%s' adaptive query interval %.1f ... %.1f s" % ((thread_name,)+adaptive))
         # initialize thread
         self.threads[thread_name] = {}
         self.threads[thread_name]['queue'] = queue.Queue()
-        self.threads[thread_name]['thread'] = AirqThread(self.threads[thread_name]['queue'], thread_name, address, passwd, self.log_success, self.log_failure, query_interval)
         self.threads[thread_name]['prefix'] = prefix
         self.threads[thread_name]['altitude'] = altitude
         self.threads[thread_name]['QFF_temperature_source'] = 'outTemp'
-        self.threads[thread_name]['ppb&ppm'] = devconf.get('ppb&ppm',False)
-        self.threads[thread_name]['RoomType'] = devconf.get('RoomType')
-        self.threads[thread_name]['state'] = {'init':'1'}
-        # log settings for calculating the barometer value
-        if self.isDeviceOutdoor(thread_name):
-            loginf("device '%s' QFF calculation temperature source: airQ temperature reading" % thread_name)
+        self.threads[thread_name]['endpoint'] = endpoint
+        # readings to send and readings needed to calculate them
+        emit, needed = selection
+        if emit is not None:
+            loginf("device '%s' readings: %s" % (thread_name,', '.join(sorted(emit))))
+        self.threads[thread_name]['emit'] = emit
+        if spike:
+            loginf("device '%s' spike filter: %s" % (thread_name,', '.join(['%s window %s threshold %s min. deviation %s' % (key,spike[key][0],spike[key][1],spike[key][2]) for key in sorted(spike)])))
+        self.threads[thread_name]['aggregator'] = AirqAggregator(thread_name, endpoint!='data', needed, self.batch_threshold, spike)
+        # send static readings only if changed
+        if loop_static=='changed':
+            loginf("device '%s' static readings: on change, every %s packets, and at the beginning of the archive interval" % (thread_name,loop_static_every))
+            self.threads[thread_name]['loop_static'] = {
+                'keys':[self.obstype_with_prefix(self.AIRQ_DATA[ii][0],prefix) for ii in self.LOOP_STATIC if emit is None or ii in emit],
+                'every':loop_static_every,
+                'count':0,
+                'interval':None,
+                'last':{}}
         else:
-            loginf("device '%s' QFF calculation temperature source: %s" % (thread_name,self.threads[thread_name]['QFF_temperature_source']))
-        # set accumulators for non-numeric observation types
+            self.threads[thread_name]['loop_static'] = None
+        if self.source in ('broker','replay'):
+            # The readings and the device config are received from the 
+            # broker or read from a recording.
+            self.threads[thread_name]['thread'] = None
+            devconf = {}
+        else:
+            # get config data out of the cache or the device
+            self.threads[thread_name]['host'] = (address, passwd)
+            devconf = self._device_config(thread_name, address, passwd)
+            if self.processes:
+                # The device is polled by a worker process.
+                self.threads[thread_name]['thread'] = None
+                self.threads[thread_name]['shard'] = (address, passwd, query_interval, endpoint, needed, spike, adaptive)
+            else:
+                self.threads[thread_name]['thread'] = AirqThread(self.threads[thread_name]['queue'], thread_name, address, passwd, self.log_success, self.log_failure, query_interval, recorder=self.recorder, endpoint=endpoint, shm=self.shm, adaptive=adaptive)
+            if self.recorder:
+                self.recorder.record_config(thread_name, devconf)
+        self.set_device_config(thread_name, devconf)
+        if self.derived:
+            derived_keys = self.derived_keys(self.threads[thread_name]['ppb&ppm'])
+        else:
+            derived_keys = []
+        # set accumulators for non-numeric observation types, and for
+        # static readings that are not sent in every LOOP packet
         _accum = {}
-        for ii in self.ACCUM_LAST:
+        for ii in (self.LOOP_STATIC if self.threads[thread_name]['loop_static'] else self.ACCUM_LAST):
+            if emit is not None and ii not in emit: continue
             _obs_conf = self.AIRQ_DATA[ii]
             if _obs_conf:
                 _accum[self.obstype_with_prefix(_obs_conf[0],prefix)] = ACCUM_LAST_DICT
             else:
                 _accum[self.obstype_with_prefix(ii,prefix)] = ACCUM_LAST_DICT
+        for ii in self.EXTRACT_LAST:
+            if emit is not None and ii not in emit: continue
+            _accum[self.obstype_with_prefix(self.AIRQ_DATA[ii][0],prefix)] = ACCUM_EXTRACT_LAST_DICT
+        self._remove_accum(thread_name)
         weewx.accum.accum_dict.maps.append(_accum)
+        self.accum_maps[thread_name] = _accum
         # set units for observation types
         for ii in self.AIRQ_DATA:
+            if emit is not None and ii not in emit: continue
             _obs_conf = self.AIRQ_DATA[ii]
             if _obs_conf and _obs_conf[2] is not None:
                 #weewx.units.obs_group_dict.setdefault(self.obstype_with_prefix(_obs_conf[0],prefix),_obs_conf[2])
                 weewx.units.obs_group_dict[self.obstype_with_prefix(_obs_conf[0],prefix)] = _obs_conf[2]
+                # buffer numeric readings for short-window aggregates
+                if self.rolling_stats and ii not in self.ACCUM_LAST and ii not in derived_keys:
+                    self.rolling_stats.add_obs_type(self.obstype_with_prefix(_obs_conf[0],prefix))
         # start thread
-        self.threads[thread_name]['thread'].start()
+        if self.threads[thread_name]['thread']:
+            self.threads[thread_name]['thread'].start()
         return True
+
+    def _remove_accum(self, thread_name):
+        """ remove the accumulator settings of the device """
+        _accum = self.accum_maps.pop(thread_name,None)
+        if _accum is not None:
+            # by identity, as devices without prefix have equal dicts
+            weewx.accum.accum_dict.maps[:] = [ii for ii in weewx.accum.accum_dict.maps if ii is not _accum]
+
+    def _device_config(self, thread_name, address, passwd):
+        """ config data out of the cache, or out of the device if not
+            cached 
+            
+            With 'config_background' set, the device is not asked here
+            but in background, and {} is returned for the time being.
+        """
+        dev = self.threads[thread_name]
+        # time to read the config data in background, None if not planned
+        dev['config_next'] = None
+        # config data read in background
+        dev['config_new'] = None
+        if self.config_cache:
+            devconf, valid = self.config_cache.get(thread_name, address)
+            if devconf is not None:
+                if valid:
+                    loginf("device '%s': config data out of the cache" % thread_name)
+                    dev['config_next'] = self.config_cache.expires(thread_name)
+                else:
+                    loginf("device '%s': config data out of the cache, expired, reading them in background" % thread_name)
+                    dev['config_next'] = 0
+                return devconf
+        if self.config_background:
+            loginf("device '%s': reading config data in background" % thread_name)
+            dev['config_next'] = 0
+            return {}
+        devconf = self._read_config(address, passwd)
+        if devconf:
+            if self.config_cache:
+                self.config_cache.put(thread_name, address, devconf)
+                dev['config_next'] = self.config_cache.expires(thread_name)
+        else:
+            logerr("device '%s': could not read config out of the device" % thread_name)
+            if self.config_cache:
+                dev['config_next'] = time.time()+CONFIG_RETRY
+        return devconf
+
+    @staticmethod
+    def _read_config(address, passwd):
+        """ get config data out of the device, {} in case of error """
+        try:
+            reply = airQget(address,'/config',passwd,timeout=POLL_TIMEOUT)
+            if reply['replystatus']==200:
+                return reply.get('content',{})
+        except Exception:
+            # invalid reply, possibly wrong password
+            pass
+        return {}
+
+    @staticmethod
+    def _refresh_config(dev, address, passwd):
+        """ read config data in background """
+        dev['config_new'] = AirqService._read_config(address, passwd)
+
+    def _check_config(self, thread_name, data):
+        """ apply config data read in background, and read them again
+            if they expired or another device answers at that address
+        """
+        dev = self.threads[thread_name]
+        devconf = dev.get('config_new')
+        if devconf is not None:
+            dev['config_new'] = None
+            self._update_config(thread_name, devconf)
+        device_id = data.get('DeviceID')
+        if (self.config_cache and device_id and dev.get('device_id') and 
+            device_id!=dev['device_id'] and dev.get('config_next') is not None):
+            loginf("device '%s': device id changed from %s to %s" % (thread_name,dev['device_id'],device_id))
+            self.config_cache.invalidate(thread_name)
+            dev['device_id'] = device_id
+            dev['config_next'] = 0
+        if dev.get('config_next') is not None and time.time()>=dev['config_next']:
+            # None while reading
+            dev['config_next'] = None
+            thread = threading.Thread(target=self._refresh_config, args=(dev,)+dev['host'], name='airQ-config-'+thread_name)
+            thread.daemon = True
+            thread.start()
+
+    def _update_config(self, thread_name, devconf):
+        """ save and apply the config data read in background """
+        dev = self.threads[thread_name]
+        if not devconf:
+            LOG_THROTTLE.log(thread_name,'config',logerr,"device '%s': could not read config out of the device" % thread_name,owner='device')
+            dev['config_next'] = time.time()+CONFIG_RETRY
+            return
+        if self.config_cache:
+            self.config_cache.put(thread_name, dev['host'][0], devconf)
+            dev['config_next'] = self.config_cache.expires(thread_name)
+        old = dev.get('config',{})
+        if all(devconf.get(key)==old.get(key) for key in DEVICE_CONFIG_KEYS): return
+        if old and devconf.get('air-Q-Software-Version')!=old.get('air-Q-Software-Version'):
+            loginf("device '%s': firmware version changed from %s to %s" % (thread_name,old.get('air-Q-Software-Version'),devconf.get('air-Q-Software-Version')))
+        self.set_device_config(thread_name, devconf)
+        if self.recorder:
+            self.recorder.record_config(thread_name, devconf)
+
+    def set_device_config(self, thread_name, devconf):
+        """ log and apply the config data out of the device """
+        self.threads[thread_name]['config'] = {key:devconf[key] for key in DEVICE_CONFIG_KEYS if key in devconf}
+        self.threads[thread_name]['device_id'] = devconf.get('id')
+        loginf("device '%s' device id: %s" % (thread_name,devconf.get('id','unknown')))
+        loginf("device '%s' firmware version: %s" % (thread_name,devconf.get('air-Q-Software-Version','unknown')))
+        loginf("device '%s' sensors: %s" % (thread_name,devconf.get('sensors','unkown')))
+        loginf("device '%s' concentration units config: %s" % (thread_name,'ppb&ppm' if devconf.get('ppb&ppm',False) else 'µg/m^3'))
+        self.threads[thread_name]['ppb&ppm'] = devconf.get('ppb&ppm',False)
+        self.threads[thread_name]['RoomType'] = devconf.get('RoomType')
+        # log settings for calculating the barometer value
+        if self.isDeviceOutdoor(thread_name):
+            loginf("device '%s' QFF calculation temperature source: airQ temperature reading" % thread_name)
+        else:
+            loginf("device '%s' QFF calculation temperature source: %s" % (thread_name,self.threads[thread_name]['QFF_temperature_source']))
+        # register derived observation types calculated on request
+        if self.derived:
+            self.derived.add_device(thread_name, self.threads[thread_name]['prefix'], self.threads[thread_name]['ppb&ppm'], self.threads[thread_name].get('emit'))
             
     def shutDown(self):
+        # remove XTypes
+        for xtype in (self.rolling_stats,self.derived,self.rollup):
+            if xtype:
+                try:
+                    weewx.xtypes.xtypes.remove(xtype)
+                except ValueError:
+                    pass
+        if getattr(self,'broker_client',None):
+            self.broker_client.shutDown()
+        if getattr(self,'shards',None):
+            self.shards.shutDown()
         for ii in self.threads:
             try:
-                loginf("shutting down connection to '%s'" % ii)
-                self.threads[ii]['thread'].shutDown()
+                if self.threads[ii]['thread']:
+                    loginf("shutting down connection to '%s'" % ii)
+                    self.threads[ii]['thread'].shutDown()
             except:
                 pass
         # wait at max 10 seconds for shutdown to complete
         timeout = time.time()+10
         for ii in self.threads:
             try:
+                if not self.threads[ii]['thread']: continue
                 w = timeout-time.time()
                 if w<=0: break
                 self.threads[ii]['thread'].join(w)
@@ -471,11 +2676,32 @@ class AirqService(StdService):
                     logerr("unable to shutdown thread '%s'" % self.threads[ii]['thread'].name)
             except:
                 pass
+        if self.recorder:
+            self.recorder.close()
+        if self.rollup:
+            self.rollup.close()
+        if self.shm:
+            self.shm.close()
+        for shm in self.shm_retired:
+            shm.retire()
+        # log the numbers of spikes rejected
+        for ii in self.threads:
+            __filters = self.threads[ii]['aggregator'].filters
+            for key in sorted(__filters):
+                # With option 'processes' the values are filtered 
+                # within the worker processes.
+                if not __filters[key].accepted+__filters[key].rejected: continue
+                loginf("device '%s' spike filter '%s': %s of %s values rejected" % (ii,key,__filters[key].rejected,__filters[key].accepted+__filters[key].rejected))
+        # log pending summaries and the numbers of messages
+        LOG_THROTTLE.flush()
+        __stats = LOG_THROTTLE.stats()
+        if __stats['suppressed']:
+            loginf("repeated messages: %s logged, %s not logged" % (__stats['logged'],__stats['suppressed']))
         # report threads that are still alive
         _threads = [ii for ii in self.threads]
         for ii in _threads:
             try:
-                if self.threads[ii]['thread'].is_alive():
+                if self.threads[ii]['thread'] and self.threads[ii]['thread'].is_alive():
                     logerr("unable to shutdown thread '%s'" % self.threads[ii]['thread'].name)
                 del self.threads[ii]['thread']
                 del self.threads[ii]['queue']
@@ -483,135 +2709,460 @@ class AirqService(StdService):
             except:
                 pass
         
+    def _check_reload(self):
+        """ reload the device sections if weewx.conf was changed """
+        now = time.time()
+        if now<self.reload_next: return
+        self.reload_next = now+self.reload_interval
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except OSError as e:
+            logerr("reload: %s" % e)
+            return
+        if mtime==self.config_mtime: return
+        self.config_mtime = mtime
+        try:
+            conf = configobj.ConfigObj(self.config_path, encoding='utf-8', file_error=True)
+        except (OSError,SyntaxError) as e:
+            # configobj.ConfigObjError is derived from SyntaxError
+            logerr("reload: could not read '%s': %s" % (self.config_path,e))
+            return
+        if 'airQ' not in conf:
+            logerr("reload: section [airQ] missing in '%s'" % self.config_path)
+            return
+        self.reload(conf['airQ'])
+
+    def reload(self, conf):
+        """ apply the changes of the device sections of section [airQ]
+        
+            New devices are added, removed devices are stopped. If only
+            host address, password, or query interval of a device 
+            changed, the running thread is updated. Otherwise the 
+            device is set up anew.
+        """
+        loginf("reloading the device sections of section [airQ]")
+        # general options
+        options = {key:conf[key] for key in conf.scalars}
+        for key in sorted(set(options)|set(self.airq_options)):
+            if options.get(key)!=self.airq_options.get(key) and key not in self.RELOAD_OPTIONS:
+                logerr("reload: option '%s' changed, restart WeeWX to apply" % key)
+        self.airq_options = options
+        if 'reload_interval' in options:
+            # 0 switches reloading off until the next restart
+            self.reload_interval = weeutil.weeutil.to_float(options['reload_interval']) or 0.0
+            if not self.reload_interval:
+                loginf("reload: checking '%s' switched off" % self.config_path)
+        if self.profiler:
+            self.profiler.packets = weeutil.weeutil.to_int(options.get('profile_packets',100))
+            self.profiler.minutes = weeutil.weeutil.to_float(options.get('profile_minutes',0))
+        # devices
+        removed = [ii for ii in self.threads if ii not in conf.sections]
+        added = [ii for ii in conf.sections if ii not in self.threads]
+        for ii in removed:
+            loginf("reload: device '%s' removed" % ii)
+            self._remove_device(ii)
+        # The order of the slots of the shared memory file is the order
+        # of the device sections. The old file is retired with the next
+        # LOOP packet, when the threads switched to the new one. Then 
+        # the readers switch over, too.
+        if self.shm and (removed or added):
+            import user.airq_shm
+            try:
+                shm = user.airq_shm.AirqShmWriter(self.shm_file, conf.sections)
+                self.shm_retired.append(self.shm)
+                self.shm = shm
+                for ii in self.threads:
+                    if self.threads[ii]['thread']:
+                        self.threads[ii]['thread'].shm = self.shm
+            except ValueError as e:
+                logerr("reload: shared memory file '%s': %s" % (self.shm_file,e))
+        for ii in conf.sections:
+            params = self._device_params(conf, ii)
+            if ii in self.threads:
+                old = self.threads[ii].get('params',{})
+                changed = [key for key in params if params[key]!=old.get(key)]
+                if not changed: continue
+                if (set(changed)<=set(self.RELOAD_IN_PLACE) and 
+                    self.threads[ii]['thread'] and params['address'] and params['passwd']):
+                    loginf("reload: device '%s' changed: %s" % (ii,', '.join(changed)))
+                    self.threads[ii]['thread'].update(params['address'], params['passwd'], params['query_interval'])
+                    self.threads[ii]['host'] = (params['address'], params['passwd'])
+                    self.threads[ii]['params'] = params
+                    if 'address' in changed:
+                        # possibly another device, read its config data
+                        # in background
+                        self.threads[ii]['config_next'] = 0
+                    continue
+                loginf("reload: device '%s' changed: %s, setting it up anew" % (ii,', '.join(changed)))
+                self._remove_device(ii)
+            else:
+                loginf("reload: device '%s' added" % ii)
+            # The config data of the device are read in background, so
+            # that the LOOP is not delayed.
+            self.config_background = True
+            if self._create_thread(ii, **params):
+                self.threads[ii]['params'] = params
+        loginf("reload: %s air-Q devices active" % len(self.threads))
+
+    def _remove_device(self, thread_name):
+        """ stop polling the device and forget about it
+        
+            The thread is not joined, so that the LOOP is not delayed.
+            It ends after the current request to the device at the 
+            latest.
+        """
+        dev = self.threads.pop(thread_name)
+        self._remove_accum(thread_name)
+        if dev['thread']:
+            loginf("shutting down connection to '%s'" % thread_name)
+            dev['thread'].shm = None
+            dev['thread'].shutDown()
+        if self.derived:
+            self.derived.remove_device(thread_name)
+        if self.snapshot:
+            self.snapshot.devices.pop(thread_name,None)
+        if self.shm:
+            self.shm.set_offline(thread_name)
+
     def new_loop_packet(self, event):
-        for ii in self.threads:
-            data = {}
-            avg_sum = {}
-            avg_ct = {}
-            last_ts = 0
-            while True:
-                try:
-                    # get new data packet from queue
-                    reply = self.threads[ii]['queue'].get(block=False)
-                    # check timestamp
-                    if reply['timestamp']<=last_ts: 
-                        logdbg("New record is older than last record.")
-                        continue
-                    # check status
-                    try:
-                        if reply.get('Status','')=='OK':
-                            airqstate = {}
-                        else:
-                            airqstate = json.loads(reply['Status'])
-                            if 'Status' in airqstate:
-                                airqstate = airqstate['Status']
-                        if airqstate!=self.threads[ii]['state']:
-                            self.threads[ii]['state'] = airqstate
-                            if airqstate:
-                                logerr("thread '%s': state %s" % (ii,airqstate))
-                            else:
-                                loginf("thread '%s': state OK" % ii)
-                    except (KeyError,ValueError,IndexError,TypeError):
-                        airqstate = {}
-                    # process values
-                    for jj in reply:
-                        try:
-                            unit_group = self.AIRQ_DATA.get(jj)[2] 
-                        except (IndexError,TypeError):
-                            unit_group = ""
-                        if jj in airqstate:
-                            # observation type is mentioned in status,
-                            # that means the value is invalid
-                            val = None
-                        else:
-                            # otherwise try to get the value
-                            try:
-                                xx = self.AIRQ_DATA.get(jj)
-                                val = xx[3](reply[jj]) if xx is not None else reply[jj]
-                                if jj not in self.ACCUM_LAST:
-                                    if val<0.0: val = None
-                            except (ValueError,TypeError,IndexError,KeyError) as e:
-                                val = None
-                        #logdbg("val %s - %s - %s" % (jj,reply[jj],val))
-                        if unit_group in self.AVG_GROUPS:
-                            # if observation type is in AVG_GROUPS, then
-                            # add values for calculating averages
-                            if val:
-                                avg_sum[jj] = avg_sum.get(jj,0)+val
-                                avg_ct[jj] = avg_ct.get(jj,0)+1
-                        else:
-                            # otherwise remember the last value of the
-                            # loop period
-                            data.update({jj:val})
-                except queue.Empty:
-                    break
-                except KeyError:
-                    # instead of queue.Empty KeyError was raised
-                    break
-                except (IndexError,ValueError,TypeError) as e:
-                    logerr("new_loop_packet %s" % e)
-            # calculate average
-            for jj in avg_sum:
-                data.update({jj:avg_sum[jj]/avg_ct[jj]})
-            # calculate altimeter value from pressure reading
-            if 'pressure' in data and 'altimeter' not in data:
-                try:
-                    data['altimeter'] = altimeter_pressure_Metric(data['pressure'],self.threads[ii]['altitude'])
-                except (ValueError,TypeError,IndexError,KeyError):
-                    pass
-            # calculate barometer value from pressure and temperature reading
-            if not self.isDeviceOutdoor(ii) and self.threads[ii]['QFF_temperature_source'] in event.packet:
-                # As outTemp is not within every LOOP packet and airQ
-                # readings are not available for every LOOP packet,
-                # remember the outTemp reading for the next 5 minutes.
-                # Only necessary if 'RoomType' is indoor.
-                self.threads[ii]['outTemp_vt'] = weewx.units.as_value_tuple(
-                    event.packet,
-                    self.threads[ii]['QFF_temperature_source'])
-                self.threads[ii]['outTempValid'] = time.time()+300
-            if 'pressure' in data and 'barometer' not in data:
-                try:
-                    if self.isDeviceOutdoor(ii):
-                        # if the airQ device is located outdoor, use the
-                        # temperature measured by the device
-                        t_C = data['temperature']
-                    else:
-                        # if the airQ device is located indoor, use the
-                        # observation type 'outTemp'
-                        if time.time()>self.threads[ii]['outTempValid']:
-                            raise ValueError("no recent outTemp reading")
-                        t_C = weewx.units.convert(self.threads[ii]['outTemp_vt'],'degree_C')[0]
-                    data['barometer'] = sealevel_pressure_Metric(data['pressure'],self.threads[ii]['altitude'],t_C)
-                except (ValueError,TypeError,IndexError,KeyError):
-                    pass
-            # volume or mass
+        if self.profiler and self.profiler.check(self):
             try:
+                self._new_loop_packet(event)
+            finally:
+                self.profiler.done(self)
+        else:
+            self._new_loop_packet(event)
+
+    def _new_loop_packet(self, event):
+        LOG_THROTTLE.flush()
+        if self.reload_interval:
+            self._check_reload()
+        # time since the previous LOOP packet for the adaptive query
+        # interval
+        now = self.clock.time()
+        loop_interval = now-self.last_loop if self.last_loop else None
+        self.last_loop = now
+        # shared memory files replaced by reload
+        while self.shm_retired:
+            self.shm_retired.pop().retire()
+        for ii in self.threads:
+            # get all readings out of the queue and calculate averages
+            samples = self.threads[ii]['queue'].qsize()
+            data = self.threads[ii]['aggregator'].aggregate(self.threads[ii]['queue']).get_data()
+            if loop_interval and self.threads[ii]['thread'] and self.threads[ii]['thread'].adaptive:
+                self.threads[ii]['thread'].loop_feedback(loop_interval, samples)
+            self._check_config(ii, data)
+            # calculate values that are not provided by the device
+            if self.derived_obs=='lazy':
+                # The derived values are calculated on request by the
+                # XType AirqDerived. Only the volume readings are to 
+                # be renamed.
                 if self.threads[ii]['ppb&ppm']:
                     for vmobs in self.CONV_V_M:
-                        if vmobs in data and vmobs in self.AIRQ_DATA:
-                            data[vmobs+'_vol'] = data[vmobs]
-                            data[vmobs] = self.convert_to_m(ii,vmobs,data[vmobs],data.get('temperature'),data.get('pressure'))
-                else:
-                    for vmobs in self.CONV_V_M:
-                        if vmobs in data and vmobs in self.AIRQ_DATA:
-                            data[vmobs+'_vol'] = self.convert_to_v(ii,vmobs,data[vmobs],data.get('temperature'),data.get('pressure'))
-                            logdbg("%s: mass %.3f vol %.3f" % (vmobs,data[vmobs],data[vmobs+'_vol']))
-                            pass
-            except (ValueError,TypeError,IndexError,KeyError) as e:
-                pass
+                        if vmobs in data:
+                            data[vmobs+'_vol'] = data.pop(vmobs)
+            else:
+                self._calc_derived_loop(ii, data, event.packet)
+            # remove the readings not selected
+            if self.threads[ii]['emit'] is not None:
+                data = {key:data[key] for key in data if key in self.threads[ii]['emit']}
             # convert airQ to WeeWX observation type names and
             # values to archive unit system
             data = self.airq_to_weewx(data, self.threads[ii].get('prefix'), event.packet.get('usUnits'))
             # 'dateTime' and 'interval' must not be in data
             if data.get('dateTime'): del data['dateTime']
             if data.get('interval'): del data['interval']
+            # remove static readings that did not change
+            if self.threads[ii]['loop_static']:
+                self._remove_unchanged(self.threads[ii]['loop_static'], data, event.packet.get('dateTime'))
             # log 
             if self.debug>=3: 
                 logdbg("PACKET %s" % data)
             #loginf("PACKET %s" % data)
+            # remember readings for short-window aggregates
+            if self.rolling_stats:
+                self.rolling_stats.add_packet(event.packet.get('dateTime'), data, event.packet.get('usUnits'))
+            # remember readings for the snapshot file
+            if self.snapshot:
+                self.snapshot.update(ii, self.threads[ii].get('prefix'), self.threads[ii]['aggregator'].state, data, event.packet.get('usUnits'), event.packet.get('dateTime'))
             # update loop packet with airQ data
             event.packet.update(data)
+        if self.snapshot:
+            self.snapshot.write(event.packet.get('dateTime'))
+
+    def _remove_unchanged(self, static, data, ts):
+        """ remove static readings from data that did not change
+
+            The readings use the 'firstlast' accumulator. They are sent
+            at the beginning of each archive interval, so that the 
+            archive record gets them even if they do not change.
+        """
+        static['count'] += 1
+        interval = weeutil.weeutil.startOfInterval(ts,self.archive_interval) if ts else None
+        if (interval!=static['interval'] or 
+            (static['every'] and static['count']>=static['every'])):
+            # send all static readings
+            static['interval'] = interval
+            static['count'] = 0
+            for key in static['keys']:
+                if key in data:
+                    static['last'][key] = data[key]
+            return
+        for key in static['keys']:
+            if key in data:
+                if key in static['last'] and data[key]==static['last'][key]:
+                    del data[key]
+                else:
+                    static['last'][key] = data[key]
+
+    def new_archive_record(self, event):
+        """ update the rollup store """
+        try:
+            self.rollup.add_records([event.record])
+            self.rollup.prune(event.record['dateTime'])
+        except weedb.DatabaseError as e:
+            logerr("rollup: %s" % e)
             
+    def _calc_derived_loop(self, ii, data, packet):
+        """ calculate altimeter, barometer, volume and mass values
+            for the LOOP packet """
+        # calculate altimeter value from pressure reading
+        if 'pressure' in data and 'altimeter' not in data:
+            try:
+                data['altimeter'] = altimeter_pressure_Metric(data['pressure'],self.threads[ii]['altitude'])
+            except (ValueError,TypeError,IndexError,KeyError):
+                pass
+        # calculate barometer value from pressure and temperature reading
+        if not self.isDeviceOutdoor(ii) and self.threads[ii]['QFF_temperature_source'] in packet:
+            # As outTemp is not within every LOOP packet and airQ
+            # readings are not available for every LOOP packet,
+            # remember the outTemp reading for the next 5 minutes.
+            # Only necessary if 'RoomType' is indoor.
+            self.threads[ii]['outTemp_vt'] = weewx.units.as_value_tuple(
+                packet,
+                self.threads[ii]['QFF_temperature_source'])
+            self.threads[ii]['outTempValid'] = self.clock.time()+300
+        if 'pressure' in data and 'barometer' not in data:
+            try:
+                if self.isDeviceOutdoor(ii):
+                    # if the airQ device is located outdoor, use the
+                    # temperature measured by the device
+                    t_C = data['temperature']
+                else:
+                    # if the airQ device is located indoor, use the
+                    # observation type 'outTemp'
+                    if self.clock.time()>self.threads[ii]['outTempValid']:
+                        raise ValueError("no recent outTemp reading")
+                    t_C = weewx.units.convert(self.threads[ii]['outTemp_vt'],'degree_C')[0]
+                data['barometer'] = sealevel_pressure_Metric(data['pressure'],self.threads[ii]['altitude'],t_C)
+            except (ValueError,TypeError,IndexError,KeyError):
+                pass
+        # volume or mass
+        try:
+            if self.threads[ii]['ppb&ppm']:
+                for vmobs in self.CONV_V_M:
+                    if vmobs in data and vmobs in self.AIRQ_DATA:
+                        data[vmobs+'_vol'] = data[vmobs]
+                        data[vmobs] = self.convert_to_m(ii,vmobs,data[vmobs],data.get('temperature'),data.get('pressure'))
+            else:
+                for vmobs in self.CONV_V_M:
+                    if vmobs in data and vmobs in self.AIRQ_DATA:
+                        data[vmobs+'_vol'] = self.convert_to_v(ii,vmobs,data[vmobs],data.get('temperature'),data.get('pressure'))
+                        logdbg("%s: mass %.3f vol %.3f" % (vmobs,data[vmobs],data[vmobs+'_vol']))
+                        pass
+        except (ValueError,TypeError,IndexError,KeyError) as e:
+            pass
+
+    @classmethod
+    def _names(cls):
+        """ airQ keys by airQ key and by WeeWX observation type """
+        # WeeWX observation types take precedence
+        names = {key:key for key in cls.AIRQ_DATA}
+        for key in cls.AIRQ_DATA:
+            if cls.AIRQ_DATA[key]: names[cls.AIRQ_DATA[key][0]] = key
+        return names
+
+    @classmethod
+    def spike_selection(cls, conf, global_conf=None):
+        """ window and threshold of the spike filter by airQ key
+            according to the options 'spike_filter', 'spike_window', 
+            and 'spike_threshold'
+
+            An entry of 'spike_filter' can be 
+            'name:window:threshold:min_deviation' to override the 
+            defaults for that reading. Returns None if no filter is 
+            configured.
+        """
+        if global_conf is None: global_conf = {}
+        option = conf.get('spike_filter',global_conf.get('spike_filter'))
+        if not option: return None
+        window = weeutil.weeutil.to_int(conf.get('spike_window',global_conf.get('spike_window',SPIKE_WINDOW)))
+        threshold = weeutil.weeutil.to_float(conf.get('spike_threshold',global_conf.get('spike_threshold',SPIKE_THRESHOLD)))
+        min_deviation = weeutil.weeutil.to_float(conf.get('spike_min_deviation',global_conf.get('spike_min_deviation',SPIKE_MIN_DEVIATION)))
+        names = cls._names()
+        spike = {}
+        for entry in weeutil.weeutil.option_as_list(option):
+            parts = entry.split(':')
+            if parts[0] not in names:
+                logerr("unknown observation type '%s' in option 'spike_filter'" % parts[0])
+                continue
+            try:
+                spike[names[parts[0]]] = (
+                    max(3,int(parts[1])) if len(parts)>1 and parts[1] else max(3,window),
+                    float(parts[2]) if len(parts)>2 and parts[2] else threshold,
+                    float(parts[3]) if len(parts)>3 and parts[3] else min_deviation)
+            except ValueError:
+                logerr("invalid entry '%s' in option 'spike_filter'" % entry)
+        return spike
+
+    @classmethod
+    def obs_selection(cls, conf, global_conf=None, lazy=False):
+        """ airQ keys to send and airQ keys needed to calculate them
+            according to the options 'include' and 'exclude'
+        
+            The names can be airQ keys or WeeWX observation types
+            without prefix. Returns (None, None) if all the readings
+            are used.
+        """
+        if global_conf is None: global_conf = {}
+        include = conf.get('include',global_conf.get('include'))
+        exclude = conf.get('exclude',global_conf.get('exclude'))
+        if not include and not exclude: return None, None
+        names = cls._names()
+        def _keys(option):
+            keys = set()
+            for name in weeutil.weeutil.option_as_list(option):
+                if name in names:
+                    keys.add(names[name])
+                else:
+                    logerr("unknown observation type '%s' in option 'include' or 'exclude'" % name)
+            return keys
+        emit = _keys(include) if include else set(cls.AIRQ_DATA)
+        if exclude: emit -= _keys(exclude)
+        # readings the derived values are calculated from, and the
+        # device id to check the config data against
+        needed = set(emit)
+        needed.add('DeviceID')
+        for key in emit:
+            if key in ('altimeter','barometer'):
+                needed.update(('pressure','temperature'))
+            gas = key[:-4] if key.endswith('_vol') else key
+            if gas in cls.CONV_V_M:
+                needed.update((gas,'temperature','pressure'))
+        # In 'lazy' mode the derived values are calculated out of the
+        # record, so the base readings must be within.
+        if lazy: emit = needed
+        return emit, needed
+
+    @staticmethod
+    def adaptive_bounds(conf, global_conf):
+        """ minimum and maximum of the adaptive query interval, None
+            if the query interval is fixed """
+        if not weeutil.weeutil.to_bool(conf.get('adaptive_interval',global_conf.get('adaptive_interval',False))):
+            return None
+        low = weeutil.weeutil.to_float(conf.get('query_interval_min',global_conf.get('query_interval_min',1.0)))
+        high = weeutil.weeutil.to_float(conf.get('query_interval_max',global_conf.get('query_interval_max',30.0)))
+        return (low, max(low,high))
+
+    @classmethod
+    def derived_keys(cls, ppbppm):
+        """ airQ keys of the values calculated by software """
+        if ppbppm:
+            return ['altimeter','barometer']+list(cls.CONV_V_M)
+        return ['altimeter','barometer']+[ii+'_vol' for ii in cls.CONV_V_M]
+
+    def _record_value(self, record, key, prefix):
+        """ get reading out of a record, converted to the airQ unit """
+        obs = self.obstype_with_prefix(self.AIRQ_DATA[key][0],prefix)
+        if record.get(obs) is None: return None
+        vt = weewx.units.as_value_tuple(record, obs)
+        return weewx.units.convert(vt, self.AIRQ_DATA[key][1])[0]
+
+    def calc_derived(self, thread_name, key, record):
+        """ calculate the derived value 'key' out of the base readings
+            in 'record' """
+        dev = self.threads[thread_name]
+        prefix = dev.get('prefix')
+        try:
+            if key=='altimeter':
+                return altimeter_pressure_Metric(
+                    self._record_value(record,'pressure',prefix),
+                    dev['altitude'])
+            if key=='barometer':
+                if self.isDeviceOutdoor(thread_name):
+                    t_C = self._record_value(record,'temperature',prefix)
+                else:
+                    vt = weewx.units.as_value_tuple(record,dev['QFF_temperature_source'])
+                    t_C = weewx.units.convert(vt,'degree_C')[0]
+                return sealevel_pressure_Metric(
+                    self._record_value(record,'pressure',prefix),
+                    dev['altitude'], t_C)
+            temp = self._record_value(record,'temperature',prefix)
+            pressure = self._record_value(record,'pressure',prefix)
+            if key.endswith('_vol'):
+                return self.convert_to_v(thread_name, key[:-4], 
+                    self._record_value(record,key[:-4],prefix),
+                    temp, pressure)
+            return self.convert_to_m(thread_name, key,
+                    self._record_value(record,key+'_vol',prefix),
+                    temp, pressure)
+        except (ValueError,TypeError,IndexError,KeyError):
+            return None
+
+    def calc_derived_array(self, thread_name, key, arrays):
+        """ calculate the derived value 'key' for a lot of records at once
+        
+            Like calc_derived(), but 'arrays' is a dict of NumPy arrays
+            of the base readings in airQ units, with NaN for missing
+            values. The temperature source for indoor devices is 
+            expected in degree_C. Returns an array with NaN where the 
+            value cannot be calculated, all NaN if a base reading is
+            missing in 'arrays'.
+        """
+        dev = self.threads[thread_name]
+        pressure = arrays.get('pressure')
+        temp = arrays.get('temperature')
+        size = len(next(iter(arrays.values()))) if arrays else 0
+        with numpy.errstate(invalid='ignore',divide='ignore'):
+            if key=='altimeter':
+                if pressure is None: return numpy.full(size,numpy.nan)
+                # same algorithm as altimeter_pressure_Metric()
+                return numpy.where(pressure>0.3,
+                    weewx.uwxutils.TWxUtils.StationToAltimeter(pressure, dev['altitude'], algorithm='aaASOS'),
+                    numpy.nan)
+            if key=='barometer':
+                if self.isDeviceOutdoor(thread_name):
+                    t_C = temp
+                else:
+                    t_C = arrays.get(dev['QFF_temperature_source'])
+                if pressure is None or t_C is None: return numpy.full(size,numpy.nan)
+                # same formula as sealevel_pressure_Metric()
+                return pressure/numpy.exp(-dev['altitude']/((t_C+273.15)*29.263))
+            if key.endswith('_vol'):
+                gas = key[:-4]
+                val = arrays.get(gas)
+                if val is None: return numpy.full(size,numpy.nan)
+                if dev['ppb&ppm']: return numpy.where(val!=0,val,numpy.nan)
+                val = val/self._volume_mass_factor_array(gas, temp, pressure)
+            else:
+                gas = key
+                val = arrays.get(gas+'_vol')
+                if val is None: return numpy.full(size,numpy.nan)
+                if dev['ppb&ppm']:
+                    val = val*self._volume_mass_factor_array(gas, temp, pressure)
+            # like convert_to_m() and convert_to_v() zero means no value
+            return numpy.where(val!=0,val,numpy.nan)
+
+    def _volume_mass_factor_array(self, obs, temp, pressure):
+        """ conversion factor between mass and volume for arrays """
+        if temp is None or pressure is None or not self.volume_mass_method:
+            return self.CONV_V_M[obs]
+        const = numpy.full(len(temp),self.CONV_V_M[obs])
+        valid = numpy.isfinite(temp)&(temp!=0)&numpy.isfinite(pressure)&(pressure!=0)
+        return numpy.where(valid,
+            (self.MOL_MASS[obs]/22.4) * (273.15/(273.15+temp)) * (pressure/1013.25),
+            const)
+
     def _volume_mass_factor(self, obs, temp, pressure):
         """ conversion factor between mass and volume """
         if not temp or not pressure or not self.volume_mass_method:
@@ -671,6 +3222,110 @@ class AirqService(StdService):
             _data[weewx_key] = val
         return _data
 
+# bit of each reading within the sensor fault mask, fixed by the order
+# of AIRQ_DATA; all the keys in 'Status' that are not in AIRQ_DATA
+# share bit 62, so that the mask fits into a signed 64 bit integer
+FAULT_BITS = {key:1<<idx for idx, key in enumerate(AirqService.AIRQ_DATA)}
+FAULT_OTHER = 1<<62
+
+##############################################################################
+#   replay recorded replies                                                  #
+##############################################################################
+
+class AirqReplay(object):
+    """ feed recorded replies into AirqService.new_loop_packet()
+
+        Synthetic LOOP packets are created every 'loop_interval' seconds
+        of the recorded time. The time is provided by a virtual clock,
+        so the replay runs as fast as possible. With 'skip_gaps' no
+        LOOP packets are created for intervals without replies.
+    """
+
+    class _Engine(object):
+        """ the parts of the WeeWX engine AirqService needs """
+        def __init__(self, stn_info):
+            self.stn_info = stn_info
+        def bind(self, event_type, callback):
+            pass
+
+    def __init__(self, config_dict, loop_interval=2.0, usUnits=None, callback=None, skip_gaps=False):
+        import weewx.station
+        import copy
+        config_dict = copy.deepcopy(config_dict)
+        config_dict['airQ']['source'] = 'replay'
+        # do not touch the files and databases of the running service
+        for key in ('snapshot_file','rollup_binding','profile_dir','config_cache'):
+            config_dict['airQ'].pop(key,None)
+        engine = AirqReplay._Engine(weewx.station.StationInfo(**config_dict.get('Station',{})))
+        self.clock = AirqVirtualClock()
+        self.service = AirqService(engine, config_dict)
+        self.service.clock = self.clock
+        self.loop_interval = loop_interval
+        self.usUnits = usUnits if usUnits is not None else weewx.METRIC
+        self.callback = callback
+        self.skip_gaps = skip_gaps
+
+    def run(self, path):
+        """ replay the recording in 'path', returns statistics """
+        with open(path) as file:
+            return self.feed(self._read_recording(file))
+
+    @staticmethod
+    def _read_recording(file):
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+    def feed(self, records):
+        """ replay the records in order of time, returns statistics
+        
+            The records are dicts with the keys 'device', 'ts' and
+            'reply', or 'device' and 'config', like in a recording.
+        """
+        stats = {'replies':0,'packets':0,'start':None,'stop':None}
+        wall_start = time.time()
+        next_loop = None
+        pending = 0
+        for rec in records:
+            dev = rec.get('device')
+            if dev not in self.service.threads: continue
+            if 'config' in rec:
+                self.service.set_device_config(dev, rec['config'])
+                continue
+            ts = rec['ts']
+            if next_loop is None:
+                stats['start'] = ts
+                next_loop = (int(ts/self.loop_interval)+1)*self.loop_interval
+            while ts>next_loop:
+                if self.skip_gaps and not pending:
+                    next_loop = (int(ts/self.loop_interval)+1)*self.loop_interval
+                    break
+                self._loop(next_loop)
+                stats['packets'] += 1
+                next_loop += self.loop_interval
+                pending = 0
+            self.service.threads[dev]['queue'].put(rec['reply'])
+            stats['replies'] += 1
+            pending += 1
+        if next_loop is not None:
+            self._loop(next_loop)
+            stats['packets'] += 1
+            stats['stop'] = next_loop
+        stats['wall_time'] = time.time()-wall_start
+        self.service.shutDown()
+        return stats
+
+    def _loop(self, ts):
+        """ create a LOOP packet and augment it with the airQ readings """
+        self.clock.set(ts)
+        event = weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime':int(ts),'usUnits':self.usUnits})
+        self.service.new_loop_packet(event)
+        if self.callback:
+            self.callback(event.packet)
+
+
 ##############################################################################
 #   prep_services: augment units.py                                          #
 ##############################################################################
@@ -683,12 +3338,15 @@ class AirqUnits(StdService):
 
         if 'airQ' in config_dict:
             for device in config_dict['airQ'].sections:
-                self._augment_obs_group_dict(device, config_dict['airQ'][device].get('prefix'))
+                self._augment_obs_group_dict(device, config_dict['airQ'][device].get('prefix'),
+                    AirqService.obs_selection(config_dict['airQ'][device],config_dict['airQ'],
+                        config_dict['airQ'].get('derived_obs','loop').lower()=='lazy')[0])
 
-    def _augment_obs_group_dict(self, device, prefix):
+    def _augment_obs_group_dict(self, device, prefix, emit=None):
         """ set units for observation types """
         log_dict = {}
         for ii in AirqService.AIRQ_DATA:
+            if emit is not None and ii not in emit: continue
             _obs_conf = AirqService.AIRQ_DATA[ii]
             if _obs_conf and _obs_conf[2] is not None:
                 weewx_key = AirqService.obstype_with_prefix(_obs_conf[0],prefix)
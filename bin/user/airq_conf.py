@@ -12,8 +12,12 @@ from __future__ import with_statement
 
 # modules for WeeWX access
 import weewx
+import weewx.manager
+import weewx.units
 import weecfg.database
-from weeutil.weeutil import y_or_n
+from weeutil.weeutil import y_or_n, to_float
+import weeutil.weeutil
+import weeutil.logger
 import weedb
 
 import user.airQ_corant
@@ -21,6 +25,7 @@ import configobj
 import optparse
 import os.path
 import shutil
+import collections
 
 # modules for airQ access
 import base64
@@ -33,19 +38,32 @@ import six
 
 usage = """airq_conf --help
        airq_conf --device=DEVICE --print-config
+       airq_conf [--device=DEVICE] --check [--samples=N] [--deadline=SECONDS] [--format=table|json]
        airq_conf --device=DEVICE --add-columns
        airq_conf --device=DEVICE --drop-columns
-       airq_conf --device=DEVICE --set-location=station
-       airq_conf --device=DEVICE --set-location=LATITUDE,LOGITUDE
-       airq_conf --device=DEVICE --set-roomsize=HEIGHT,AREA
-       airq_conf [--device=DEVICE] --set-ntp=NTP_SERVER
-       airq_conf --create-skin"""
+       airq_conf --device=DEVICES --set-location=station [--parallel=N] [--timeout=SECONDS]
+       airq_conf --device=DEVICES --set-location=LATITUDE,LOGITUDE
+       airq_conf --device=DEVICES --set-roomsize=HEIGHT,AREA
+       airq_conf [--device=DEVICES] --set-ntp=NTP_SERVER
+       airq_conf --create-skin
+       airq_conf --broker
+       airq_conf --replay=FILE [--loop-interval=SECONDS]
+       airq_conf --benchmark [--processes=N] [--duration=SECONDS]
+       airq_conf --rollup-backfill [--binding=BINDING_NAME]
+       airq_conf --device=DEVICE --export [--from=DATE] [--to=DATE] [--format=csv|jsonl]
+                 [--output=FILE] [--unit-system=US|METRIC|METRICWX]
+       airq_conf --device=DEVICE --import=FILE|DIRECTORY [--import=...]
+       airq_conf --device=DEVICE --recalc [--from=DATE] [--to=DATE]"""
         
 epilog = """NOTE: MAKE A BACKUP OF YOUR DATABASE BEFORE USING THIS UTILITY!
 Many of its actions are irreversible!"""
 
 headers = {'Content-type': 'application/x-www-form-urlencoded'}
 
+# defaults for writing config data into several devices
+CONFIG_PARALLEL = 8
+CONFIG_TIMEOUT = 10.0
+
 NTP_SERVERS = {
     'default':'pool.ntp.org',
     'ntp':'pool.ntp.org',
@@ -69,20 +87,30 @@ def airQrequest(data, passwd):
     msgb64 = base64.b64encode(crypt).decode('utf-8')
     return msgb64
 
-def airQput(host, page, passwd, data):
+def airQput(host, page, passwd, data, timeout=None):
+    """ post data to airQ, reply like airQget() """
+    connection = None
     try:
-        connection = http.client.HTTPConnection(host)
+        if timeout:
+            connection = http.client.HTTPConnection(host, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(host)
         connection.request("POST", page, "request="+airQrequest(data,passwd),headers)
         _response = connection.getresponse()
         if _response.status==200:
             reply = user.airQ_corant.airQreply(_response.read(), passwd)
         else:
             reply = {'content':{}}
-    except Exception as e:
-        print(e)
-        reply = None
+        reply['replystatus'] = _response.status
+        reply['replyreason'] = _response.reason
+    except (http.client.HTTPException,OSError,ValueError) as e:
+        # ValueError: invalid reply, possibly wrong password
+        reply = {
+            'replystatus': 503,
+            'replyreason': "%s %s" % (e.__class__.__name__,e),
+            'content': {}}
     finally:
-        connection.close()
+        if connection: connection.close()
     return reply
 
 
@@ -95,7 +123,7 @@ def main():
     # options
     
     parser.add_option("--device", type=str, metavar="DEVICE",
-                       help="airQ device as defined in weewx.conf")
+                       help="airQ device as defined in weewx.conf, for --check and --set-... also a comma separated list or 'all'")
                        
     parser.add_option("--config", dest="config_path", type=str,
                       metavar="CONFIG_FILE",
@@ -109,6 +137,18 @@ def main():
     parser.add_option("--print-config", action="store_true",
                       help="Get the config from the airQ device and print")
                       
+    parser.add_option("--check", action="store_true",
+                      help="contact all the devices concurrently and report their state and response times")
+
+    parser.add_option("--samples", type=int, metavar="N", default=5,
+                      help="number of /data requests per device for --check. Default is 5.")
+
+    parser.add_option("--deadline", type=float, metavar="SECONDS", default=20.0,
+                      help="time limit for --check. Default is 20 seconds.")
+
+    parser.add_option("--format", dest="format", type=str, metavar="FORMAT",
+                      help="output format, 'table' or 'json' for --check, 'csv' or 'jsonl' for --export")
+                      
     parser.add_option("--add-columns",action="store_true",
                        help="add columns to the WeeWX database")
                        
@@ -123,10 +163,59 @@ def main():
                       
     parser.add_option("--set-ntp", dest="ntp", type=str, metavar="NTP_SERVER",
                       help="write NTP server address to use into the airQ device")
+
+    parser.add_option("--parallel", type=int, metavar="N", default=CONFIG_PARALLEL,
+                      help="number of devices to configure at the same time. Default is %s." % CONFIG_PARALLEL)
+
+    parser.add_option("--timeout", type=float, metavar="SECONDS", default=CONFIG_TIMEOUT,
+                      help="timeout of each request to a device for --set-... Default is %s seconds." % CONFIG_TIMEOUT)
     
     parser.add_option("--create-skin", action="store_true",
                       help="create a simple skin with all the devices configured")
                       
+    parser.add_option("--broker", action="store_true",
+                      help="poll the devices and publish the readings to other instances of WeeWX")
+                      
+    parser.add_option("--replay", dest="replay", type=str, metavar="FILE",
+                      help="feed replies recorded by option 'record_file' into the service")
+
+    parser.add_option("--loop-interval", dest="loop_interval", type=float, 
+                      metavar="SECONDS", default=2.0,
+                      help="LOOP packet interval for --replay. Default is 2 seconds.")
+                      
+    parser.add_option("--benchmark", action="store_true",
+                      help="compare polling the devices by threads and by processes")
+
+    parser.add_option("--processes", type=int, metavar="N", default=2,
+                      help="number of processes for --benchmark. Default is 2.")
+
+    parser.add_option("--duration", type=float, metavar="SECONDS", default=60.0,
+                      help="duration of each --benchmark run. Default is 60 seconds.")
+                      
+    parser.add_option("--rollup-backfill", dest="rollup_backfill", action="store_true",
+                      help="build the rollup store out of the archive")
+                      
+    parser.add_option("--export", action="store_true",
+                      help="export the readings of a device out of the database")
+
+    parser.add_option("--from", dest="from_date", type=str, metavar="DATE",
+                      help="start of the time span, YYYY-MM-DD or YYYY-MM-DDTHH:MM. Default is the first record.")
+
+    parser.add_option("--to", dest="to_date", type=str, metavar="DATE",
+                      help="end of the time span, YYYY-MM-DD or YYYY-MM-DDTHH:MM. Default is the last record.")
+
+    parser.add_option("--output", type=str, metavar="FILE",
+                      help="output file for --export, compressed if ending in '.gz', '-' for stdout. Default is DEVICE.FORMAT.gz")
+
+    parser.add_option("--unit-system", dest="unit_system", type=str, metavar="UNIT_SYSTEM",
+                      help="unit system for --export. Default is the unit system of the database.")
+
+    parser.add_option("--import", dest="import_files", action="append", metavar="FILE",
+                      help="import readings of a device out of CSV or JSON files into the database, can be given more than once")
+
+    parser.add_option("--recalc", action="store_true",
+                      help="recalculate the derived readings of a device in the database")
+                      
     (options, args) = parser.parse_args()
     
     # get config_dict to use
@@ -142,14 +231,30 @@ def main():
     
     if options.print_config:
         printConfig(config_path,config_dict,device)
+    elif options.check:
+        checkDevices(config_dict, device, options.samples, options.deadline, options.format)
     elif options.location:
-        setLocation(config_dict,device,options.location)
+        setLocation(config_dict,device,options.location,options.parallel,options.timeout)
     elif options.roomsize:
-        setRoomsize(config_dict,device,options.roomsize)
+        setRoom(config_dict,device,options.roomsize,options.parallel,options.timeout)
     elif options.ntp:
-        setNTP(config_dict,device,options.ntp)
+        setNTP(config_dict,device,options.ntp,options.parallel,options.timeout)
     elif options.create_skin:
         createSkin(config_path,config_dict, db_binding)
+    elif options.broker:
+        runBroker(config_dict)
+    elif options.replay:
+        replay(config_dict, options.replay, options.loop_interval)
+    elif options.benchmark:
+        benchmark(config_dict, options.processes, options.duration, options.loop_interval)
+    elif options.rollup_backfill:
+        rollupBackfill(config_dict, db_binding)
+    elif options.export:
+        export(config_dict, db_binding, device, options.format, options.from_date, options.to_date, options.output, options.unit_system)
+    elif options.import_files:
+        importFiles(config_dict, db_binding, device, options.import_files)
+    elif options.recalc:
+        recalc(config_dict, db_binding, device, options.from_date, options.to_date)
     else:
         addDropColumns(config_dict, db_binding, device, action_add, action_drop)
 
@@ -174,6 +279,106 @@ def printConfig(config_path,config_dict, device):
                 printConfig(config_path,config_dict,dev)
                 print()
 
+def _checkDevice(conf, samples, deadline):
+    """ contact one device and measure response times """
+    import time
+    result = {
+        'host': conf.get('host'),
+        'prefix': conf.get('prefix'),
+        'ok': 0,
+        'errors': 0,
+        'last_error': None,
+        'connect': [],
+        'response': [],
+        'decrypt': []}
+    def _get(page):
+        timeout = deadline-time.time()
+        if timeout<=0:
+            raise TimeoutError("deadline exceeded")
+        timing = {}
+        try:
+            reply = user.airQ_corant.airQget(conf.get('host'),page,conf.get('password'),timeout=timeout,timing=timing)
+        except ValueError as e:
+            # invalid reply, possibly wrong password
+            reply = {'replystatus':500,'replyreason':"invalid reply %s" % e,'content':{}}
+        except Exception as e:
+            reply = {'replystatus':500,'replyreason':"%s %s" % (e.__class__.__name__,e),'content':{}}
+        if reply['replystatus']==200:
+            result['ok'] += 1
+            for key in ('connect','response','decrypt'):
+                if key in timing: result[key].append(timing[key])
+        else:
+            result['errors'] += 1
+            result['last_error'] = "%s - %s" % (reply['replystatus'],reply['replyreason'])
+        return reply
+    timestamps = []
+    try:
+        devconf = _get('/config').get('content',{})
+        result['id'] = devconf.get('id')
+        result['firmware'] = devconf.get('air-Q-Software-Version')
+        result['sensors'] = devconf.get('sensors')
+        result['ppb&ppm'] = devconf.get('ppb&ppm')
+        result['RoomType'] = devconf.get('RoomType')
+        for ii in range(samples):
+            if ii: time.sleep(min(1.0,max(deadline-time.time(),0)))
+            ts = _get('/data').get('content',{}).get('timestamp')
+            if ts and ts not in timestamps: timestamps.append(ts)
+    except TimeoutError:
+        result['errors'] += 1
+        result['last_error'] = "deadline exceeded"
+    except Exception as e:
+        # Report the failed check of this device instead of aborting
+        # the check of all the others.
+        result['errors'] += 1
+        result['last_error'] = "%s %s" % (e.__class__.__name__,e)
+    # The timestamp is in milliseconds.
+    diffs = sorted([(timestamps[ii]-timestamps[ii-1])/1000.0 for ii in range(1,len(timestamps))])
+    result['cadence'] = diffs[len(diffs)//2] if diffs else None
+    for key in ('connect','response','decrypt'):
+        vals = result[key]
+        result[key] = {
+            'min': min(vals) if vals else None,
+            'avg': sum(vals)/len(vals) if vals else None,
+            'max': max(vals) if vals else None}
+    return result
+
+def checkDevices(config_dict, device, samples, deadline, fmt):
+    """ contact the devices concurrently and report their state """
+    import concurrent.futures
+    import time
+    conf = config_dict.get('airQ',{})
+    devices = _devices(config_dict, device if device else 'all')
+    if not devices:
+        print("no device found")
+        return
+    end = time.time()+deadline
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(devices),32)) as executor:
+        futures = {executor.submit(_checkDevice,conf[dev],samples,end):dev for dev in devices}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    if fmt=='json':
+        print(json.dumps(results,indent=4))
+        return
+    def _ms(x):
+        return "%.0f" % (x*1000) if x is not None else "-"
+    print("%-15s %-20s %5s %5s %8s %8s %8s %-8s %7s %-7s %-12s %7s" % (
+        "device","host","ok","err","conn ms","resp ms","decr ms",
+        "firmware","sensors","ppb&ppm","RoomType","cadence"))
+    for dev in devices:
+        rs = results[dev]
+        print("%-15s %-20s %5s %5s %8s %8s %8s %-8s %7s %-7s %-12s %7s" % (
+            dev,rs['host'],rs['ok'],rs['errors'],
+            _ms(rs['connect']['avg']),_ms(rs['response']['avg']),_ms(rs['decrypt']['avg']),
+            rs.get('firmware') or '-',
+            len(rs['sensors']) if rs.get('sensors') else '-',
+            rs.get('ppb&ppm') if rs.get('ppb&ppm') is not None else '-',
+            rs.get('RoomType') or '-',
+            "%.1f s" % rs['cadence'] if rs['cadence'] else '-'))
+    for dev in devices:
+        if results[dev]['last_error']:
+            print("device '%s': %s" % (dev,results[dev]['last_error']))
+
 def _printDict(reply, indent):
     """ print dict with indent """
     for key in reply:
@@ -215,10 +420,28 @@ def addDropColumns(config_dict, db_binding, device, action_add, action_drop):
                     schema = manager_dict.get('schema',{}).get('table',[])
                 except AttributeError:
                     schema = manager_dict.get('schema',[])
+                # In 'lazy' mode derived observation types are calculated
+                # on request and need not be saved to the database.
+                derived_keys = []
+                if action_add and config_dict['airQ'].get('derived_obs','loop').lower()=='lazy':
+                    reply = user.airQ_corant.airQget(conf.get('host'),'/config',conf.get('password'))
+                    if reply['replystatus']==200:
+                        derived_keys = user.airQ_corant.AirqService.derived_keys(reply['content'].get('ppb&ppm',False))
+                    else:
+                        print("could not read config out of the device, add all volume and mass columns")
+                        derived_keys = ['altimeter','barometer']
+                # only the readings selected by 'include' and 'exclude'
+                if action_add:
+                    emit = user.airQ_corant.AirqService.obs_selection(conf,config_dict['airQ'],
+                        config_dict['airQ'].get('derived_obs','loop').lower()=='lazy')[0]
+                else:
+                    emit = None
                 # determine columns to add or drop
                 cols = []
                 ocls = []
                 for ii in airq_data:
+                    if ii in derived_keys: continue
+                    if emit is not None and ii not in emit: continue
                     if airq_data[ii] is not None and airq_data[ii][0] is not None and ii not in user.airQ_corant.AirqService.ACCUM_LAST:
                         __col = user.airQ_corant.AirqService.obstype_with_prefix(airq_data[ii][0],prefix)
                         if __col in [col[0] for col in schema]:
@@ -293,7 +516,23 @@ def enumColumns(config_dict, db_binding, cols):
     return existing_cols
 
 
-def setLocation(config_dict, device, loc):
+def _devices(config_dict, device):
+    """ device names out of option --device: a name, a comma separated 
+        list of names, or 'all' """
+    conf = config_dict.get('airQ',{})
+    if not device:
+        return []
+    if device=='all':
+        names = conf.sections
+    else:
+        names = [dev.strip() for dev in device.split(',') if dev.strip()]
+    for dev in names:
+        if dev not in conf.sections:
+            print("device '%s' not found in section [airQ]" % dev)
+            return []
+    return [dev for dev in names if 'host' in conf[dev] and 'password' in conf[dev]]
+
+def setLocation(config_dict, device, loc, parallel=CONFIG_PARALLEL, timeout=CONFIG_TIMEOUT):
     """ set location """
     if loc=="station":
         stn_info = config_dict.get('Station',{})
@@ -304,41 +543,618 @@ def setLocation(config_dict, device, loc):
         lat = float(_loc[0])
         lon = float(_loc[1])
     data = { 'geopos': { 'lat':lat, 'long':lon }}
-    setConfig(config_dict, device, data)
+    setConfig(config_dict, device, data, parallel, timeout)
 
-def setRoom(config_dict, device, roomsize):
+def setRoom(config_dict, device, roomsize, parallel=CONFIG_PARALLEL, timeout=CONFIG_TIMEOUT):
     """ set room size parameters """
     _size = roomsize.split(',')
     data = { 'RoomHeight':float(_size[0]),'RoomArea':float(_size[1]) }
-    setConfig(config_dict, device, data)
+    setConfig(config_dict, device, data, parallel, timeout)
 
-def setNTP(config_dict, device, ntp):
+def setNTP(config_dict, device, ntp, parallel=CONFIG_PARALLEL, timeout=CONFIG_TIMEOUT):
     """ set NTP server for the airQ device """
     if ntp.lower() in NTP_SERVERS:
         ntp = NTP_SERVERS[ntp.lower()]
     data = { 'TimeServer': ntp }
-    if device:
-        setConfig(config_dict, device, data)
+    setConfig(config_dict, device if device else 'all', data, parallel, timeout)
+
+def _sameConfig(wanted, actual):
+    """ check whether the device took over the value """
+    if isinstance(wanted,dict):
+        return isinstance(actual,dict) and all(_sameConfig(wanted[key],actual.get(key)) for key in wanted)
+    if isinstance(wanted,float):
+        # The device may round the value.
+        try:
+            return abs(wanted-float(actual))<=1e-4*max(abs(wanted),1.0)
+        except (TypeError,ValueError):
+            return False
+    return wanted==actual
+
+def _setDeviceConfig(conf, data, timeout):
+    """ write config data into one device and read it back """
+    import time
+    start = time.time()
+    result = {'host':conf['host'],'result':'failed','message':None}
+    reply = airQput(conf['host'],"/config",conf['password'],data,timeout=timeout)
+    if reply['replystatus']!=200:
+        result['message'] = "write: %s - %s" % (reply['replystatus'],reply['replyreason'])
     else:
-        conf = config_dict.get('airQ',{})
-        for dev in conf:
-            if isinstance(conf[dev],dict) and 'host' in conf[dev] and 'password' in conf[dev]:
-                setConfig(config_dict, dev, data)
-
-def setConfig(config_dict, device, data):
-    """ write config data into the airQ device """
-    if device:
-        conf = config_dict.get('airQ',{}).get(device)
-        if conf is None:
-            print("device '%s' not found in '%s'" % (device,config_path))
+        reply = user.airQ_corant.airQget(conf['host'],"/config",conf['password'],timeout=timeout)
+        if reply['replystatus']!=200:
+            result['result'] = 'written'
+            result['message'] = "read back: %s - %s" % (reply['replystatus'],reply['replyreason'])
         else:
-            print("device '%s' host '%s' set %s" % (device,conf['host'],data))
-            ans = y_or_n("Are you sure you want to proceed (y/n)?")
-            if ans=='y':
-                reply = airQput(conf['host'],"/config",conf['password'],data)
-                _printDict(reply,0)
-    else:
+            devconf = reply.get('content',{})
+            wrong = [key for key in data if not _sameConfig(data[key],devconf.get(key))]
+            if wrong:
+                result['result'] = 'mismatch'
+                result['message'] = "device reports %s" % ', '.join(["%s=%s" % (key,devconf.get(key)) for key in wrong])
+            else:
+                result['result'] = 'verified'
+    result['duration'] = time.time()-start
+    return result
+
+def setConfig(config_dict, device, data, parallel=CONFIG_PARALLEL, timeout=CONFIG_TIMEOUT):
+    """ write config data into the airQ devices concurrently """
+    import concurrent.futures
+    if not device:
         print("option --device=DEVICE missing")
+        return
+    conf = config_dict.get('airQ',{})
+    devices = _devices(config_dict, device)
+    if not devices:
+        print("no device found")
+        return
+    for dev in devices:
+        print("device '%s' host '%s'" % (dev,conf[dev]['host']))
+    print("set %s" % data)
+    ans = y_or_n("Are you sure you want to proceed (y/n)?")
+    if ans!='y': return
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(len(devices),parallel),1)) as executor:
+        futures = {executor.submit(_setDeviceConfig,conf[dev],data,timeout):dev for dev in devices}
+        for future in concurrent.futures.as_completed(futures):
+            dev = futures[future]
+            results[dev] = future.result()
+            print("device '%s': %s" % (dev,results[dev]['result']))
+    print()
+    print("%-15s %-20s %-9s %7s  %s" % ("device","host","result","time","message"))
+    for dev in devices:
+        rs = results[dev]
+        print("%-15s %-20s %-9s %5.1f s  %s" % (dev,rs['host'],rs['result'],rs['duration'],rs['message'] or ''))
+    counts = collections.Counter([results[dev]['result'] for dev in devices])
+    print("%s devices: %s" % (len(devices),', '.join(["%s %s" % (counts[ii],ii) for ii in ('verified','mismatch','written','failed') if counts[ii]])))
+
+
+def runBroker(config_dict):
+    """ poll the devices and publish the readings by Unix domain socket """
+    weeutil.logger.setup('airq_conf', config_dict)
+    broker = user.airQ_corant.AirqBroker(config_dict)
+    print("publishing readings of %s devices at '%s'" % (len(broker.devices),broker.socket_path))
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        broker.shutDown()
+
+
+def replay(config_dict, path, loop_interval):
+    """ feed recorded replies into the service """
+    print("replaying '%s', LOOP packet interval %.1f s" % (path,loop_interval))
+    rp = user.airQ_corant.AirqReplay(config_dict, loop_interval)
+    stats = rp.run(path)
+    print("replies:      %s" % stats['replies'])
+    print("LOOP packets: %s" % stats['packets'])
+    if stats['start'] is not None:
+        print("time span:    %.0f s" % (stats['stop']-stats['start']))
+    print("wall time:    %.3f s" % stats['wall_time'])
+    if stats['packets']:
+        print("per packet:   %.3f ms" % (stats['wall_time']*1000/stats['packets']))
+
+
+def benchmark(config_dict, processes, duration, loop_interval):
+    """ compare polling by threads and by processes """
+    import copy
+    import time
+    import weewx.station
+    engine = user.airQ_corant.AirqReplay._Engine(
+        weewx.station.StationInfo(**config_dict.get('Station',{})))
+    results = []
+    for procs in (0, processes):
+        conf = copy.deepcopy(config_dict)
+        conf['airQ']['processes'] = procs
+        for key in ('record_file','snapshot_file','shm_file','rollup_binding'):
+            conf['airQ'].pop(key,None)
+        print("polling by %s for %.0f s..." % ("threads" if procs==0 else "%s processes" % procs,duration))
+        srv = user.airQ_corant.AirqService(engine, conf)
+        try:
+            cpu_start = time.process_time()
+            start = time.time()
+            while time.time()<start+duration:
+                time.sleep(loop_interval)
+                event = weewx.Event(weewx.NEW_LOOP_PACKET, packet={'dateTime':int(time.time()),'usUnits':weewx.METRIC})
+                srv.new_loop_packet(event)
+            cpu = time.process_time()-cpu_start
+            replies = sum([srv.threads[ii]['aggregator'].replies for ii in srv.threads])
+        finally:
+            srv.shutDown()
+        results.append((procs,replies,cpu))
+    print()
+    print("%-12s %10s %12s %20s" % ("mode","replies/s","CPU WeeWX","CPU ms per reply"))
+    for procs, replies, cpu in results:
+        print("%-12s %10.1f %11.2fs %20.3f" % (
+            "threads" if procs==0 else "%s processes" % procs,
+            replies/duration, cpu, cpu*1000/replies if replies else 0))
+
+
+def rollupBackfill(config_dict, db_binding):
+    """ build the rollup store out of the archive """
+    import weeutil.weeutil
+    rollup_binding = config_dict['airQ'].get('rollup_binding')
+    if not rollup_binding:
+        print("option 'rollup_binding' missing in section [airQ]")
+        return
+    rollup = user.airQ_corant.AirqRollup(config_dict, rollup_binding,
+        user.airQ_corant.AirqRollup.obs_types_from_config(config_dict),
+        to_float(config_dict['airQ'].get('rollup_keep_days',14)))
+    with weewx.manager.open_manager_with_config(config_dict, db_binding) as dbmanager:
+        # only the columns that are in the database
+        rollup.obs_types &= set(dbmanager.sqlkeys)
+        print("observation types: %s" % ", ".join(sorted(rollup.obs_types)))
+        first = dbmanager.firstGoodStamp()
+        last = dbmanager.lastGoodStamp()
+        if first is None:
+            print("no records in the database")
+            rollup.close()
+            return
+        ans = y_or_n("The rollup store will be rebuilt. Continue? (y/n): ")
+        if ans!='y':
+            rollup.close()
+            return
+        rollup.drop_tables()
+        records = 0
+        # one day at a time, so that each daily bucket is written once
+        for span in weeutil.weeutil.genDaySpans(first-1, last):
+            batch = list(dbmanager.genBatchRecords(span.start, span.stop))
+            rollup.add_records(batch)
+            records += len(batch)
+            print("%s: %s records" % (weeutil.weeutil.timestamp_to_string(span.start),len(batch)), end='\r')
+        rollup.last_prune = 0
+        rollup.prune(last)
+        rollup.close()
+    print()
+    print("%s records processed" % records)
+
+
+# number of records read at once by --export
+EXPORT_CHUNK = 1000
+
+def _parse_date(date, end=False):
+    """ convert YYYY-MM-DD or YYYY-MM-DDTHH:MM local time to timestamp 
+    
+        With 'end' set, a date without time means the end of that day,
+        so that the day is included.
+    """
+    import time
+    for fmt in ('%Y-%m-%dT%H:%M','%Y-%m-%d'):
+        try:
+            tt = time.strptime(date,fmt)
+        except ValueError:
+            continue
+        if end and fmt=='%Y-%m-%d':
+            # start of the next day, mktime() normalizes the day
+            return int(time.mktime((tt.tm_year,tt.tm_mon,tt.tm_mday+1,0,0,0,0,0,-1)))
+        return int(time.mktime(tt))
+    raise ValueError("invalid date '%s'" % date)
+
+def export(config_dict, db_binding, device, fmt, from_date, to_date, output, unit_system):
+    """ export the readings of a device chunk by chunk """
+    import csv
+    import gzip
+    import sys
+    conf = config_dict.get('airQ',{}).get(device)
+    if conf is None:
+        print("option '--device=DEVICE' is mandatory, and the device must be defined in section [airQ]", file=sys.stderr)
+        return
+    if fmt is None: fmt = 'csv'
+    if fmt not in ('csv','jsonl'):
+        print("unknown format '%s'" % fmt, file=sys.stderr)
+        return
+    if unit_system:
+        if unit_system.upper() not in weewx.units.unit_constants:
+            print("unknown unit system '%s'" % unit_system, file=sys.stderr)
+            return
+        target = weewx.units.unit_constants[unit_system.upper()]
+    else:
+        target = None
+    airq_data = user.airQ_corant.AirqService.AIRQ_DATA
+    prefix = conf.get('prefix')
+    with weewx.manager.open_manager_with_config(config_dict, db_binding) as dbmanager:
+        # the columns of the device that are in the database
+        cols = []
+        for key in airq_data:
+            if airq_data[key] is None: continue
+            col = obstype_with_prefix(airq_data[key][0],prefix)
+            if col in dbmanager.sqlkeys and col not in cols:
+                cols.append(col)
+        if not cols:
+            print("no columns of device '%s' in the database" % device, file=sys.stderr)
+            return
+        first = dbmanager.firstGoodStamp()
+        if first is None:
+            print("no records in the database", file=sys.stderr)
+            return
+        start = _parse_date(from_date) if from_date else first-1
+        stop = _parse_date(to_date,end=True) if to_date else dbmanager.lastGoodStamp()
+        # unit of each column
+        std_unit_system = dbmanager.std_unit_system
+        units = {}
+        for col in cols:
+            unit, group = weewx.units.getStandardUnitType(std_unit_system,col)
+            if target is not None and group:
+                units[col] = (unit, weewx.units.std_groups[target].get(group,unit), group)
+            else:
+                units[col] = (unit, unit, group)
+        if output is None:
+            output = '%s.%s.gz' % (device,fmt)
+        if output=='-':
+            file = sys.stdout
+        elif output.endswith('.gz'):
+            file = gzip.open(output,'wt',newline='')
+        else:
+            file = open(output,'w',newline='')
+        print("exporting %s columns of device '%s' to '%s'" % (len(cols),device,output), file=sys.stderr)
+        try:
+            if fmt=='csv':
+                writer = csv.writer(file)
+                writer.writerow(['dateTime']+['%s [%s]' % (col,units[col][1]) if units[col][1] else col for col in cols])
+            sql = "SELECT dateTime, usUnits, %s FROM %s WHERE dateTime>? AND dateTime<=? ORDER BY dateTime LIMIT %s" % (
+                ', '.join(['`%s`' % col for col in cols]),dbmanager.table_name,EXPORT_CHUNK)
+            records = 0
+            # Read chunk by chunk, starting after the last timestamp of
+            # the previous chunk, so that memory usage is bounded even
+            # if the database driver fetches the whole result set.
+            while start<stop:
+                rows = list(dbmanager.genSql(sql,(start,stop)))
+                if not rows: break
+                for row in rows:
+                    if row[1]!=std_unit_system:
+                        raise weewx.UnsupportedFeature("unit system changed at %s" % row[0])
+                    vals = []
+                    for col, val in zip(cols,row[2:]):
+                        if val is not None and units[col][0]!=units[col][1]:
+                            val = weewx.units.convert((val,units[col][0],units[col][2]),units[col][1])[0]
+                        vals.append(val)
+                    if fmt=='csv':
+                        writer.writerow([row[0]]+['' if val is None else val for val in vals])
+                    else:
+                        rec = {'dateTime':row[0],'usUnits':target if target is not None else row[1]}
+                        rec.update({col:val for col, val in zip(cols,vals) if val is not None})
+                        file.write(json.dumps(rec)+'\n')
+                records += len(rows)
+                start = rows[-1][0]
+                print("%s: %s records" % (weeutil.weeutil.timestamp_to_string(start),records), end='\r', file=sys.stderr)
+        finally:
+            if file is not sys.stdout:
+                file.close()
+    print("", file=sys.stderr)
+    print("%s records exported" % records, file=sys.stderr)
+
+
+# number of archive records written in one transaction by --import
+IMPORT_BATCH = 5000
+
+def _import_value(key, text):
+    """ convert a CSV field to the form of the device reply """
+    try:
+        val = float(text)
+    except ValueError:
+        return text
+    # Most of the readings are lists of value and error margin 
+    # within the device reply.
+    xx = user.airQ_corant.AirqService.AIRQ_DATA.get(key)
+    if xx:
+        try:
+            if not isinstance(xx[3]([val]),list): return [val]
+        except (TypeError,IndexError,ValueError):
+            pass
+    return val
+
+def _import_replies(path, passwd):
+    """ read the replies out of a file one by one 
+    
+        Supported are CSV files with the airQ keys as header and JSON
+        files with one reply per line, plain or encrypted as on the
+        SD card of the device, or as recorded by option 'record_file'.
+        Yields timestamp in seconds and reply.
+    """
+    import csv
+    import gzip
+    if path.endswith('.gz'):
+        file = gzip.open(path,'rt',newline='')
+        path = path[:-3]
+    else:
+        file = open(path,'r',newline='')
+    with file:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(file):
+                try:
+                    if row.get('timestamp'):
+                        ts = int(float(row.pop('timestamp')))
+                    else:
+                        ts = int(float(row.pop('dateTime'))*1000)
+                except (KeyError,ValueError,TypeError):
+                    continue
+                reply = {key:_import_value(key,val) for key, val in row.items() if key and val not in (None,'')}
+                reply['timestamp'] = ts
+                yield ts/1000.0, reply
+        else:
+            for line in file:
+                line = line.strip()
+                if not line: continue
+                try:
+                    reply = json.loads(line)
+                except ValueError:
+                    # encrypted line of the SD card
+                    try:
+                        reply = user.airQ_corant.airQreply(json.dumps({'content':line}),passwd)['content']
+                    except (ValueError,TypeError,KeyError,IndexError,UnicodeDecodeError):
+                        continue
+                if not isinstance(reply,dict): continue
+                # recording of option 'record_file'
+                if 'reply' in reply: reply = reply['reply']
+                try:
+                    yield reply['timestamp']/1000.0, reply
+                except (KeyError,ValueError,TypeError):
+                    continue
+
+def _import_write(dbmanager, batch, stats):
+    """ merge a batch of records into the archive in one transaction 
+    
+        Existing records get the airQ readings in columns that are
+        empty so far, the other columns are not touched.
+    """
+    table = dbmanager.table_name
+    with weedb.Transaction(dbmanager.connection) as cursor:
+        cursor.execute("SELECT dateTime FROM %s WHERE dateTime>=? AND dateTime<=?" % table,
+            (batch[0]['dateTime'],batch[-1]['dateTime']))
+        existing = set([row[0] for row in cursor])
+        for rec in batch:
+            cols = [col for col in rec if col in dbmanager.sqlkeys and rec[col] is not None
+                    and col not in ('dateTime','usUnits','interval')]
+            if not cols: continue
+            vals = [rec[col] for col in cols]
+            if rec['dateTime'] in existing:
+                cursor.execute("UPDATE %s SET %s WHERE dateTime=?" % (table,
+                    ', '.join(['`%s`=COALESCE(`%s`,?)' % (col,col) for col in cols])),
+                    vals+[rec['dateTime']])
+                stats['updated'] += 1
+            else:
+                cursor.execute("INSERT INTO %s (`dateTime`, `usUnits`, `interval`, %s) VALUES (%s)" % (table,
+                    ', '.join(['`%s`' % col for col in cols]),
+                    ', '.join(['?']*(len(cols)+3))),
+                    [rec['dateTime'],rec['usUnits'],rec['interval']]+vals)
+                stats['inserted'] += 1
+
+def importFiles(config_dict, db_binding, device, paths):
+    """ import readings out of files into the archive """
+    import copy
+    import weeutil.weeutil
+    if not device or device not in config_dict.get('airQ',{}):
+        print("option '--device=DEVICE' is mandatory, and the device must be defined in section [airQ]")
+        return
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted([os.path.join(path,file) for file in os.listdir(path) if os.path.isfile(os.path.join(path,file))]))
+        else:
+            files.append(path)
+    interval = weeutil.weeutil.to_int(config_dict.get('StdArchive',{}).get('archive_interval',300))
+    conf = copy.deepcopy(config_dict)
+    # all the readings in every record
+    conf['airQ'].pop('loop_static',None)
+    conf['airQ'][device].pop('loop_static',None)
+    passwd = conf['airQ'][device].get('password','')
+    # The derived readings depend on the config of the device 
+    # (ppb&ppm, RoomType).
+    print("device '%s':" % device)
+    devconf = _deviceConfig(config_dict['airQ'][device], device, _configCache(config_dict))
+    if not devconf:
+        print("config data of device '%s' not available, import aborted" % device)
+        return
+    print("importing %s files for device '%s', archive interval %s s" % (len(files),device,interval))
+    ans = y_or_n("Stop WeeWX and make a backup of the database before. Continue? (y/n): ")
+    if ans!='y': return
+    stats = {'inserted':0,'updated':0,'first':None,'last':None}
+    with weewx.manager.open_manager_with_config(config_dict, db_binding) as dbmanager:
+        batch = []
+        def _record(packet):
+            # one LOOP packet per archive interval, the average of 
+            # the replies within that interval
+            packet['interval'] = interval//60
+            batch.append(packet)
+            if stats['first'] is None: stats['first'] = packet['dateTime']
+            stats['last'] = packet['dateTime']
+            if len(batch)>=IMPORT_BATCH:
+                _import_write(dbmanager, batch, stats)
+                del batch[:]
+                print("%s: %s records inserted, %s updated" % (
+                    weeutil.weeutil.timestamp_to_string(stats['last']),
+                    stats['inserted'],stats['updated']), end='\r')
+        rp = user.airQ_corant.AirqReplay(conf, interval, dbmanager.std_unit_system, _record, skip_gaps=True)
+        rp.service.set_device_config(device, devconf)
+        def _replies():
+            for file in files:
+                print("%s" % file)
+                for ts, reply in _import_replies(file,passwd):
+                    yield {'device':device,'ts':ts,'reply':reply}
+        rp.feed(_replies())
+        if batch:
+            _import_write(dbmanager, batch, stats)
+    print()
+    print("%s records inserted, %s records updated" % (stats['inserted'],stats['updated']))
+    if stats['first'] is None: return
+    _rebuildDailySummaries(config_dict, db_binding, stats['first'], stats['last'])
+
+
+def _rebuildDailySummaries(config_dict, db_binding, first, last):
+    """ rebuild the daily summaries of the days changed """
+    import datetime
+    import weeutil.weeutil
+    with weewx.manager.open_manager_with_config(config_dict, db_binding) as dbmanager:
+        if hasattr(dbmanager,'backfill_day_summary'):
+            print("rebuilding daily summaries")
+            start_d = datetime.date.fromtimestamp(weeutil.weeutil.startOfArchiveDay(first))
+            stop_d = datetime.date.fromtimestamp(weeutil.weeutil.startOfArchiveDay(last))
+            try:
+                dbmanager.backfill_day_summary(start_d=start_d, stop_d=stop_d)
+            except weewx.ViolatedPrecondition:
+                # Records were appended after the last update of the
+                # daily summaries. Bring them up to date first, then
+                # rebuild the days changed before.
+                dbmanager.backfill_day_summary()
+                dbmanager.backfill_day_summary(start_d=start_d, stop_d=stop_d)
+    if config_dict['airQ'].get('rollup_binding'):
+        print("Run 'airq_conf --rollup-backfill' to update the rollup store.")
+
+
+# number of records read and updated at once by --recalc
+RECALC_CHUNK = 5000
+
+def recalc(config_dict, db_binding, device, from_date, to_date):
+    """ recalculate the derived readings of a device in the database """
+    import copy
+    if not device or device not in config_dict.get('airQ',{}):
+        print("option '--device=DEVICE' is mandatory, and the device must be defined in section [airQ]")
+        return
+    conf = copy.deepcopy(config_dict)
+    # The derived values are calculated by AirqService.
+    conf['airQ']['derived_obs'] = 'loop'
+    print("device '%s':" % device)
+    devconf = _deviceConfig(config_dict['airQ'][device], device, _configCache(config_dict))
+    if not devconf:
+        print("config data of device '%s' not available" % device)
+        return
+    rp = user.airQ_corant.AirqReplay(conf)
+    service = rp.service
+    service.set_device_config(device, devconf)
+    dev = service.threads[device]
+    prefix = dev['prefix']
+    airq_data = user.airQ_corant.AirqService.AIRQ_DATA
+    with weewx.manager.open_manager_with_config(config_dict, db_binding) as dbmanager:
+        # derived readings to recalculate
+        keys = [key for key in service.derived_keys(dev['ppb&ppm'])
+                if obstype_with_prefix(airq_data[key][0],prefix) in dbmanager.sqlkeys
+                and (dev['emit'] is None or key in dev['emit'])]
+        if not keys:
+            print("no derived readings of device '%s' in the database" % device)
+            return
+        # base readings they are calculated from
+        base = ['pressure','temperature']
+        for key in keys:
+            gas = key[:-4] if key.endswith('_vol') else key
+            if gas in service.CONV_V_M:
+                base.append(key+'_vol' if dev['ppb&ppm'] else key[:-4])
+        cols = {key:obstype_with_prefix(airq_data[key][0],prefix) for key in base
+                if obstype_with_prefix(airq_data[key][0],prefix) in dbmanager.sqlkeys}
+        # temperature source for barometer of indoor devices
+        if 'barometer' in keys and not service.isDeviceOutdoor(device):
+            qff = dev['QFF_temperature_source']
+            if qff in dbmanager.sqlkeys: cols[qff] = qff
+        # skip the readings whose base readings are not in the database,
+        # temperature and pressure are optional for the conversion 
+        # between volume and mass
+        for key in list(keys):
+            if key=='altimeter':
+                needs = ['pressure']
+            elif key=='barometer':
+                needs = ['pressure','temperature' if service.isDeviceOutdoor(device) else dev['QFF_temperature_source']]
+            elif key.endswith('_vol'):
+                needs = [key[:-4]]
+            else:
+                needs = [key+'_vol']
+            missing = [col for col in needs if col not in cols]
+            if missing:
+                print("skipping %s, column %s not in the database" % (
+                    obstype_with_prefix(airq_data[key][0],prefix),
+                    ", ".join([obstype_with_prefix(airq_data[col][0],prefix) if col in airq_data else col for col in missing])))
+                keys.remove(key)
+        if not keys:
+            print("nothing to recalculate")
+            return
+        print("recalculating %s out of %s" % (
+            ", ".join([obstype_with_prefix(airq_data[key][0],prefix) for key in keys]),
+            ", ".join(cols.values())))
+        first = dbmanager.firstGoodStamp()
+        if first is None:
+            print("no records in the database")
+            return
+        start = _parse_date(from_date) if from_date else first-1
+        stop = _parse_date(to_date,end=True) if to_date else dbmanager.lastGoodStamp()
+        ans = y_or_n("Make a backup of the database before. Continue? (y/n): ")
+        if ans!='y': return
+        names = list(cols)
+        sql_select = "SELECT dateTime, usUnits, %s FROM %s WHERE dateTime>? AND dateTime<=? ORDER BY dateTime LIMIT %s" % (
+            ', '.join(['`%s`' % cols[key] for key in names]),dbmanager.table_name,RECALC_CHUNK)
+        sql_update = "UPDATE %s SET %s WHERE dateTime=?" % (dbmanager.table_name,
+            ', '.join(['`%s`=?' % obstype_with_prefix(airq_data[key][0],prefix) for key in keys]))
+        records = 0
+        first = None
+        # One chunk is read and then updated in one short transaction,
+        # so that WeeWX is not locked out of the database for long.
+        while start<stop:
+            rows = list(dbmanager.genSql(sql_select,(start,stop)))
+            if not rows: break
+            if user.airQ_corant.numpy is not None:
+                results = _recalc_array(service, device, keys, names, cols, rows)
+            else:
+                results = _recalc_records(service, device, keys, names, cols, rows)
+            with weedb.Transaction(dbmanager.connection) as cursor:
+                for row, vals in zip(rows,results):
+                    cursor.execute(sql_update, vals+[row[0]])
+            if first is None: first = rows[0][0]
+            records += len(rows)
+            start = rows[-1][0]
+            print("%s: %s records" % (weeutil.weeutil.timestamp_to_string(start),records), end='\r')
+    rp.service.shutDown()
+    print()
+    print("%s records recalculated" % records)
+    if first is not None:
+        _rebuildDailySummaries(config_dict, db_binding, first, start)
+
+def _recalc_array(service, device, keys, names, cols, rows):
+    """ calculate the derived readings of a chunk of records by NumPy """
+    numpy = user.airQ_corant.numpy
+    airq_data = user.airQ_corant.AirqService.AIRQ_DATA
+    usUnits = rows[0][1]
+    if any([row[1]!=usUnits for row in rows]):
+        # unit system changed within the chunk
+        return _recalc_records(service, device, keys, names, cols, rows)
+    arrays = {}
+    for idx, key in enumerate(names):
+        arr = numpy.array([row[idx+2] for row in rows],dtype=float)
+        unit = weewx.units.getStandardUnitType(usUnits,cols[key])
+        target = airq_data[key][1] if key in airq_data else 'degree_C'
+        arrays[key] = weewx.units.convert((arr,unit[0],unit[1]),target)[0]
+    results = []
+    for key in keys:
+        arr = service.calc_derived_array(device, key, arrays)
+        arr = weewx.units.convertStd((arr,airq_data[key][1],airq_data[key][2]),usUnits)[0]
+        results.append([None if val!=val else float(val) for val in arr])
+    return [list(vals) for vals in zip(*results)]
+
+def _recalc_records(service, device, keys, names, cols, rows):
+    """ calculate the derived readings record by record """
+    airq_data = user.airQ_corant.AirqService.AIRQ_DATA
+    results = []
+    for row in rows:
+        record = {'dateTime':row[0],'usUnits':row[1]}
+        record.update({cols[key]:row[idx+2] for idx, key in enumerate(names)})
+        vals = []
+        for key in keys:
+            val = service.calc_derived(device, key, record)
+            vals.append(weewx.units.convertStd((val,airq_data[key][1],airq_data[key][2]),row[1])[0])
+        results.append(vals)
+    return results
 
 
 HTML_HEAD='''<!DOCTYPE html>
@@ -373,6 +1189,36 @@ HTML_FOOT='''
 </html>
 '''
 
+# load the snapshot file written by the service and update the 
+# current values without regenerating the page
+HTML_SNAPSHOT='''
+    <script>
+      function airq_snapshot() {
+        var req = new XMLHttpRequest();
+        req.onload = function() {
+          var snap = JSON.parse(this.responseText);
+          var dev = snap.devices['%s'];
+          if (!dev) return;
+          for (var obs in dev.values) {
+            var el = document.getElementById('airq_'+obs);
+            if (!el || el.getAttribute('data-unit')) continue;
+            var val = dev.values[obs][0];
+            var unit = snap.units[dev.values[obs][1]];
+            if (val===null || !unit) continue;
+            var m = /[.]([0-9]+)f/.exec(unit.format);
+            el.textContent = (m ? val.toFixed(parseInt(m[1])) : val)+unit.label;
+          }
+          if (dev.dateTime) {
+            document.querySelector('p.lastupdate').textContent = new Date(dev.dateTime*1000).toLocaleString();
+          }
+        };
+        req.open('GET','%s?'+Date.now());
+        req.send();
+      }
+      window.setInterval(airq_snapshot,%d);
+    </script>
+'''
+
 def _check_gettext(seasons_skin_path):
     """ check whether gettext """
     with open(os.path.join(seasons_skin_path,'index.html.tmpl')) as f:
@@ -383,18 +1229,41 @@ def _check_gettext(seasons_skin_path):
                 if c in ('(','['): return c
     return '?'
 
+def _configCache(config_dict):
+    """ the config data cache of the service if configured """
+    if not config_dict['airQ'].get('config_cache'):
+        return None
+    return user.airQ_corant.AirqConfigCache(config_dict['airQ']['config_cache'],
+        to_float(config_dict['airQ'].get('config_cache_ttl',user.airQ_corant.CONFIG_CACHE_TTL)))
+
+def _deviceConfig(conf, dev, cache):
+    """ config data out of the cache if valid, otherwise out of the 
+        device """
+    devconf, valid = cache.get(dev, conf['host']) if cache else (None, False)
+    if valid:
+        print("  config data out of the cache")
+        return devconf
+    reply = user.airQ_corant.airQget(conf['host'],'/config',conf['password'],timeout=CONFIG_TIMEOUT)
+    if reply['replystatus']==200:
+        if cache: cache.put(dev, conf['host'], reply['content'])
+        return reply['content']
+    if devconf is not None:
+        print("  %s - %s, using expired config data out of the cache" % (reply['replystatus'],reply['replyreason']))
+        return devconf
+    print("  %s - %s, no config data" % (reply['replystatus'],reply['replyreason']))
+    return {}
+
 def createSkin(config_path, config_dict, db_binding):
     """ create skin """
     sensors = {}
     obstypes = {}
     RoomTypes = {}
+    cache = _configCache(config_dict)
     for dev in config_dict['airQ'].sections:
         print("device '%s':" % dev)
-        reply = user.airQ_corant.airQget(
-                       config_dict['airQ'][dev]['host'],'/config',
-                       config_dict['airQ'][dev]['password'])
-        sensors[dev] = reply['content']['sensors']
-        RoomTypes[dev] = reply['content'].get('RoomType')
+        devconf = _deviceConfig(config_dict['airQ'][dev], dev, cache)
+        sensors[dev] = devconf.get('sensors',[])
+        RoomTypes[dev] = devconf.get('RoomType')
         print("  sensors %s" % sensors[dev])
         cols = []
         for img in IMG_DICT:
@@ -474,6 +1343,10 @@ def createSkin(config_path, config_dict, db_binding):
     # as well as those listed in https://docs.python.org/3/library/codecs.html#s
     encoding = html_entities
 
+    # $airq_stats reads the statistics of all the readings of a device
+    # by one query per period
+    search_list_extensions = user.airq_stats.AirqStats
+
     [[SummaryByMonth]]
 
     [[SummaryByYear]]
@@ -490,6 +1363,17 @@ def createSkin(config_path, config_dict, db_binding):
             file.write("""        [[[%s]]]
             template = %s
 """ % (dev,template_file))
+        print("  writing section [airQ]")
+        file.write("""
+###############################################################################
+
+# Options of the tag $airq_stats
+
+[airQ]
+
+    # database binding the readings of the devices are saved in
+    data_binding = %s
+""" % db_binding)
         print("  writing section [CopyGenerator]")
         file.write("""
 ###############################################################################
@@ -507,6 +1391,11 @@ def createSkin(config_path, config_dict, db_binding):
 
 """)
         print("  writing section [ImageGenerator]")
+        # read long-range plots out of the rollup store
+        if config_dict['airQ'].get('rollup_binding'):
+            rollup_option = "        airq_rollup = true # read out of the rollup store\n\n"
+        else:
+            rollup_option = ""
         file.write("""###############################################################################
 
 # The ImageGenerator creates image plots of data.
@@ -650,6 +1539,7 @@ def createSkin(config_path, config_dict, db_binding):
         aggregate_interval = hour
 
 """)
+        file.write(rollup_option)
         for dev in config_dict['airQ'].sections:
             image_section(file, config_dict['airQ'][dev], dev, 'week', sensors[dev], obstypes[dev], seasons_lang)
 
@@ -663,6 +1553,7 @@ def createSkin(config_path, config_dict, db_binding):
         show_daynight = false
 
 """)
+        file.write(rollup_option)
         for dev in config_dict['airQ'].sections:
             image_section(file, config_dict['airQ'][dev], dev, 'month', sensors[dev],obstypes[dev], seasons_lang)
 
@@ -676,6 +1567,7 @@ def createSkin(config_path, config_dict, db_binding):
         show_daynight = false
 
 """)
+        file.write(rollup_option)
         for dev in config_dict['airQ'].sections:
             image_section(file, config_dict['airQ'][dev], dev, 'year', sensors[dev],obstypes[dev], seasons_lang)
 
@@ -701,8 +1593,16 @@ def createSkin(config_path, config_dict, db_binding):
         file.write("</ul>")
         file.write(HTML_FOOT)
         print("  done.")
+    # The snapshot file is expected in the same directory as the
+    # pages.
+    if config_dict['airQ'].get('snapshot_file'):
+        snapshot = (os.path.basename(config_dict['airQ']['snapshot_file']),
+                    max(to_float(config_dict['airQ'].get('snapshot_interval',5.0)),1.0))
+        print("snapshot file: %s every %.0f s" % snapshot)
+    else:
+        snapshot = None
     for dev in config_dict['airQ'].sections:
-        create_template(config_dict['airQ'][dev],dev,airq_skin_path,sensors[dev],obstypes[dev],gettext_style)
+        create_template(config_dict['airQ'][dev],dev,airq_skin_path,sensors[dev],obstypes[dev],gettext_style,snapshot)
 
 IMG_DICT = [
     ('barometer','pressure',['airqBarometer']),
@@ -747,8 +1647,24 @@ def _gettext_text(page, text, gettext_style):
         return '$gettext[%s][%s]' % (page,text)
     return '$pgettext(%s,%s)' % (page,text)
 
-def create_template(dev_dict, dev, airq_skin_path, sensors, obstypes, gettext_style):
+def _obs_unit(obs):
+    """ unit and format of the value in the template """
+    if obs=='airqHumAbs':
+        return '.gram_per_meter_cubed'
+    if obs in ('TVOC','so2','no2'):
+        return '.ppb'
+    if obs=='airqCO_m':
+        return '.milligram_per_meter_cubed.format("%.2f")'
+    if obs=='airqO3_m':
+        return '.microgram_per_meter_cubed.format("%.1f")'
+    if obs in ('pm1_0','pm2_5','pm10_0'):
+        return '.format("%.1f")'
+    return ''
+
+def create_template(dev_dict, dev, airq_skin_path, sensors, obstypes, gettext_style, snapshot=None):
     """ create html template """
+    # statistics of the device out of one query per period
+    stats_tag = "$airq_stats(%s)" % ("'%s'" % dev_dict['prefix'] if dev_dict.get('prefix') else '')
     fn = dev+'.html.tmpl'
     fn = os.path.join(airq_skin_path,fn)
     print("creating %s" % fn)
@@ -772,26 +1688,54 @@ def create_template(dev_dict, dev, airq_skin_path, sensors, obstypes, gettext_st
         for img in IMG_DICT:
             if img[1] in sensors:
                 for obs in img[2]:
-                    unit = ''
-                    if obs=='airqHumAbs':
-                        unit = '.gram_per_meter_cubed'
-                    elif obs in ('TVOC','so2','no2'):
-                        unit = '.ppb'
-                    elif obs=='airqCO_m':
-                        unit = '.milligram_per_meter_cubed.format("%.2f")'
-                    elif obs=='airqO3_m':
-                        unit = '.microgram_per_meter_cubed.format("%.1f")'
-                    elif obs in ('pm1_0','pm2_5','pm10_0'):
-                        unit = '.format("%.1f")'
+                    unit = _obs_unit(obs)
                     file.write('''<tr>
             <td class="label">$obs.label.%s</td>
-            <td class="data">$current.%s%s</td>
+            <td class="data" id="airq_%s"%s>$current.%s%s</td>
 </tr>
-''' % (obstype_with_prefix(obs,dev_dict.get('prefix')),obstype_with_prefix(obs,dev_dict.get('prefix')),unit))
+''' % (obstype_with_prefix(obs,dev_dict.get('prefix')),obstype_with_prefix(obs,dev_dict.get('prefix')),' data-unit="%s"' % unit.split('.')[1] if unit.startswith('.') and not unit.startswith('.format') else '',obstype_with_prefix(obs,dev_dict.get('prefix')),unit))
         file.write('''    </tbody>
   </table>
   </div>
 
+</div>
+''')
+        file.write('''
+<div id='hilo_widget' class="widget">
+  <div class="widget_title">
+    %s
+    <a class="widget_control"
+      onclick="toggle_widget('hilo')">&diams;</a>
+  </div>
+
+  <div class="widget_contents">
+  <table>
+    <tbody>
+      <tr>
+        <td></td>
+        <th>&nbsp;<br/>%s</th>
+        <th class="hilo_week">&nbsp;<br/>%s</th>
+        <th class="hilo_month">&nbsp;<br/>%s</th>
+        <th class="hilo_year">&nbsp;<br/>%s</th>
+      </tr>
+''' % tuple([_gettext_text(None,'"%s"' % ii,gettext_style) for ii in ('HiLo','Today','Week','Month','Year')]))
+        for img in IMG_DICT:
+            if img[1] in sensors:
+                for obs in img[2]:
+                    obsp = obstype_with_prefix(obs,dev_dict.get('prefix'))
+                    if obsp not in obstypes: continue
+                    unit = _obs_unit(obs)
+                    file.write('''      <tr>
+        <td class="label">$obs.label.%s</td>
+''' % obsp)
+                    for zeit in ('day','week','month','year'):
+                        file.write('''        <td class="data%s"><span class="hival">%s.%s.%s.max%s</span><br/><span class="loval">%s.%s.%s.min%s</span></td>
+''' % ('' if zeit=='day' else ' hilo_'+zeit,stats_tag,zeit,obsp,unit,stats_tag,zeit,obsp,unit))
+                    file.write('''      </tr>
+''')
+        file.write('''    </tbody>
+  </table>
+  </div>
 </div>
 
       </div>
@@ -823,16 +1767,28 @@ def create_template(dev_dict, dev, airq_skin_path, sensors, obstypes, gettext_st
 ''' % zeit)
             for img in IMG_DICT:
                 if img[1] in sensors:
-                    file.write('''            #if $%s.%s.hasdata
+                    # $airq_stats knows database columns only, so test
+                    # the first observation type of the plot that is 
+                    # a column. Types calculated on request (option
+                    # derived_obs = lazy) or excluded are not.
+                    cols = [obstype_with_prefix(obs,dev_dict.get('prefix')) for obs in img[2]]
+                    cols = [col for col in cols if col in obstypes]
+                    if cols:
+                        file.write('''            #if %s.%s.%s.hasdata
             <img src="%s%s%s.png" />
             #end if
-''' % (zeit,obstype_with_prefix(img[2][0],dev_dict.get('prefix')),zeit,dev,img[0]))
+''' % (stats_tag,zeit,cols[0],zeit,dev,img[0]))
+                    else:
+                        file.write('''            <img src="%s%s%s.png" />
+''' % (zeit,dev,img[0]))
             file.write('''          </div>
 ''')
         file.write('''
         </div>
       </div>
 ''')
+        if snapshot:
+            file.write(HTML_SNAPSHOT % (dev,snapshot[0],snapshot[1]*1000))
         file.write(HTML_FOOT)
         print("  done.")
 
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+#
+# shared-memory table of the latest readings of the airQ devices
+#
+# Copyright (C) 2021 Johanna Roedenbeck
+# airQ API Copyright (C) Corant GmbH
+
+"""
+
+The airQ service writes the latest reading of each device into a file
+that is mapped into memory, usually in /dev/shm. Any number of local
+processes can map that file read-only and get the current values
+without calling into the kernel for each read.
+
+Layout of the file (little endian):
+
+    header      magic 'AIRQSHM1', version, number of slots, number of
+                fields, size of a slot, flags
+    field names number of fields * 16 bytes, airQ names of the fields
+    slots       one slot per device in the order of the sections
+                within section [airQ] of weewx.conf
+
+Layout of a slot:
+
+    seq         uint32, sequence counter, odd while the slot is written
+    status      uint32, STATUS_OK, STATUS_SENSOR or STATUS_OFFLINE
+    name        32 bytes, name of the device section, longer names are
+                cut at a character boundary (see slot_key())
+    timestamp   float64, timestamp of the reading by the device (s)
+    arrival     float64, time of arrival of the reading (s)
+    values      number of fields * float64, NaN if not available
+
+Each slot is written by one thread only. The writer increments 'seq'
+before and after writing. The reader repeats reading until 'seq' is
+even and the same before and after (seqlock).
+
+If the set of devices changes, the writer creates a new file and
+renames it to the same path. Then it marks all the slots of the old
+file STATUS_OFFLINE and sets FLAG_REPLACED in its header. The reader
+checks that flag on every read and maps the new file.
+
+Example:
+
+    from user.airq_shm import AirqShmReader
+    shm = AirqShmReader('/dev/shm/weewx-airq')
+    rec = shm.read('livingroom')
+    if rec: print(rec['values']['co2'])
+
+"""
+
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'AIRQSHM1'
+VERSION = 2
+
+# fields of the slot, airQ names
+FIELDS = (
+    'co2','tvoc','temperature','humidity','humidity_abs','dewpt',
+    'pressure','pm1','pm2_5','pm10','co','no2','o3','so2','h2s',
+    'oxygen','sound','health','performance')
+
+STATUS_OK = 0
+STATUS_SENSOR = 1
+STATUS_OFFLINE = 2
+
+# flags of the header
+FLAG_REPLACED = 1
+
+HEADER = struct.Struct('<8sIIIII')
+FIELD_NAME = struct.Struct('<16s')
+SLOT_HEAD = struct.Struct('<II32sdd')
+SEQ = struct.Struct('<I')
+FLAGS = struct.Struct('<I')
+FLAGS_OFFSET = HEADER.size-FLAGS.size
+
+NAN = float('nan')
+
+# size of the name within the slot
+NAME_SIZE = 32
+
+
+def slot_key(name):
+    """ name of the device as stored in its slot
+
+        Names longer than NAME_SIZE bytes in UTF-8 are cut at a 
+        character boundary. Writer and reader look the slots up by 
+        that key, so they can be used with the full name.
+    """
+    buf = name.encode('utf-8')
+    if len(buf)<=NAME_SIZE: return name
+    return buf[:NAME_SIZE].decode('utf-8','ignore')
+
+
+def _slot_size(nfields):
+    # round up to a multiple of 64 bytes (cache line)
+    return (SLOT_HEAD.size+8*nfields+63)//64*64
+
+
+class AirqShmWriter(object):
+    """ write the readings of the devices into the shared memory """
+
+    def __init__(self, path, names=None):
+        """ open the file and create it, if 'names' is given """
+        self.path = path
+        if names is not None:
+            self._create(path, names)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        self.fields, self.slots, self.slot_size, self.offset = _read_header(self.map)
+        self.values = struct.Struct('<%sd' % len(self.fields))
+        self.seq = {}
+
+    @staticmethod
+    def _create(path, names):
+        """ write header and empty slots to a new file """
+        slot_size = _slot_size(len(FIELDS))
+        keys = [slot_key(name) for name in names]
+        for key in keys:
+            if keys.count(key)>1:
+                raise ValueError("device names sharing the first %s bytes '%s'" % (NAME_SIZE,key))
+        buf = bytearray(HEADER.size+FIELD_NAME.size*len(FIELDS)+slot_size*len(names))
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, len(names), len(FIELDS), slot_size, 0)
+        offset = HEADER.size
+        for field in FIELDS:
+            FIELD_NAME.pack_into(buf, offset, field.encode('ascii'))
+            offset += FIELD_NAME.size
+        for key in keys:
+            SLOT_HEAD.pack_into(buf, offset, 0, STATUS_OFFLINE, key.encode('utf-8'), 0, 0)
+            struct.pack_into('<%sd' % len(FIELDS), buf, offset+SLOT_HEAD.size, *([NAN]*len(FIELDS)))
+            offset += slot_size
+        # replace an existing file as a whole, the readers that still 
+        # map the old one switch over when the old one is retired
+        tmp = path+'.tmp'
+        with open(tmp,'wb') as file:
+            file.write(buf)
+        os.rename(tmp,path)
+
+    def write(self, name, reply, arrival=None):
+        """ write a reply of the device to its slot """
+        values = []
+        for field in self.fields:
+            val = reply.get(field)
+            if isinstance(val,list): val = val[0] if val else None
+            try:
+                values.append(float(val))
+            except (TypeError,ValueError):
+                values.append(NAN)
+        if reply.get('Status','OK')=='OK':
+            status = STATUS_OK
+        else:
+            status = STATUS_SENSOR
+        try:
+            ts = float(reply.get('timestamp',0))/1000.0
+        except (TypeError,ValueError):
+            ts = 0.0
+        self._write(name, status, ts, arrival if arrival else time.time(), values)
+
+    def set_offline(self, name):
+        """ mark the device as not reachable, keep the last values """
+        offset = self.offset.get(slot_key(name))
+        if offset is None or not self.map: return
+        try:
+            seq = self._begin(name, offset)
+            struct.pack_into('<I', self.map, offset+4, STATUS_OFFLINE)
+            SEQ.pack_into(self.map, offset, seq+2)
+        except ValueError:
+            # closed by another thread after the file was replaced
+            pass
+
+    def _begin(self, name, offset):
+        seq = self.seq.get(name, SEQ.unpack_from(self.map, offset)[0] & ~1)
+        self.seq[name] = seq+2
+        SEQ.pack_into(self.map, offset, seq+1)
+        return seq
+
+    def _write(self, name, status, ts, arrival, values):
+        key = slot_key(name)
+        offset = self.offset.get(key)
+        if offset is None or not self.map: return
+        try:
+            seq = self._begin(name, offset)
+            SLOT_HEAD.pack_into(self.map, offset, seq+1, status, key.encode('utf-8'), ts, arrival)
+            self.values.pack_into(self.map, offset+SLOT_HEAD.size, *values)
+            SEQ.pack_into(self.map, offset, seq+2)
+        except ValueError:
+            # closed by another thread after the file was replaced
+            pass
+
+    def retire(self):
+        """ mark the file as replaced by a new one and close it
+
+            The slots are set STATUS_OFFLINE first, so that readers 
+            that do not check the flag do not report stale readings
+            as current.
+        """
+        if not self.map: return
+        for key in self.offset:
+            self.set_offline(key)
+        FLAGS.pack_into(self.map, FLAGS_OFFSET, FLAGS.unpack_from(self.map, FLAGS_OFFSET)[0]|FLAG_REPLACED)
+        self.close()
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+
+
+class AirqShmReader(object):
+    """ read the latest readings out of the shared memory """
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            shm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            self.fields, self.slots, self.slot_size, self.offset = _read_header(shm)
+        except ValueError:
+            shm.close()
+            raise
+        self.values = struct.Struct('<%sd' % len(self.fields))
+        if self.map: self.map.close()
+        self.map = shm
+
+    def _check(self):
+        """ map the new file if the writer replaced the old one """
+        if FLAGS.unpack_from(self.map, FLAGS_OFFSET)[0] & FLAG_REPLACED:
+            try:
+                self._open()
+            except (OSError,ValueError):
+                # The new file is not available. Go on with the old 
+                # one, whose slots are offline.
+                pass
+
+    def devices(self):
+        """ names of the devices """
+        self._check()
+        return list(self.slots)
+
+    def read(self, name, retries=100):
+        """ consistent copy of the slot of the device 'name'
+
+            Returns None if the device is unknown or no consistent
+            copy could be read.
+        """
+        self._check()
+        offset = self.offset.get(slot_key(name))
+        if offset is None: return None
+        for ii in range(retries):
+            seq, status, _, ts, arrival = SLOT_HEAD.unpack_from(self.map, offset)
+            if seq & 1: continue
+            values = self.values.unpack_from(self.map, offset+SLOT_HEAD.size)
+            if SEQ.unpack_from(self.map, offset)[0]!=seq: continue
+            return {
+                'name':name,
+                'status':status,
+                'timestamp':ts,
+                'arrival':arrival,
+                'values':{field:val for field, val in zip(self.fields,values) if val==val}}
+        return None
+
+    def read_all(self):
+        """ consistent copies of all the slots """
+        self._check()
+        return {name:self.read(name) for name in self.slots}
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+
+
+def _read_header(buf):
+    """ get field names and slot offsets out of the header """
+    magic, version, nslots, nfields, slot_size, flags = HEADER.unpack_from(buf, 0)
+    if magic!=MAGIC or version!=VERSION:
+        raise ValueError("not an airQ shared memory file")
+    offset = HEADER.size
+    fields = []
+    for ii in range(nfields):
+        fields.append(FIELD_NAME.unpack_from(buf, offset)[0].rstrip(b'\0').decode('ascii'))
+        offset += FIELD_NAME.size
+    slots = []
+    offsets = {}
+    for ii in range(nslots):
+        name = SLOT_HEAD.unpack_from(buf, offset)[2].rstrip(b'\0').decode('utf-8')
+        slots.append(name)
+        offsets[name] = offset
+        offset += slot_size
+    return fields, slots, slot_size, offsets
+
+
+if __name__ == '__main__':
+    import sys
+    shm = AirqShmReader(sys.argv[1] if len(sys.argv)>1 else '/dev/shm/weewx-airq')
+    for name, rec in shm.read_all().items():
+        print(name, rec)
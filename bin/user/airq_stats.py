@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+#
+# search list extension: statistics of the readings of an airQ device
+#
+# Copyright (C) 2021 Johanna Roedenbeck
+# airQ API Copyright (C) Corant GmbH
+
+"""
+
+Tags like $day.co2.max cost one database query each. A page showing
+the minimum, average, and maximum of all the readings of a device for
+day, week, month, and year would run hundreds of them. The tag
+$airq_stats fetches the statistics of all the columns of a device for
+a period by one query and keeps them for the whole report run.
+
+Usage in a template:
+
+    $airq_stats('room').day.room_co2.max
+    $airq_stats('room').week.room_TVOC.avg
+    #if $airq_stats('room').year.room_pm2_5.hasdata
+
+The argument is the prefix of the device as set in weewx.conf, none
+for a device without prefix. Periods are 'day', 'week', 'month', and
+'year', aggregations 'min', 'max', 'avg', 'sum', 'count', and
+'hasdata'. The values are formatted and converted like those of the
+built-in tags.
+
+Configuration in skin.conf:
+
+[CheetahGenerator]
+    search_list_extensions = user.airq_stats.AirqStats
+
+[airQ]
+    data_binding = wx_binding # optional, default binding of the report
+
+The statistics are read out of the daily summaries. Columns without
+daily summary are aggregated out of the archive table.
+
+"""
+
+import weewx.units
+import weeutil.weeutil
+from weewx.cheetahgenerator import SearchList
+
+import user.airQ_corant
+
+try:
+    # Test for new-style weewx logging by trying to import weeutil.logger
+    import weeutil.logger
+    import logging
+    log = logging.getLogger("user.airQ.stats")
+
+    def logdbg(msg):
+        log.debug(msg)
+
+    def loginf(msg):
+        log.info(msg)
+
+    def logerr(msg):
+        log.error(msg)
+
+except ImportError:
+    # Old-style weewx logging
+    import syslog
+
+    def logmsg(level, msg):
+        syslog.syslog(level, 'user.airQ.stats: %s' % msg)
+
+    def logdbg(msg):
+        logmsg(syslog.LOG_DEBUG, msg)
+
+    def loginf(msg):
+        logmsg(syslog.LOG_INFO, msg)
+
+    def logerr(msg):
+        logmsg(syslog.LOG_ERR, msg)
+
+PERIODS = ('day','week','month','year')
+AGGREGATES = ('min','max','avg','sum','count')
+
+
+class AirqStats(SearchList):
+    """ search list extension providing the tag $airq_stats """
+
+    def __init__(self, generator):
+        super(AirqStats,self).__init__(generator)
+        self.data_binding = generator.skin_dict.get('airQ',{}).get('data_binding')
+        self.week_start = getattr(generator.stn_info,'week_start',6)
+        # statistics read during this report run
+        self.cache = {}
+        self.queries = 0
+
+    def get_extension_list(self, timespan, db_lookup):
+        return [{'airq_stats':AirqStatsBinder(self, timespan, db_lookup)}]
+
+    def finalize(self):
+        logdbg("%s queries for %s periods" % (self.queries,len(self.cache)))
+
+    def period_span(self, period, report_time):
+        """ time span of the period like the built-in tags """
+        if period=='day':
+            return weeutil.weeutil.archiveDaySpan(report_time)
+        if period=='week':
+            return weeutil.weeutil.archiveWeekSpan(report_time,startOfWeek=self.week_start)
+        if period=='month':
+            return weeutil.weeutil.archiveMonthSpan(report_time)
+        return weeutil.weeutil.archiveYearSpan(report_time)
+
+    def get_stats(self, dbmanager, data_binding, prefix, timespan):
+        """ statistics of all the columns of the device
+
+            Returns a dict of column name: (min, max, sum, count,
+            wsum, sumtime)
+        """
+        memo = (data_binding,prefix,timespan.start,timespan.stop)
+        if memo not in self.cache:
+            self.cache[memo] = self._query(dbmanager, self.columns(dbmanager,prefix), timespan)
+        return self.cache[memo]
+
+    @staticmethod
+    def columns(dbmanager, prefix):
+        """ numeric columns of the device """
+        sqlkeys = dbmanager.sqlkeys
+        return [col for col in
+            [user.airQ_corant.AirqService.obstype_with_prefix(obs[0],prefix)
+             for obs in user.airQ_corant.AirqService.AIRQ_DATA.values()
+             if obs and obs[2] is not None]
+            if col in sqlkeys]
+
+    def _query(self, dbmanager, cols, timespan):
+        """ one query for all the columns """
+        daykeys = getattr(dbmanager,'daykeys',None) or []
+        day_cols = [col for col in cols if col in daykeys]
+        archive_cols = [col for col in cols if col not in daykeys]
+        result = {}
+        if day_cols:
+            # The day summaries include 'dateTime' at the start of the
+            # day.
+            sql = ' UNION ALL '.join([
+                "SELECT '%s',MIN(min),MAX(max),SUM(sum),SUM(count),SUM(wsum),SUM(sumtime) "
+                "FROM %s_day_%s WHERE dateTime>=? AND dateTime<?" % (col,dbmanager.table_name,col)
+                for col in day_cols])
+            for row in dbmanager.genSql(sql,(timespan.start,timespan.stop)*len(day_cols)):
+                result[row[0]] = row[1:]
+            self.queries += 1
+        if archive_cols:
+            sql = "SELECT %s FROM %s WHERE dateTime>? AND dateTime<=?" % (
+                ','.join(['MIN(%s),MAX(%s),SUM(%s),COUNT(%s)' % (col,col,col,col) for col in archive_cols]),
+                dbmanager.table_name)
+            row = dbmanager.getSql(sql,(timespan.start,timespan.stop))
+            if row:
+                for ii, col in enumerate(archive_cols):
+                    result[col] = row[4*ii:4*ii+4]+(None,None)
+            self.queries += 1
+        return result
+
+
+class AirqStatsBinder(object):
+    """ $airq_stats(prefix) """
+
+    def __init__(self, stats, timespan, db_lookup):
+        self.stats = stats
+        self.timespan = timespan
+        self.db_lookup = db_lookup
+
+    def __call__(self, prefix=None, data_binding=None):
+        return AirqDeviceStats(self, prefix, data_binding or self.stats.data_binding)
+
+
+class AirqDeviceStats(object):
+    """ $airq_stats(prefix).period """
+
+    def __init__(self, binder, prefix, data_binding):
+        self.binder = binder
+        self.prefix = prefix
+        self.data_binding = data_binding
+
+    def __getattr__(self, period):
+        if period not in PERIODS:
+            raise AttributeError(period)
+        stats = self.binder.stats
+        dbmanager = self.binder.db_lookup(self.data_binding)
+        timespan = stats.period_span(period,self.binder.timespan.stop)
+        return AirqPeriodStats(
+            stats.get_stats(dbmanager,self.data_binding,self.prefix,timespan),
+            dbmanager.std_unit_system, period, stats.generator)
+
+
+class AirqPeriodStats(object):
+    """ $airq_stats(prefix).period.obs """
+
+    def __init__(self, values, usUnits, context, generator):
+        self.values = values
+        self.usUnits = usUnits
+        self.context = context
+        self.generator = generator
+
+    def __getattr__(self, obs_type):
+        if obs_type.startswith('__'):
+            raise AttributeError(obs_type)
+        return AirqObsStats(self, obs_type, self.values.get(obs_type))
+
+
+class AirqObsStats(object):
+    """ $airq_stats(prefix).period.obs.aggregation """
+
+    def __init__(self, period, obs_type, row):
+        self.period = period
+        self.obs_type = obs_type
+        # min, max, sum, count, wsum, sumtime
+        self.row = row if row else (None,None,None,0,None,None)
+
+    @property
+    def hasdata(self):
+        return bool(self.row[3])
+
+    def __getattr__(self, aggregate_type):
+        if aggregate_type not in AGGREGATES:
+            raise AttributeError(aggregate_type)
+        min_, max_, sum_, count, wsum, sumtime = self.row
+        if aggregate_type=='min':
+            val = min_
+        elif aggregate_type=='max':
+            val = max_
+        elif aggregate_type=='sum':
+            val = sum_
+        elif aggregate_type=='count':
+            val = count if count else 0
+        elif sumtime:
+            # time-weighted like the daily summaries of WeeWX
+            val = wsum/sumtime
+        else:
+            val = sum_/count if count else None
+        unit, group = weewx.units.getStandardUnitType(self.period.usUnits,self.obs_type,aggregate_type)
+        return weewx.units.ValueHelper(
+            weewx.units.ValueTuple(val,unit,group),
+            context=self.period.context,
+            formatter=self.period.generator.formatter,
+            converter=self.period.generator.converter)
@@ -26,7 +26,16 @@ class AirqInstaller(ExtensionInstaller):
                   'password':'replace_me',
                   '#prefix':'replace_me',
                   '#altitude': 'set_if_not_station_altitude'
-                  }}},
-            files=[('bin/user', ['bin/user/airQ_corant.py','bin/user/airq_conf.py']),
+                  }},
+              'DataBindings':{
+                  'airq_rollup_binding':{
+                      'database':'airq_rollup_sqlite',
+                      'table_name':'airq_rollup',
+                      'manager':'weewx.manager.Manager'}},
+              'Databases':{
+                  'airq_rollup_sqlite':{
+                      'database_name':'airq_rollup.sdb',
+                      'database_type':'SQLite'}}},
+            files=[('bin/user', ['bin/user/airQ_corant.py','bin/user/airq_conf.py','bin/user/airq_shm.py','bin/user/airq_stats.py']),
                    ('bin',      ['bin/airq_conf'])]
             )